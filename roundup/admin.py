@@ -22,9 +22,10 @@
 '''
 __docformat__ = 'restructuredtext'
 
-import csv, getopt, getpass, os, re, shutil, sys, UserDict
+import csv, getopt, getpass, os, re, shutil, sys, UserDict, marshal, time
 
-from roundup import date, hyperdb, roundupdb, init, password, token
+from roundup import date, hyperdb, roundupdb, init, password, token, support
+from roundup.backends.indexer_common import TextCollector
 from roundup import __version__ as roundup_version
 import roundup.instance
 from roundup.configuration import CoreConfig
@@ -1271,29 +1272,229 @@ Erase it? Y/N: """))
         return 0
 
     def do_reindex(self, args, desre=re.compile('([A-Za-z]+)([0-9]+)')):
-        ""'''Usage: reindex [classname|designator]*
+        ""'''Usage: reindex [--jobs N] [--resume] [classname|designator]*
         Re-generate a tracker's search indexes.
 
         This will re-generate the search indexes for a tracker.
         This will typically happen automatically.
+
+        With "--jobs N" the texts of the items are split into words by N
+        worker processes while this process writes them to the index.
+        Progress is committed and recorded every 1000 items;
+        "--resume" carries on from where an interrupted reindex stopped.
         '''
-        if args:
-            for arg in args:
-                m = desre.match(arg)
-                if m:
-                    cl = self.get_class(m.group(1))
-                    try:
-                        cl.index(m.group(2))
-                    except IndexError:
-                        raise UsageError, _('no such item "%(designator)s"')%{
-                            'designator': arg}
+        jobs = 1
+        resume = 0
+        names = []
+        while args:
+            arg = args.pop(0)
+            if arg == '--resume':
+                resume = 1
+            elif arg == '--jobs' or arg.startswith('--jobs='):
+                if arg == '--jobs':
+                    if not args:
+                        raise UsageError, _('--jobs needs a number')
+                    arg = args.pop(0)
                 else:
-                    cl = self.get_class(arg)
-                    self.db.reindex(arg)
-        else:
-            self.db.reindex(show_progress=True)
+                    arg = arg[7:]
+                try:
+                    jobs = int(arg)
+                except ValueError:
+                    raise UsageError, _('--jobs needs a number')
+                if jobs < 1:
+                    raise UsageError, _('--jobs needs a number')
+            else:
+                names.append(arg)
+
+        classes = []
+        for arg in names:
+            m = desre.match(arg)
+            if m:
+                cl = self.get_class(m.group(1))
+                try:
+                    cl.index(m.group(2))
+                except IndexError:
+                    raise UsageError, _('no such item "%(designator)s"')%{
+                        'designator': arg}
+            else:
+                classes.append(self.get_class(arg))
+        if names and not classes:
+            return 0
+        if not names:
+            classes = [self.db.getclass(cn) for cn in self.db.getclasses()]
+
+        if jobs == 1 and not resume:
+            if names:
+                for cl in classes:
+                    self.db.reindex(cl.classname)
+            else:
+                self.db.reindex(show_progress=True)
+            return 0
+
+        self.reindex_classes(classes, jobs, resume)
         return 0
 
+    # the number of items indexed between progress checkpoints
+    reindex_interval = 1000
+
+    def reindex_classes(self, classes, jobs=1, resume=0):
+        '''Reindex the items of the classes in id order, committing and
+        recording the last indexed id of each class (in the
+        "reindex-checkpoint" file of the tracker database) every
+        "reindex_interval" items.
+
+        If "resume" is true the items up to the recorded ids are skipped.
+        With more than one job, the texts of the items are handed out in
+        turn to worker processes (see reindex_workers) which split them
+        into words, and this process writes the words to the index.
+        '''
+        checkpoint = os.path.join(self.db.config.DATABASE,
+            'reindex-checkpoint')
+        done = {}
+        if resume and os.path.exists(checkpoint):
+            f = open(checkpoint, 'rb')
+            try:
+                done = marshal.load(f)
+            finally:
+                f.close()
+
+        if not hasattr(os, 'fork'):
+            jobs = 1
+        indexer = self.db.indexer
+        workers = []
+        if jobs > 1:
+            workers = self.reindex_workers(indexer, jobs)
+
+        try:
+            total = 0
+            total_start = time.time()
+            for klass in classes:
+                cn = klass.classname
+                last = done.get(cn, 0)
+                ids = [int(nodeid) for nodeid in klass.list()]
+                ids.sort()
+                ids = [str(nodeid) for nodeid in ids if nodeid > last]
+                if not ids:
+                    continue
+
+                start = time.time()
+                indexer.begin_batch()
+                # the items handed to the workers, oldest first
+                pending = []
+                count = 0
+                for nodeid in support.Progress('Reindex %s'%cn, ids):
+                    if not workers:
+                        klass.index(nodeid)
+                    else:
+                        # collect the texts of the item...
+                        collector = TextCollector()
+                        self.db.indexer = collector
+                        try:
+                            klass.index(nodeid)
+                        finally:
+                            self.db.indexer = indexer
+                        # ... and have the next worker split them, once
+                        # it's done with its previous item
+                        worker = workers[count % jobs]
+                        if len(pending) == jobs:
+                            self.reindex_store(pending.pop(0))
+                        marshal.dump(collector.texts, worker[1])
+                        worker[1].flush()
+                        pending.append(worker)
+                    count += 1
+                    if count % self.reindex_interval == 0 or count == len(ids):
+                        while pending:
+                            self.reindex_store(pending.pop(0))
+                        self.db.commit()
+                        done[cn] = int(nodeid)
+                        f = open(checkpoint, 'wb')
+                        try:
+                            marshal.dump(done, f)
+                        finally:
+                            f.close()
+                        indexer.begin_batch()
+
+                elapsed = time.time() - start
+                total += count
+                print _('%(cn)s: %(count)s items in %(elapsed).1fs '
+                    '(%(rate).1f items/s)')%{'cn': cn, 'count': count,
+                    'elapsed': elapsed, 'rate': count / max(elapsed, 0.001)}
+        finally:
+            for pid, tasks, results in workers:
+                tasks.close()
+                results.close()
+                os.waitpid(pid, 0)
+
+        elapsed = time.time() - total_start
+        print _('Reindexed %(total)s items in %(elapsed).1fs '
+            '(%(rate).1f items/s)')%{'total': total, 'elapsed': elapsed,
+            'rate': total / max(elapsed, 0.001)}
+        indexer.save_index()
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+    def reindex_store(self, worker):
+        '''Add the words of the next item split by the worker to the
+        index.
+        '''
+        pid, tasks, results = worker
+        try:
+            texts = marshal.load(results)
+        except (EOFError, ValueError, TypeError):
+            raise ValueError, _('reindex worker %(pid)s failed')%locals()
+        for identifier, words in texts:
+            self.db.indexer.add_words(identifier, words)
+
+    def reindex_workers(self, indexer, jobs):
+        '''Fork "jobs" processes splitting texts with the indexer's
+        split_text(). Each reads lists of (identifier, text, mime_type)
+        from its "tasks" pipe and answers each with the list of
+        (identifier, words) on its "results" pipe. The workers don't use
+        the database at all.
+
+        Returns a list of (pid, tasks file, results file).
+        '''
+        workers = []
+        for job in range(jobs):
+            task_r, task_w = os.pipe()
+            result_r, result_w = os.pipe()
+            pid = os.fork()
+            if pid:
+                os.close(task_r)
+                os.close(result_w)
+                workers.append((pid, os.fdopen(task_w, 'wb'),
+                    os.fdopen(result_r, 'rb')))
+                continue
+
+            # in the worker
+            status = 1
+            try:
+                try:
+                    os.close(task_w)
+                    os.close(result_r)
+                    for pid, tasks, results in workers:
+                        tasks.close()
+                        results.close()
+                    tasks = os.fdopen(task_r, 'rb')
+                    results = os.fdopen(result_w, 'wb')
+                    while 1:
+                        try:
+                            texts = marshal.load(tasks)
+                        except EOFError:
+                            break
+                        marshal.dump([(identifier, indexer.split_text(text,
+                            mime_type)) for identifier, text, mime_type
+                            in texts], results)
+                        results.flush()
+                    status = 0
+                except:
+                    import traceback
+                    traceback.print_exc()
+            finally:
+                # skip the cleanup (of the database...) meant for the parent
+                os._exit(status)
+        return workers
+
     def do_security(self, args):
         ""'''Usage: security [Role name]
         Display the Permissions available to one or all Roles.
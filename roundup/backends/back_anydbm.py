@@ -70,7 +70,7 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
       modified. Do some sort of conflict checking on the dirty stuff.
     - perhaps detect write collisions (related to above)?
     '''
-    def __init__(self, config, journaltag=None):
+    def __init__(self, config, journaltag=None, cached_security=None):
         '''Open a hyperdatabase given a specifier to some storage.
 
         The 'storagelocator' is obtained from config.DATABASE.
@@ -84,6 +84,10 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         None, the database is opened in read-only mode: the Class.create(),
         Class.set(), Class.retire(), and Class.restore() methods are
         disabled.
+
+        If 'cached_security' is given, the database uses a copy of that
+        Security (see Tracker.open_cached()) instead of setting up a new
+        one.
         '''
         FileStorage.__init__(self, config.UMASK)
         self.config, self.journaltag = config, journaltag
@@ -96,8 +100,15 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         self.newnodes = {}      # keep track of the new nodes by class
         self.destroyednodes = {}# keep track of the destroyed nodes by class
         self.transactions = []
+        self.changed_classes = {}
+        self.change_stamps = {}
+        self.session_manager = None
+        self.otk_manager = None
         self.indexer = Indexer(self)
-        self.security = security.Security(self)
+        if cached_security is None:
+            self.security = security.Security(self)
+        else:
+            self.security = cached_security.bind(self)
         os.umask(config.UMASK)
 
         # lock it
@@ -119,10 +130,19 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         self.reindex()
 
     def getSessionManager(self):
-        return Sessions(self)
+        if self.session_manager is None:
+            self.session_manager = Sessions(self)
+        return self.session_manager
 
     def getOTKManager(self):
-        return OneTimeKeys(self)
+        if self.otk_manager is None:
+            self.otk_manager = OneTimeKeys(self)
+        return self.otk_manager
+
+    def sessionStores(self):
+        '''Return the session and one-time-key stores in use.
+        '''
+        return filter(None, [self.session_manager, self.otk_manager])
 
     def reindex(self, classname=None, show_progress=False):
         if classname:
@@ -195,6 +215,11 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
                     os.remove(path)
                 elif os.path.exists(path+'.db'):    # dbm appends .db
                     os.remove(path+'.db')
+            path = os.path.join(self.dir, 'filter.%s'%cn)
+            if os.path.exists(path):
+                os.remove(path)
+            elif os.path.exists(path+'.db'):    # dbm appends .db
+                os.remove(path+'.db')
         # reset id sequences
         path = os.path.join(os.getcwd(), self.dir, '_ids')
         if os.path.exists(path):
@@ -308,6 +333,7 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         if __debug__:
             logging.getLogger('hyperdb').debug('save %s%s %r'%(classname, nodeid, node))
         self.transactions.append((self.doSaveNode, (classname, nodeid, node)))
+        self.noteChange(classname)
 
     def getnode(self, classname, nodeid, db=None, cache=1):
         ''' get a node from the database
@@ -379,6 +405,7 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         # add the destroy commit action
         self.transactions.append((self.doDestroyNode, (classname, nodeid)))
         self.transactions.append((FileStorage.destroy, (self, classname, nodeid)))
+        self.noteChange(classname)
 
     def serialise(self, classname, node):
         '''Copy the node contents, converting non-marshallable data into
@@ -491,6 +518,7 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
             creator = self.getuid()
         self.transactions.append((self.doSaveJournal, (classname, nodeid,
             action, params, creator, creation)))
+        self.noteChange(classname)
 
     def setjournal(self, classname, nodeid, journal):
         '''Set the journal to the "journal" list.'''
@@ -499,6 +527,7 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
                 nodeid, journal))
         self.transactions.append((self.doSetJournal, (classname, nodeid,
             journal)))
+        self.noteChange(classname)
 
     def getjournal(self, classname, nodeid):
         ''' get the journal for id
@@ -636,6 +665,11 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
 
         self.clearCache()
 
+        self.renewChangeStamps()
+
+        for store in self.sessionStores():
+            store.commit()
+
     def clearCache(self):
         # all transactions committed, back to normal
         self.cache = {}
@@ -655,9 +689,18 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
 
     def doSaveNode(self, classname, nodeid, node):
         db = self.getCachedClassDB(classname)
+        data = self.serialise(classname, node)
+
+        # keep the filter index up to date
+        idx = self.getCachedFilterIndexDB(classname)
+        if idx is not None:
+            old = None
+            if db.has_key(nodeid):
+                old = marshal.loads(db[nodeid])
+            self.updateFilterIndex(idx, classname, nodeid, old, data)
 
         # now save the marshalled data
-        db[nodeid] = marshal.dumps(self.serialise(classname, node))
+        db[nodeid] = marshal.dumps(data)
 
         # return the classname, nodeid so we reindex this content
         return (classname, nodeid)
@@ -718,6 +761,10 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         # delete from the class database
         db = self.getCachedClassDB(classname)
         if db.has_key(nodeid):
+            idx = self.getCachedFilterIndexDB(classname)
+            if idx is not None:
+                old = marshal.loads(db[nodeid])
+                self.updateFilterIndex(idx, classname, nodeid, old, None)
             del db[nodeid]
 
         # delete from the database
@@ -725,6 +772,134 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         if db.has_key(nodeid):
             del db[nodeid]
 
+    #
+    # Filter index
+    #
+    # The filter index of a class maps "propname:value" keys to the
+    # space-separated ids of the nodes having that value for one of the
+    # Link, Multilink or Boolean properties of the class. An empty value
+    # stands for an unset Link or Boolean and an empty Multilink. The
+    # "__props__" key records which properties the index was built for.
+    #
+    def getIndexedProps(self, classname):
+        ''' Return a dict of the properties of the class that are kept
+            in its filter index
+        '''
+        d = {}
+        for propname, prop in self.getclass(classname).getprops().items():
+            if isinstance(prop, (hyperdb.Link, hyperdb.Multilink,
+                    hyperdb.Boolean)):
+                d[propname] = prop
+        return d
+
+    def filterIndexKey(self, propname, prop, value):
+        ''' Return the filter index key for a single property value
+        '''
+        if value is None:
+            value = ''
+        elif isinstance(prop, hyperdb.Boolean):
+            value = value and '1' or '0'
+        return '%s:%s'%(propname, value)
+
+    def filterIndexKeys(self, props, node):
+        ''' Return all the filter index keys of the serialised node for
+            the given properties
+        '''
+        keys = {}
+        for propname, prop in props.items():
+            value = node.get(propname)
+            if isinstance(prop, hyperdb.Multilink):
+                if not value:
+                    keys[self.filterIndexKey(propname, prop, None)] = 1
+                else:
+                    for v in value:
+                        keys[self.filterIndexKey(propname, prop, v)] = 1
+            else:
+                keys[self.filterIndexKey(propname, prop, value)] = 1
+        return keys
+
+    def getCachedFilterIndexDB(self, classname):
+        ''' get the filter index db, looking in our cache of databases
+            for commit. None is returned if the index hasn't been built.
+        '''
+        db_name = 'filter.%s'%classname
+        if not self.databases.has_key(db_name):
+            path = os.path.join(os.getcwd(), self.dir, db_name)
+            if not whichdb.whichdb(path):
+                return None
+            self.databases[db_name] = self.opendb(db_name, 'c')
+        return self.databases[db_name]
+
+    def updateFilterIndex(self, idx, classname, nodeid, old, new):
+        ''' Move the node from the filter index entries of its "old"
+            serialised values to those of the "new" ones (either may be
+            None)
+        '''
+        if not idx.has_key('__props__'):
+            return
+        props = self.getclass(classname).getprops()
+        indexed = {}
+        for propname in idx['__props__'].split():
+            if props.has_key(propname):
+                indexed[propname] = props[propname]
+        oldkeys = newkeys = {}
+        if old is not None:
+            oldkeys = self.filterIndexKeys(indexed, old)
+        if new is not None:
+            newkeys = self.filterIndexKeys(indexed, new)
+        for key in oldkeys.keys():
+            if newkeys.has_key(key) or not idx.has_key(key):
+                continue
+            ids = idx[key].split()
+            if nodeid in ids:
+                ids.remove(nodeid)
+            if ids:
+                idx[key] = ' '.join(ids)
+            else:
+                del idx[key]
+        for key in newkeys.keys():
+            if oldkeys.has_key(key):
+                continue
+            if idx.has_key(key):
+                ids = idx[key].split()
+                if nodeid not in ids:
+                    idx[key] = ' '.join(ids + [nodeid])
+            else:
+                idx[key] = nodeid
+
+    def getFilterIndex(self, classname):
+        ''' Open the filter index of the class for reading, (re)building
+            it first if it's missing or was built for another schema
+        '''
+        props = self.getIndexedProps(classname)
+        propnames = props.keys()
+        propnames.sort()
+        propnames = ' '.join(propnames)
+
+        db_name = 'filter.%s'%classname
+        idx = self.opendb(db_name, 'c')
+        if idx.has_key('__props__') and idx['__props__'] == propnames:
+            return idx
+
+        logging.getLogger('hyperdb').info('build filter index %s'%classname)
+        entries = {}
+        cldb = self.getclassdb(classname)
+        try:
+            for nodeid in cldb.keys():
+                node = marshal.loads(cldb[nodeid])
+                for key in self.filterIndexKeys(props, node).keys():
+                    entries.setdefault(key, []).append(nodeid)
+        finally:
+            cldb.close()
+        for key in idx.keys():
+            del idx[key]
+        for key, ids in entries.items():
+            idx[key] = ' '.join(ids)
+        # mark the index complete last
+        idx['__props__'] = propnames
+        idx.close()
+        return self.opendb(db_name, 'r')
+
     def rollback(self):
         ''' Reverse all actions from the current transaction.
         '''
@@ -740,14 +915,21 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         self.newnodes = {}
         self.destroyednodes = {}
         self.transactions = []
+        self.forgetChanges()
+        for store in self.sessionStores():
+            store.rollback()
 
     def close(self):
-        ''' Nothing to do
+        ''' Write the session changes left and release the lock
         '''
-        if self.lockfile is not None:
-            locking.release_lock(self.lockfile)
-            self.lockfile.close()
-            self.lockfile = None
+        try:
+            for store in self.sessionStores():
+                store.close()
+        finally:
+            if self.lockfile is not None:
+                locking.release_lock(self.lockfile)
+                self.lockfile.close()
+                self.lockfile = None
 
 _marker = []
 class Class(hyperdb.Class):
@@ -1649,14 +1831,64 @@ class Class(hyperdb.Class):
                 l.append((OTHER, k, [float(val) for val in v]))
 
         filterspec = l
-        
+
+        # Link, Multilink and Boolean filters may be looked up in the
+        # filter index: each gives the set of candidate nodes having
+        # any of the wanted values
+        lookups = []
+        for t, k, v in filterspec:
+            propclass = props[k]
+            if t == LINK:
+                keys = [self.db.filterIndexKey(k, propclass, entry)
+                    for entry in v]
+            elif t == MULTILINK:
+                if v:
+                    keys = [self.db.filterIndexKey(k, propclass, entry)
+                        for entry in v]
+                else:
+                    keys = [self.db.filterIndexKey(k, propclass, None)]
+            elif t == OTHER and isinstance(propclass, hyperdb.Boolean):
+                keys = [self.db.filterIndexKey(k, propclass, entry)
+                    for entry in v]
+            else:
+                continue
+            lookups.append(keys)
+
         # now, find all the nodes that are active and pass filtering
         matches = []
         cldb = self.db.getclassdb(cn)
         t = 0
         try:
-            # TODO: only full-scan once (use items())
-            for nodeid in self.getnodeids(cldb):
+            if lookups:
+                candidates = None
+                idx = self.db.getFilterIndex(cn)
+                try:
+                    for keys in lookups:
+                        found = {}
+                        for key in keys:
+                            if idx.has_key(key):
+                                for nodeid in idx[key].split():
+                                    found[nodeid] = 1
+                        if candidates is not None:
+                            for nodeid in found.keys():
+                                if not candidates.has_key(nodeid):
+                                    del found[nodeid]
+                        candidates = found
+                finally:
+                    idx.close()
+                # the index only holds committed data - the uncommitted
+                # nodes are checked against the full filter below
+                for nodes in self.db.newnodes, self.db.dirtynodes:
+                    if nodes.has_key(cn):
+                        candidates.update(nodes[cn])
+                if self.db.destroyednodes.has_key(cn):
+                    for nodeid in self.db.destroyednodes[cn].keys():
+                        if candidates.has_key(nodeid):
+                            del candidates[nodeid]
+                nodeids = candidates.keys()
+            else:
+                nodeids = self.getnodeids(cldb)
+            for nodeid in nodeids:
                 node = self.db.getnode(cn, nodeid, cldb)
                 if node.has_key(self.db.RETIRED_FLAG):
                     continue
@@ -36,6 +36,7 @@ __docformat__ = 'restructuredtext'
 
 from roundup.backends.rdbms_common import *
 from roundup.backends import rdbms_common
+from roundup.backends import connpool
 import MySQLdb
 import os, shutil
 from MySQLdb.constants import ER
@@ -52,6 +53,8 @@ def connection_dict(config, dbnamestr=None):
 
 def db_nuke(config):
     """Clear all database contents and drop database itself"""
+    # pooled connections would keep the tables locked
+    connpool.clear_pools()
     if db_exists(config):
         kwargs = connection_dict(config)
         conn = MySQLdb.connect(**kwargs)
@@ -141,18 +144,26 @@ class Database(Database):
     def sql_open_connection(self):
         kwargs = connection_dict(self.config, 'db')
         logging.getLogger('hyperdb').info('open database %r'%(kwargs['db'],))
+        pool = self.sql_pool(kwargs, MySQLdb.connect)
         try:
-            conn = MySQLdb.connect(**kwargs)
+            if pool is None:
+                conn = MySQLdb.connect(**kwargs)
+            else:
+                conn = pool.get()
         except MySQLdb.OperationalError, message:
             raise DatabaseError, message
+        self.connection_pool = pool
         cursor = conn.cursor()
         cursor.execute("SET AUTOCOMMIT=0")
         cursor.execute("START TRANSACTION")
         return (conn, cursor)
 
     def open_connection(self):
-        # make sure the database actually exists
-        if not db_exists(self.config):
+        # make sure the database actually exists (which it does if there
+        # are idle pooled connections)
+        pool = self.sql_pool(connection_dict(self.config, 'db'),
+            MySQLdb.connect)
+        if (pool is None or not pool.idle) and not db_exists(self.config):
             db_create(self.config)
 
         self.conn, self.cursor = self.sql_open_connection()
@@ -203,20 +214,25 @@ class Database(Database):
             ENGINE=%s'''%self.mysql_backend)
         self.sql('''CREATE INDEX sessions_key_idx ON
             sessions(session_key)''')
+        self.create_session_time_indexes()
 
         # full-text indexing store
         self.sql('''CREATE TABLE __textids (_class VARCHAR(255),
             _itemid VARCHAR(255), _prop VARCHAR(255), _textid INT)
             ENGINE=%s'''%self.mysql_backend)
-        self.sql('''CREATE TABLE __words (_word VARCHAR(30),
-            _textid INT) ENGINE=%s'''%self.mysql_backend)
-        self.sql('CREATE INDEX words_word_ids ON __words(_word)')
-        self.sql('CREATE INDEX words_by_id ON __words (_textid)')
+        self.create_words_table()
         self.sql('CREATE UNIQUE INDEX __textids_by_props ON '
                  '__textids (_class, _itemid, _prop)')
         sql = 'insert into ids (name, num) values (%s,%s)'%(self.arg, self.arg)
         self.sql(sql, ('__textids', 1))
 
+    def create_words_table(self):
+        self.sql('''CREATE TABLE __words (_word VARCHAR(30),
+            _textid INT, _count INT, _positions MEDIUMTEXT)
+            ENGINE=%s'''%self.mysql_backend)
+        self.sql('CREATE INDEX words_word_ids ON __words(_word)')
+        self.sql('CREATE INDEX words_by_id ON __words (_textid)')
+
     def add_new_columns_v2(self):
         '''While we're adding the actor column, we need to update the
         tables to have the correct datatypes.'''
@@ -360,6 +376,12 @@ class Database(Database):
             # change things
             self.database_schema['tables'][cn] = klass.schema()
 
+    def fix_version_7_tables(self):
+        rdbms_common.Database.fix_version_7_tables(self)
+        # the positions of a common word in a large text don't fit in the
+        # TEXT column (64KB) created by versions 6 and 7
+        self.sql('ALTER TABLE __words MODIFY _positions MEDIUMTEXT')
+
     def fix_version_2_tables(self):
         # Convert journal date column to TIMESTAMP, params column to TEXT
         self._convert_journal_tables()
@@ -559,6 +581,9 @@ class Database(Database):
 
     def sql_close(self):
         logging.getLogger('hyperdb').info('close')
+        if self.connection_pool is not None:
+            self.connection_pool.put(self.conn)
+            return
         try:
             self.conn.close()
         except MySQLdb.ProgrammingError, message:
@@ -9,7 +9,8 @@
 '''Postgresql backend via psycopg for Roundup.'''
 __docformat__ = 'restructuredtext'
 
-import os, shutil, popen2, time
+import os, shutil, popen2, time, re
+from cStringIO import StringIO
 try:
     import psycopg
     from psycopg import QuotedString
@@ -23,6 +24,7 @@ import logging
 from roundup import hyperdb, date
 from roundup.backends import rdbms_common
 from roundup.backends import sessions_rdbms
+from roundup.backends import connpool
 
 def connection_dict(config, dbnamestr=None):
     ''' read_default_group is MySQL-specific, ignore it '''
@@ -41,6 +43,8 @@ def db_create(config):
 
 def db_nuke(config, fail_ok=0):
     """Clear all database contents and drop database itself"""
+    # pooled connections would keep the database busy
+    connpool.clear_pools()
     command = 'DROP DATABASE %s'% config.RDBMS_NAME
     logging.getLogger('hyperdb').info(command)
     db_command(config, command)
@@ -126,23 +130,30 @@ class Database(rdbms_common.Database):
     # used by some code to switch styles of query
     implements_intersect = 1
 
-    def getSessionManager(self):
-        return Sessions(self)
+    session_class = Sessions
 
     def sql_open_connection(self):
         db = connection_dict(self.config, 'database')
         logging.getLogger('hyperdb').info('open database %r'%db['database'])
+        pool = self.sql_pool(db, psycopg.connect)
         try:
-            conn = psycopg.connect(**db)
+            if pool is None:
+                conn = psycopg.connect(**db)
+            else:
+                conn = pool.get()
         except psycopg.OperationalError, message:
             raise hyperdb.DatabaseError, message
+        self.connection_pool = pool
 
         cursor = conn.cursor()
 
         return (conn, cursor)
 
     def open_connection(self):
-        if not db_exists(self.config):
+        # idle pooled connections mean the database exists
+        pool = self.sql_pool(connection_dict(self.config, 'database'),
+            psycopg.connect)
+        if (pool is None or not pool.idle) and not db_exists(self.config):
             db_create(self.config)
 
         self.conn, self.cursor = self.sql_open_connection()
@@ -171,18 +182,24 @@ class Database(rdbms_common.Database):
             session_value TEXT)''')
         self.sql('''CREATE INDEX sessions_key_idx ON
             sessions(session_key)''')
+        self.create_session_time_indexes()
 
         # full-text indexing store
         self.sql('CREATE SEQUENCE ___textids_ids')
         self.sql('''CREATE TABLE __textids (
             _textid integer primary key, _class VARCHAR(255),
             _itemid VARCHAR(255), _prop VARCHAR(255))''')
+        self.create_words_table()
+        self.sql('CREATE UNIQUE INDEX __textids_by_props ON '
+                 '__textids (_class, _itemid, _prop)')
+
+    def create_words_table(self):
         self.sql('''CREATE TABLE __words (_word VARCHAR(30),
-            _textid integer)''')
+            _textid integer, _count integer, _positions TEXT)''')
         self.sql('CREATE INDEX words_word_idx ON __words(_word)')
         self.sql('CREATE INDEX words_by_id ON __words (_textid)')
-        self.sql('CREATE UNIQUE INDEX __textids_by_props ON '
-                 '__textids (_class, _itemid, _prop)')
+        self.sql('''CREATE INDEX words_both_idx ON public.__words
+            USING btree (_word, _textid)''')
 
     def fix_version_2_tables(self):
         # Convert journal date column to TIMESTAMP, params column to TEXT
@@ -203,8 +220,9 @@ class Database(rdbms_common.Database):
 
     def fix_version_3_tables(self):
         rdbms_common.Database.fix_version_3_tables(self)
-        self.sql('''CREATE INDEX words_both_idx ON public.__words
-            USING btree (_word, _textid)''')
+        if not self.sql_index_exists('__words', 'words_both_idx'):
+            self.sql('''CREATE INDEX words_both_idx ON public.__words
+                USING btree (_word, _textid)''')
 
     def add_actor_column(self):
         # update existing tables to have the new actor column
@@ -233,11 +251,53 @@ class Database(rdbms_common.Database):
         # open a new cursor for subsequent work
         self.cursor = self.conn.cursor()
 
+    stream_cursors = 0
+    def sql_stream_cursor(self):
+        ''' With psycopg2, use a named (server-side) cursor so the rows
+            aren't all sent at once.
+        '''
+        try:
+            from psycopg2.extensions import connection
+        except ImportError:
+            return self.conn.cursor()
+        # (psycopg 1 is used if it's installed too)
+        if not isinstance(self.conn, connection):
+            return self.conn.cursor()
+        self.stream_cursors += 1
+        return connection.cursor(self.conn, 'roundup_stream_%d'%
+            self.stream_cursors)
+
     def sql_stringquote(self, value):
         ''' psycopg.QuotedString returns a "buffer" object with the
             single-quotes around it... '''
         return str(QuotedString(str(value)))[1:-1]
 
+    copy_escapes = {'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'}
+    def sql_insert_rows(self, table, columns, rows,
+            copy_escape=re.compile(r'[\\\t\n\r]')):
+        ''' Insert the rows with a single COPY when the driver can.
+        '''
+        if not rows:
+            return
+        if not hasattr(self.cursor, 'copy_from'):
+            return rdbms_common.Database.sql_insert_rows(self, table,
+                columns, rows)
+        lines = []
+        for row in rows:
+            values = []
+            for value in row:
+                if value is None:
+                    values.append('\\N')
+                else:
+                    values.append(copy_escape.sub(lambda m:
+                        self.copy_escapes[m.group(0)], str(value)))
+            lines.append('\t'.join(values))
+        if __debug__:
+            logging.getLogger('hyperdb').debug('COPY %s %r (%d rows)'%(table,
+                columns, len(rows)))
+        self.cursor.copy_from(StringIO('\n'.join(lines) + '\n'), table,
+            columns=columns)
+
     def sql_index_exists(self, table_name, index_name):
         sql = 'select count(*) from pg_indexes where ' \
             'tablename=%s and indexname=%s'%(self.arg, self.arg)
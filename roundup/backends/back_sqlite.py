@@ -137,19 +137,23 @@ class Database(rdbms_common.Database):
             'session_time integer, session_value varchar)')
         self.sql('create index sessions_key_idx on '
                 'sessions(session_key)')
+        self.create_session_time_indexes()
 
         # full-text indexing store
         self.sql('CREATE TABLE __textids (_class varchar, '
             '_itemid varchar, _prop varchar, _textid integer primary key) ')
-        self.sql('CREATE TABLE __words (_word varchar, '
-            '_textid integer)')
-        self.sql('CREATE INDEX words_word_ids ON __words(_word)')
-        self.sql('CREATE INDEX words_by_id ON __words (_textid)')
+        self.create_words_table()
         self.sql('CREATE UNIQUE INDEX __textids_by_props ON '
                  '__textids (_class, _itemid, _prop)')
         sql = 'insert into ids (name, num) values (%s,%s)'%(self.arg, self.arg)
         self.sql(sql, ('__textids', 1))
 
+    def create_words_table(self):
+        self.sql('CREATE TABLE __words (_word varchar, '
+            '_textid integer, _count integer, _positions varchar)')
+        self.sql('CREATE INDEX words_word_ids ON __words(_word)')
+        self.sql('CREATE INDEX words_by_id ON __words (_textid)')
+
     def add_new_columns_v2(self):
         # update existing tables to have the new actor column
         tables = self.database_schema['tables']
@@ -331,6 +335,16 @@ class Database(rdbms_common.Database):
         # open a new cursor for subsequent work
         self.cursor = self.conn.cursor()
 
+    def sql_insert_rows(self, table, columns, rows):
+        # there are no round-trips to save, and older SQLite versions
+        # don't support multi-row INSERTs
+        sql = 'insert into %s (%s) values (%s)'%(table, ','.join(columns),
+            ','.join([self.arg] * len(columns)))
+        if __debug__:
+            logging.getLogger('hyperdb').debug('SQL %r (%d rows)'%(sql,
+                len(rows)))
+        self.cursor.executemany(sql, rows)
+
     def sql_index_exists(self, table_name, index_name):
         self.sql('pragma index_list(%s)'%table_name)
         for entry in self.cursor.fetchall():
@@ -387,12 +401,12 @@ class Database(rdbms_common.Database):
 
 class sqliteClass:
     def filter(self, search_matches, filterspec, sort=(None,None),
-            group=(None,None)):
+            group=(None,None), limit=None, offset=None):
         ''' If there's NO matches to a fetch, sqlite returns NULL
             instead of nothing
         '''
         return filter(None, rdbms_common.Class.filter(self, search_matches,
-            filterspec, sort=sort, group=group))
+            filterspec, sort=sort, group=group, limit=limit, offset=offset))
 
 class Class(sqliteClass, rdbms_common.Class):
     pass
@@ -27,8 +27,9 @@ def _getQueryDict(spec):
     return query_dict
 
 class Database(back_postgresql.Database):
-    def __init__(self, config, journaltag=None):
-        back_postgresql.Database.__init__(self, config, journaltag)
+    def __init__(self, config, journaltag=None, cached_security=None):
+        back_postgresql.Database.__init__(self, config, journaltag,
+            cached_security)
         self.indexer = Indexer(self)
     
     def create_version_2_tables(self):
@@ -314,6 +314,7 @@ class FileStorage:
             # save off the rename action
             self.transactions.append((self.doStoreFile, (classname, nodeid,
                 property)))
+        self.noteChange(classname)
         # always set umask before writing to make sure we have the proper one
         # in multi-tracker (i.e. multi-umask) or modpython scenarios
         # the umask may have changed since last we set it.
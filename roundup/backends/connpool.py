@@ -0,0 +1,217 @@
+'''Pools of database connections kept open by a process across the
+opening and closing of its tracker databases (eg. one per request handled
+by the roundup server), for the backends whose connections are costly to
+open: PostgreSQL and MySQL.
+
+There's a pool per backend and set of connection arguments, see
+get_pool(). The pools may be used by many threads. A process forked from
+one using a pool leaves the connections it inherited alone, as they are
+the parent's.
+'''
+__docformat__ = 'restructuredtext'
+
+import os, time, logging
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
+
+class ConnectionPool:
+    '''Hands out DB-API connections, opening them with "connect()" unless
+    an idle one is available.
+
+    The connections given back with put() are rolled back and kept idle
+    for reuse, at most "max_size" of them. Those idle for more than
+    "idle_timeout" seconds are closed, except for the "min_size" most
+    recently used.
+    '''
+    # the number of seconds a connection may have been idle before it's
+    # checked (with a trivial query) when handed out again
+    check_interval = 60
+
+    def __init__(self, connect, min_size=0, max_size=5, idle_timeout=600):
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        # (time put back, connection), most recently used last
+        self.idle = []
+        # the connections handed out by this process, by id
+        self.used = {}
+        # the connections inherited from the parent process, by id: they
+        # are never used or closed (which would end the parent's session
+        # too)
+        self.orphans = {}
+        self.stats = {'connects': 0, 'reuses': 0, 'discards': 0}
+
+    def _check_pid(self):
+        '''Forget the connections of the parent process if we've been
+        forked. Called with the lock held.
+        '''
+        pid = os.getpid()
+        if pid != self.pid:
+            for stamp, conn in self.idle:
+                self.orphans[id(conn)] = conn
+            self.orphans.update(self.used)
+            self.idle = []
+            self.used = {}
+            self.pid = pid
+
+    def get(self):
+        '''Return an idle connection, or a new one.
+        '''
+        now = time.time()
+        while 1:
+            self.lock.acquire()
+            try:
+                self._check_pid()
+                if self.idle:
+                    stamp, conn = self.idle.pop()
+                else:
+                    conn = None
+            finally:
+                self.lock.release()
+            if conn is None:
+                break
+            if now - stamp < self.check_interval or self.ping(conn):
+                self.lock.acquire()
+                try:
+                    self.used[id(conn)] = conn
+                    self.stats['reuses'] += 1
+                finally:
+                    self.lock.release()
+                return conn
+            self.discard(conn)
+
+        conn = self.connect()
+        self.lock.acquire()
+        try:
+            self.used[id(conn)] = conn
+            self.stats['connects'] += 1
+        finally:
+            self.lock.release()
+        return conn
+
+    def put(self, conn):
+        '''Give back a connection handed out by get(). It's rolled back
+        and kept for reuse if there's room in the pool, or else closed.
+        '''
+        self.lock.acquire()
+        try:
+            self._check_pid()
+            if not self.used.has_key(id(conn)):
+                for stamp, idle in self.idle:
+                    if idle is conn:
+                        # given back twice
+                        return
+                # handed out before we were forked
+                self.orphans[id(conn)] = conn
+                return
+            del self.used[id(conn)]
+        finally:
+            self.lock.release()
+
+        try:
+            conn.rollback()
+        except Exception:
+            self.discard(conn)
+            return
+
+        now = time.time()
+        closing = []
+        self.lock.acquire()
+        try:
+            if len(self.idle) < self.max_size:
+                self.idle.append((now, conn))
+            else:
+                closing.append(conn)
+            # expire the connections idle for too long
+            while (len(self.idle) > self.min_size and
+                    now - self.idle[0][0] > self.idle_timeout):
+                closing.append(self.idle.pop(0)[1])
+        finally:
+            self.lock.release()
+        for conn in closing:
+            self.close(conn)
+
+    def ping(self, conn):
+        '''Determine whether the connection still works.
+        '''
+        try:
+            cursor = conn.cursor()
+            cursor.execute('select 1')
+            cursor.fetchall()
+            conn.rollback()
+        except Exception, message:
+            logging.getLogger('hyperdb').info('pooled connection failed: '
+                '%s'%message)
+            return 0
+        return 1
+
+    def discard(self, conn):
+        '''Close a connection that doesn't work any more.
+        '''
+        self.stats['discards'] += 1
+        self.close(conn)
+
+    def close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            # it's going away anyway
+            pass
+
+    def clear(self):
+        '''Close all the idle connections (eg. before dropping the
+        database).
+        '''
+        self.lock.acquire()
+        try:
+            self._check_pid()
+            idle = self.idle
+            self.idle = []
+        finally:
+            self.lock.release()
+        for stamp, conn in idle:
+            self.close(conn)
+
+# the pools of this process, by backend and connection arguments
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(backend, kwargs, connect, config):
+    '''Return the pool of connections opened with "connect(**kwargs)" for
+    the backend (the name of its module), created with the sizes given
+    by the "rdbms" section of the tracker configuration.
+    '''
+    items = kwargs.items()
+    items.sort()
+    key = (backend, tuple(items))
+    _pools_lock.acquire()
+    try:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(lambda: connect(**kwargs),
+                config.RDBMS_POOL_MIN, config.RDBMS_POOL_SIZE,
+                config.RDBMS_POOL_IDLE_TIMEOUT)
+            _pools[key] = pool
+    finally:
+        _pools_lock.release()
+    return pool
+
+def clear_pools(backend=None):
+    '''Close the idle connections of all the pools, or of those of the
+    backend.
+    '''
+    _pools_lock.acquire()
+    try:
+        pools = _pools.items()
+    finally:
+        _pools_lock.release()
+    for key, pool in pools:
+        if backend is None or key[0] == backend:
+            pool.clear()
+
+# vim: set et sts=4 sw=4 :
@@ -24,6 +24,27 @@ class Indexer:
     def is_stopword(self, word):
         return word in self.stopwords
 
+    def split_text(self, text, mime_type='text/plain'):
+        '''Do the CPU-bound part of add_text(): return the (marshallable)
+        data that add_words() stores for the text.
+
+        This lets "roundup-admin reindex --jobs" split texts in worker
+        processes; by default the text is just passed through.
+        '''
+        return (text, mime_type)
+
+    def add_words(self, identifier, words):
+        '''Store the words returned by split_text() for the identifier.
+        '''
+        text, mime_type = words
+        self.add_text(identifier, text, mime_type)
+
+    def begin_batch(self):
+        '''Hint that many texts are about to be added (and saved with
+        save_index()). Indexers that can store texts in bulk do so.
+        '''
+        pass
+
     def getHits(self, search_terms, klass):
         return self.find(search_terms)
     
@@ -97,3 +118,13 @@ class Indexer:
                             node_dict[linkprop].append(nodeid)
         return nodeids
 
+class TextCollector:
+    '''Stands in for the indexer of a database to collect the texts
+    given to add_text() as (identifier, text, mime_type) in "texts", for
+    "roundup-admin reindex --jobs" to split in its worker processes.
+    '''
+    def __init__(self):
+        self.texts = []
+
+    def add_text(self, identifier, text, mime_type='text/plain'):
+        self.texts.append((identifier, text, mime_type))
@@ -36,14 +36,31 @@ class Indexer(IndexerBase):
           fileids {fileid: identifier}
 
     where identifier is (classname, nodeid, propertyname)
+
+    The structures are saved in segment files, one holding the files and
+    fileids and one per initial character of the words. Rewriting them
+    all costs time proportional to the size of the index, so the changes
+    made since the segments were last written are appended to a log file
+    instead (see save_index) and replayed by load_index. The segments are
+    rewritten ("merged") once the log grows to half of their size.
+
+    Removing an entry only drops it from files and fileids; its stale
+    references in words are ignored by find() and dropped by the next
+    merge.
     '''
+    # don't merge the log into the segments before it reaches this size
+    min_merge_size = 65536
+
     def __init__(self, db):
         IndexerBase.__init__(self, db)
         self.indexdb_path = os.path.join(db.config.DATABASE, 'indexes')
         self.indexdb = os.path.join(self.indexdb_path, 'index.db')
+        self.indexlog = self.indexdb + '.log'
         self.reindex = 0
         self.quiet = 9
         self.changed = 0
+        # the changes not saved yet, as log records
+        self.pending = []
 
         # see if we need to reindex because of a change in code
         version = os.path.join(self.indexdb_path, 'version')
@@ -77,6 +94,16 @@ class Indexer(IndexerBase):
         '''Add some text associated with the (classname, nodeid, property)
         identifier.
         '''
+        self.add_words(identifier, self.split_text(text, mime_type))
+
+    def split_text(self, text, mime_type='text/plain'):
+        '''Split the text into the list of words to index.
+        '''
+        return self.splitter(text, mime_type)
+
+    def add_words(self, identifier, words):
+        '''Add the words returned by split_text() for the identifier.
+        '''
         # make sure the index is loaded
         self.load_index()
 
@@ -84,9 +111,6 @@ class Indexer(IndexerBase):
         if self.files.has_key(identifier):
             self.purge_entry(identifier)
 
-        # split into words
-        words = self.splitter(text, mime_type)
-
         # Find new file index, and assign it to identifier
         # (_TOP uses trick of negative to avoid conflict with file index)
         self.files['_TOP'] = (self.files['_TOP'][0]-1, None)
@@ -118,6 +142,8 @@ class Indexer(IndexerBase):
             entry[file_index] = filedict[word]
 
         # save needed
+        self.pending.append(('add', identifier, file_index, len(words),
+            filedict))
         self.changed = 1
 
     def splitter(self, text, ftype):
@@ -163,9 +189,9 @@ class Indexer(IndexerBase):
             if hits is None:
                 hits = {}
                 for k in entry.keys():
-                    if not self.fileids.has_key(k):
-                        raise ValueError, 'Index is corrupted: re-generate it'
-                    hits[k] = self.fileids[k]
+                    # skip the stale references to removed entries
+                    if self.fileids.has_key(k):
+                        hits[k] = self.fileids[k]
             else:
                 # Eliminate hits for every non-match
                 for fileid in hits.keys():
@@ -217,13 +243,95 @@ class Indexer(IndexerBase):
         self.words = db['WORDS']
         self.files = db['FILES']
         self.fileids = db['FILEIDS']
+
+        # replay the changes saved since the segments were written
+        for record in self.read_log():
+            self.apply_record(record)
+
+        self.pending = []
         self.changed = 0
 
+    def read_log(self):
+        '''Return the records of the log file.
+
+        An incomplete last record (from an interrupted save) is ignored.
+        '''
+        try:
+            f = open(self.indexlog, 'rb')
+        except IOError, error:
+            if error.errno != errno.ENOENT: raise
+            return []
+        records = []
+        try:
+            while 1:
+                try:
+                    records.append(marshal.load(f))
+                except (EOFError, ValueError, TypeError):
+                    break
+        finally:
+            f.close()
+        return records
+
+    def apply_record(self, record):
+        '''Apply a log record to the loaded index.
+        '''
+        if record[0] == 'purge':
+            identifier = record[1]
+            if self.files.has_key(identifier):
+                del self.fileids[self.files[identifier][0]]
+                del self.files[identifier]
+            return
+        action, identifier, file_index, wordcount, filedict = record
+        if self.files['_TOP'][0] > -file_index:
+            self.files['_TOP'] = (-file_index, None)
+        self.files[identifier] = (file_index, wordcount)
+        self.fileids[file_index] = identifier
+        for word, count in filedict.items():
+            self.words.setdefault(word, {})[file_index] = count
+
+    def segments_size(self):
+        '''Return the total size of the segment files.
+        '''
+        size = 0
+        for segment in self.segments:
+            try:
+                size += os.path.getsize(self.indexdb + segment)
+            except OSError, error:
+                if error.errno != errno.ENOENT: raise
+        return size
+
     def save_index(self):
         # only save if the index is loaded and changed
         if not self.index_loaded() or not self.changed:
             return
 
+        # append the changes to the log, unless it's grown big enough to
+        # be worth merging into the segments
+        if not self.reindex:
+            log_str = ''.join([marshal.dumps(r) for r in self.pending])
+            try:
+                log_size = os.path.getsize(self.indexlog)
+            except OSError, error:
+                if error.errno != errno.ENOENT: raise
+                log_size = 0
+            log_size += len(log_str)
+            if log_size < max(self.min_merge_size, self.segments_size()/2):
+                log_fh = open(self.indexlog, 'ab')
+                log_fh.write(log_str)
+                log_fh.close()
+                os.chmod(self.indexlog, 0664)
+                self.pending = []
+                self.changed = 0
+                return
+
+        # drop the references to removed entries
+        for word, entry in self.words.items():
+            for file_index in entry.keys():
+                if not self.fileids.has_key(file_index):
+                    del entry[file_index]
+            if not entry:
+                del self.words[word]
+
         # brutal space saver... delete all the small segments
         for segment in self.segments:
             try:
@@ -252,9 +360,18 @@ class Indexer(IndexerBase):
             filename = self.indexdb + initchar
             pickle_fh = open(filename, 'wb')
             pickle_fh.write(zlib.compress(pickle_str))
+            pickle_fh.close()
             os.chmod(filename, 0664)
 
+        # the segments now hold everything in the log
+        try:
+            os.remove(self.indexlog)
+        except OSError, error:
+            if error.errno != errno.ENOENT: raise
+
         # save done
+        self.pending = []
+        self.reindex = 0
         self.changed = 0
 
     def purge_entry(self, identifier):
@@ -269,12 +386,10 @@ class Indexer(IndexerBase):
         del self.files[identifier]
         del self.fileids[file_index]
 
-        # The much harder part, cleanup the word index
-        for key, occurs in self.words.items():
-            if occurs.has_key(file_index):
-                del occurs[file_index]
+        # the word index still refers to file_index until the next merge
 
         # save needed
+        self.pending.append(('purge', identifier))
         self.changed = 1
 
     def index_loaded(self):
@@ -1,17 +1,23 @@
 #$Id: indexer_rdbms.py,v 1.15 2006/10/04 01:12:00 richard Exp $
 ''' This implements the full-text indexer over two RDBMS tables. The first
-is a mapping of words to occurance IDs. The second maps the IDs to (Class,
+is a mapping of words to occurance IDs, along with the number of times and
+the positions at which the word occurs. The second maps the IDs to (Class,
 propname, itemid) instances.
 '''
 import re, sets
 
-from roundup.backends.indexer_common import Indexer as IndexerBase
+from roundup import hyperdb
+from roundup.backends.indexer_common import Indexer as IndexerBase, _isLink
 
 class Indexer(IndexerBase):
+    # the number of texts to collect before storing a batch
+    batch_size = 1000
+
     def __init__(self, db):
         IndexerBase.__init__(self, db)
         self.db = db
         self.reindex = 0
+        self.batch = None
 
     def close(self):
         '''close the indexing database'''
@@ -20,8 +26,11 @@ class Indexer(IndexerBase):
 
     def save_index(self):
         '''Save the changes to the index.'''
-        # not necessary - the RDBMS connection will handle this for us
-        pass
+        # the RDBMS connection will handle this for us, but for a pending
+        # batch of words
+        if self.batch is not None:
+            self.store_batch()
+            self.batch = None
 
     def force_reindex(self):
         '''Force a reindexing of the database.  This essentially
@@ -35,7 +44,30 @@ class Indexer(IndexerBase):
 
     def add_text(self, identifier, text, mime_type='text/plain'):
         ''' "identifier" is  (classname, itemid, property) '''
+        self.add_words(identifier, self.split_text(text, mime_type))
+
+    def split_text(self, text, mime_type='text/plain'):
+        '''Return {word: (count, positions)} for the unique words of the
+        text, or None if the text isn't indexed.
+        '''
         if mime_type != 'text/plain':
+            return None
+
+        # ok, find the positions of all the unique words in the text
+        words = {}
+        position = 0
+        for word in self.text_splitter(text):
+            if not self.is_stopword(word):
+                words.setdefault(word, []).append(str(position))
+            position += 1
+        for word, positions in words.items():
+            words[word] = (len(positions), ' '.join(positions))
+        return words
+
+    def add_words(self, identifier, words):
+        '''Store the words returned by split_text().
+        '''
+        if words is None:
             return
 
         # first, find the id of the (classname, itemid, property)
@@ -50,26 +82,78 @@ class Indexer(IndexerBase):
             sql = 'insert into __textids (_textid, _class, _itemid, _prop)'\
                 ' values (%s, %s, %s, %s)'%(a, a, a, a)
             self.db.cursor.execute(sql, (id, ) + identifier)
+            old = {}
+        elif self.batch is not None:
+            # the old entries are deleted when the batch is stored
+            id = int(r[0])
+            self.batch_replaced.append(id)
+            old = {}
         else:
             id = int(r[0])
-            # clear out any existing indexed values
-            sql = 'delete from __words where _textid=%s'%a
+            # only change the entries of the words that changed
+            sql = 'select _word, _count, _positions from __words '\
+                'where _textid=%s'%a
             self.db.cursor.execute(sql, (id, ))
+            old = {}
+            for row in self.db.cursor.fetchall():
+                old[row[0]] = (row[1], row[2])
+            removed = [(id, word) for word in old.keys()
+                if not words.has_key(word)]
+            if removed:
+                sql = 'delete from __words where _textid=%s and _word=%s'%(
+                    a, a)
+                self.db.cursor.executemany(sql, removed)
+            changed = [(count, positions, id, word)
+                for word, (count, positions) in words.items()
+                if old.has_key(word) and old[word] != (count, positions)]
+            if changed:
+                sql = 'update __words set _count=%s, _positions=%s '\
+                    'where _textid=%s and _word=%s'%(a, a, a, a)
+                self.db.cursor.executemany(sql, changed)
+
+        # add an entry in the db for each new word
+        rows = [(word, id, count, positions)
+            for word, (count, positions) in words.items()
+            if not old.has_key(word)]
+        if self.batch is not None:
+            self.batch.extend(rows)
+            self.batch_texts += 1
+            if self.batch_texts >= self.batch_size:
+                self.store_batch()
+        elif rows:
+            self.db.sql_insert_rows('__words',
+                ('_word', '_textid', '_count', '_positions'), rows)
+
+    def begin_batch(self):
+        '''Collect the words of the texts added until the next
+        save_index() (or every "batch_size" texts) and store them in
+        bulk.
+        '''
+        self.batch = []
+        self.batch_replaced = []
+        self.batch_texts = 0
 
-        # ok, find all the unique words in the text
+    def store_batch(self):
+        '''Store the words collected since begin_batch().
+        '''
+        a = self.db.arg
+        max_args = self.db.max_in_args
+        replaced = self.batch_replaced
+        for i in range(0, len(replaced), max_args):
+            chunk = replaced[i:i+max_args]
+            sql = 'delete from __words where _textid in (%s)'%(
+                ','.join([a] * len(chunk)))
+            self.db.cursor.execute(sql, tuple(chunk))
+        self.db.sql_insert_rows('__words',
+            ('_word', '_textid', '_count', '_positions'), self.batch)
+        self.begin_batch()
+
+    def text_splitter(self, text):
+        '''Split the text into the list of (upper-case) words to index.
+        '''
         text = unicode(text, "utf-8", "replace").upper()
-        wordlist = [w.encode("utf-8", "replace")
+        return [w.encode("utf-8", "replace")
                 for w in re.findall(r'(?u)\b\w{2,25}\b', text)]
-        words = sets.Set()
-        for word in wordlist:
-            if self.is_stopword(word): continue
-            if len(word) > 25: continue
-            words.add(word)
-
-        # for each word, add an entry in the db
-        sql = 'insert into __words (_word, _textid) values (%s, %s)'%(a, a)
-        words = [(word, id) for word in words]
-        self.db.cursor.executemany(sql, words)
 
     def find(self, wordlist):
         '''look up all the words in the wordlist.
@@ -130,3 +214,146 @@ class Indexer(IndexerBase):
 
         return self.db.cursor.fetchall()
 
+    def _matching_sql(self, words, columns):
+        '''Return the SQL selecting "columns" of the texts containing
+        all of the (distinct) words, and its arguments.
+        '''
+        a = ','.join([self.db.arg] * len(words))
+        sql = 'select %s from __words, __textids '\
+            'where __words._textid=__textids._textid and _word in (%s) '\
+            'group by __textids._textid, _class, _itemid, _prop '\
+            'having count(*)=%d'%(columns, a, len(words))
+        return sql, tuple(words)
+
+    def rank(self, wordlist, limit=None):
+        '''Look up the texts containing all the words in the wordlist,
+        best matches first.
+
+        Returns a list of (classname, itemid, property, score) where the
+        score is the number of occurances of the words in the text. If
+        "limit" is given only that many entries are returned. The whole
+        search and ranking is done in one SQL statement.
+        '''
+        words = {}
+        for word in wordlist:
+            if 26 > len(word) > 2:
+                words[word.upper()] = 1
+        if not words:
+            return []
+        sql, args = self._matching_sql(words.keys(),
+            '_class, _itemid, _prop, sum(_count)')
+        sql += ' order by 4 desc, _class, _itemid, _prop'
+        if limit is not None:
+            sql += ' limit %d'%limit
+        self.db.cursor.execute(sql, args)
+        return [(row[0], row[1], row[2], int(row[3]))
+            for row in self.db.cursor.fetchall()]
+
+    def find_phrase(self, phrase):
+        '''Look up the texts containing the words of the phrase (a
+        string) next to each other, in order.
+
+        Returns a list of (classname, itemid, property) like find().
+        '''
+        # the offsets of the indexed words in the phrase
+        offsets = []
+        position = 0
+        for word in self.text_splitter(phrase):
+            if not self.is_stopword(word):
+                offsets.append((position, word))
+            position += 1
+        if not offsets:
+            return []
+        words = {}
+        for offset, word in offsets:
+            words[word] = 1
+        words = words.keys()
+
+        # first find the texts with all the words, then check positions
+        sql, args = self._matching_sql(words, '__textids._textid')
+        self.db.cursor.execute(sql, args)
+        textids = [int(row[0]) for row in self.db.cursor.fetchall()]
+        found = []
+        a = self.db.arg
+        max_args = self.db.max_in_args
+        for i in range(0, len(textids), max_args):
+            chunk = textids[i:i+max_args]
+            sql = 'select _textid, _word, _positions from __words '\
+                'where _word in (%s) and _textid in (%s)'%(
+                ','.join([a] * len(words)), ','.join([a] * len(chunk)))
+            self.db.cursor.execute(sql, tuple(words) + tuple(chunk))
+            positions = {}
+            for row in self.db.cursor.fetchall():
+                d = positions.setdefault(int(row[0]), {})
+                d[row[1]] = dict([(int(n), 1) for n in row[2].split()])
+            for textid, d in positions.items():
+                start, first = offsets[0]
+                for p in d[first].keys():
+                    for offset, word in offsets[1:]:
+                        if not d[word].has_key(p + offset - start):
+                            break
+                    else:
+                        found.append(textid)
+                        break
+
+        result = []
+        for i in range(0, len(found), max_args):
+            chunk = found[i:i+max_args]
+            sql = 'select _class, _itemid, _prop from __textids '\
+                'where _textid in (%s)'%','.join([a] * len(chunk))
+            self.db.cursor.execute(sql, tuple(chunk))
+            result.extend(self.db.cursor.fetchall())
+        return result
+
+    def search(self, search_terms, klass, ignore={}):
+        '''Display search results looking for [search, terms] associated
+        with the hyperdb Class "klass". Ignore hits on {class: property}.
+
+        The hits on linked classes are mapped back to the items of
+        "klass" with one query per Link or Multilink property (and batch
+        of hits) rather than with klass.find() and klass.get().
+        '''
+        hits = self.getHits(search_terms, klass)
+        if not hits:
+            return {}
+
+        designator_propname = {}
+        for nm, propclass in klass.getprops().items():
+            if _isLink(propclass):
+                designator_propname.setdefault(propclass.classname,
+                    []).append(nm)
+
+        nodeids = {}      # this is the answer
+        linked = {}       # {classname: [ids of hit items]}
+        for entry in hits:
+            # skip this result if we don't care about this class/property
+            classname = entry[0]
+            if ignore.has_key((classname, entry[2])):
+                continue
+            nodeid = entry[1]
+            if classname == klass.classname:
+                nodeids.setdefault(nodeid, {})
+            elif designator_propname.has_key(classname):
+                linked.setdefault(classname, {})[int(nodeid)] = 1
+
+        a = self.db.arg
+        max_args = self.db.max_in_args
+        cn = klass.classname
+        for classname, ids in linked.items():
+            ids = ids.keys()
+            for propname in designator_propname[classname]:
+                if isinstance(klass.getprops()[propname], hyperdb.Multilink):
+                    sql = 'select m.nodeid, m.linkid from %s_%s as m, _%s '\
+                        'where _%s.id=m.nodeid and _%s.__retired__=0 and '\
+                        'm.linkid in (%%s)'%(cn, propname, cn, cn, cn)
+                else:
+                    sql = 'select id, _%s from _%s where __retired__=0 '\
+                        'and _%s in (%%s)'%(propname, cn, propname)
+                for i in range(0, len(ids), max_args):
+                    chunk = ids[i:i+max_args]
+                    self.db.cursor.execute(sql%','.join([a] * len(chunk)),
+                        tuple(chunk))
+                    for row in self.db.cursor.fetchall():
+                        node_dict = nodeids.setdefault(str(row[0]), {})
+                        node_dict.setdefault(propname, []).append(str(row[1]))
+        return nodeids
@@ -53,13 +53,13 @@ the same name.
 __docformat__ = 'restructuredtext'
 
 # standard python modules
-import sys, os, time, re, errno, weakref, copy, logging
+import sys, os, time, re, errno, weakref, copy, logging, marshal, base64
 
 # roundup modules
 from roundup import hyperdb, date, password, roundupdb, security, support
 from roundup.hyperdb import String, Password, Date, Interval, Link, \
     Multilink, DatabaseError, Boolean, Number, Node
-from roundup.backends import locking
+from roundup.backends import locking, connpool
 from roundup.support import reversed
 from roundup.i18n import _
 
@@ -72,9 +72,6 @@ except ImportError:
 from sessions_rdbms import Sessions, OneTimeKeys
 from roundup.date import Range
 
-# number of rows to keep in memory
-ROW_CACHE_SIZE = 100
-
 # dummy value meaning "argument not passed"
 _marker = []
 
@@ -91,6 +88,100 @@ def _bool_cvt(value):
     # assume it's a number returned from the db API
     return int(value)
 
+def _interval_seconds(value):
+    return value.as_seconds()
+
+class RowCodec:
+    """ The columns of a class table, the SQL to read and write its rows
+        and the conversions between rows and node values for each column.
+
+        These are figured once per class, see Database.row_codec().
+    """
+    def __init__(self, db, cl):
+        cn = cl.classname
+        self.cols, self.mls = db.determine_columns(cl.properties.items())
+        self.props = props = cl.getprops(protected=1)
+        a = db.arg
+
+        self.scols = ','.join([col for col,dt in self.cols])
+        self.select_sql = 'select %s from _%s where id=%s'%(self.scols, cn, a)
+        self.insert_sql = 'insert into _%s (%s,id) values (%s)'%(cn,
+            self.scols, ','.join([a] * (len(self.cols) + 1)))
+
+        # for each column, (property name, converter) from the SQL value
+        # (None for the special Interval-as-seconds columns) and to it
+        self.from_sql = []
+        self.to_sql = []
+        for col, dt in self.cols:
+            if col.endswith('_int__'):
+                self.from_sql.append(None)
+                self.to_sql.append((col[2:-6], _interval_seconds))
+                continue
+            name = col[1:]
+            klass = props[name].__class__
+            self.from_sql.append((name, db.sql_to_hyperdb_value[klass]))
+            self.to_sql.append((name, db.hyperdb_to_sql_value[klass]))
+
+        # and the converter to SQL of each property, by name
+        self.to_sql_value = {}
+        for name, prop in props.items():
+            if not isinstance(prop, Multilink) and name != 'id':
+                self.to_sql_value[name] = db.hyperdb_to_sql_value[
+                    prop.__class__]
+
+        # the converters of the journalled values that aren't journalled
+        # as they are
+        self.journal_to_sql = {}
+        self.journal_from_sql = {}
+        for name, prop in props.items():
+            for klass in (Password, Date, Interval, Boolean):
+                if isinstance(prop, klass):
+                    self.journal_to_sql[name] = db.hyperdb_to_sql_value[
+                        prop.__class__]
+                    self.journal_from_sql[name] = db.sql_to_hyperdb_value[
+                        prop.__class__]
+
+        # the multilink tables and the SQL to use them
+        self.ml_tables = {}
+        self.ml_select_sql = {}
+        self.ml_insert_sql = {}
+        self.ml_delete_sql = {}
+        for col in self.mls:
+            t = '%s_%s'%(cn, col)
+            self.ml_tables[col] = t
+            self.ml_select_sql[col] = 'select linkid from %s where ' \
+                'nodeid=%s'%(t, a)
+            self.ml_insert_sql[col] = 'insert into %s (nodeid, linkid) ' \
+                'values (%s,%s)'%(t, a, a)
+            self.ml_delete_sql[col] = 'delete from %s where nodeid=%s ' \
+                'and linkid=%s'%(t, a, a)
+
+    def row_to_node(self, values):
+        """ Convert a row with our columns into a node dict.
+        """
+        node = {}
+        col = 0
+        for cvt in self.from_sql:
+            if cvt is not None:
+                name, cvt = cvt
+                value = values[col]
+                if value is not None:
+                    value = cvt(value)
+                node[name] = value
+            col += 1
+        return node
+
+    def node_to_row(self, node):
+        """ Convert the node dict into the values of our columns.
+        """
+        row = []
+        for name, cvt in self.to_sql:
+            value = node[name]
+            if value is not None:
+                value = cvt(value)
+            row.append(value)
+        return row
+
 def connection_dict(config, dbnamestr=None):
     """ Used by Postgresql and MySQL to detemine the keyword args for
     opening the database connection."""
@@ -109,27 +200,44 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
 
         - some functionality is specific to the actual SQL database, hence
           the sql_* methods that are NotImplemented
-        - we keep a cache of the latest ROW_CACHE_SIZE row fetches.
+        - we keep a cache of the latest RDBMS_CACHE_SIZE row fetches.
     """
-    def __init__(self, config, journaltag=None):
+    def __init__(self, config, journaltag=None, cached_security=None):
         """ Open the database and load the schema from it.
+
+            If 'cached_security' is given, the database uses a copy of
+            it instead of setting up a new Security.
         """
         FileStorage.__init__(self, config.UMASK)
         self.config, self.journaltag = config, journaltag
         self.dir = config.DATABASE
         self.classes = {}
         self.indexer = Indexer(self)
-        self.security = security.Security(self)
+        if cached_security is None:
+            self.security = security.Security(self)
+        else:
+            self.security = cached_security.bind(self)
 
         # additional transaction support for external files and the like
         self.transactions = []
 
+        # the classes changed by the transaction and their change stamps,
+        # see roundupdb.Database.getChangeStamp()
+        self.changed_classes = {}
+        self.change_stamps = {}
+
+        # the session and one-time-key stores, see getSessionManager()
+        self.session_manager = None
+        self.otk_manager = None
+
         # keep a cache of the N most recently retrieved rows of any kind
         # (classname, nodeid) = row
-        self.cache = {}
-        self.cache_lru = []
-        self.stats = {'cache_hits': 0, 'cache_misses': 0, 'get_items': 0,
-            'filtering': 0}
+        self.cache = support.LRUCache(config.RDBMS_CACHE_SIZE)
+        self.stats = {'cache_hits': 0, 'cache_misses': 0,
+            'cache_evictions': 0, 'get_items': 0, 'filtering': 0}
+
+        # the RowCodec of each class, see row_codec()
+        self.row_codecs = {}
 
         # database lock
         self.lockfile = None
@@ -138,14 +246,37 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         self.open_connection()
 
     def clearCache(self):
-        self.cache = {}
-        self.cache_lru = []
+        self.cache.clear()
+
+    def row_codec(self, classname):
+        """ Return the RowCodec of the class, figuring it the first time.
+
+            The codecs are discarded when the schema changes (in
+            post_init() and Class.addprop()).
+        """
+        codec = self.row_codecs.get(classname)
+        if codec is None:
+            codec = RowCodec(self, self.classes[classname])
+            self.row_codecs[classname] = codec
+        return codec
+
+    session_class = Sessions
+    otk_class = OneTimeKeys
 
     def getSessionManager(self):
-        return Sessions(self)
+        if self.session_manager is None:
+            self.session_manager = self.session_class(self)
+        return self.session_manager
 
     def getOTKManager(self):
-        return OneTimeKeys(self)
+        if self.otk_manager is None:
+            self.otk_manager = self.otk_class(self)
+        return self.otk_manager
+
+    def sessionStores(self):
+        """ Return the session and one-time-key stores in use.
+        """
+        return filter(None, [self.session_manager, self.otk_manager])
 
     def open_connection(self):
         """ Open a connection to the database, creating it if necessary.
@@ -154,6 +285,19 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         """
         raise NotImplemented
 
+    # the connpool.ConnectionPool that self.conn was taken from, if any
+    connection_pool = None
+
+    def sql_pool(self, kwargs, connect):
+        """ Return the connpool.ConnectionPool of this process for the
+            connections opened with connect(**kwargs), or None if the
+            "pool_size" configuration disables pooling.
+        """
+        if not self.config.RDBMS_POOL_SIZE:
+            return None
+        return connpool.get_pool(self.__class__.__module__, kwargs, connect,
+            self.config)
+
     def sql(self, sql, args=None):
         """ Execute the sql with the optional args.
         """
@@ -164,6 +308,23 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         else:
             self.cursor.execute(sql)
 
+    def sql_insert_rows(self, table, columns, rows):
+        """ Insert the rows (sequences of values for the columns) into the
+            table, with as many rows per INSERT statement as the
+            "max_in_args" limit on arguments allows.
+        """
+        a = self.arg
+        row_sql = '(%s)'%','.join([a] * len(columns))
+        count = max(1, self.max_in_args / len(columns))
+        for i in range(0, len(rows), count):
+            chunk = rows[i:i+count]
+            sql = 'insert into %s (%s) values %s'%(table, ','.join(columns),
+                ','.join([row_sql] * len(chunk)))
+            args = []
+            for row in chunk:
+                args.extend(row)
+            self.sql(sql, tuple(args))
+
     def sql_fetchone(self):
         """ Fetch a single row. If there's nothing to fetch, return None.
         """
@@ -209,6 +370,7 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
             attribute actually matches the schema in the database.
         """
         save = 0
+        self.row_codecs.clear()
 
         # handle changes in the schema
         tables = self.database_schema['tables']
@@ -246,7 +408,7 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
 
     # update this number when we need to make changes to the SQL structure
     # of the backen database
-    current_db_version = 5
+    current_db_version = 8
     db_version_updated = False
     def upgrade_db(self):
         """ Update the SQL database to reflect changes in the backend code.
@@ -283,6 +445,15 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         if version < 5:
             self.fix_version_4_tables()
 
+        if version < 6:
+            self.fix_version_5_tables()
+
+        if version < 7:
+            self.fix_version_6_tables()
+
+        if version < 8:
+            self.fix_version_7_tables()
+
         self.database_schema['version'] = self.current_db_version
         self.db_version_updated = True
         return 1
@@ -310,6 +481,49 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
             if klass.key:
                 self.add_class_key_required_unique_constraint(cn, klass.key)
 
+    def fix_version_5_tables(self):
+        # the full-text index now records the count and positions of each
+        # word in a text: recreate it and reindex
+        self.sql('DROP TABLE __words')
+        self.create_words_table()
+        self.indexer.force_reindex()
+
+    def fix_version_6_tables(self):
+        # journal params are now encoded with journal_encode() instead of
+        # repr(): re-encode the existing entries (journal_decode() still
+        # reads the old ones, should any be added by older code)
+        cols = 'nodeid date tag action params'.split()
+        for cn in self.classes.keys():
+            self.sql('select %s from %s__journal'%(','.join(cols), cn))
+            rows = []
+            for row in self.sql_fetchall():
+                params = row[4]
+                if params.startswith(self.journal_prefix):
+                    continue
+                params = self._journal_encode(self._journal_eval(params))
+                rows.append((row[0], row[1], row[2], row[3], params))
+            if not rows:
+                continue
+            if __debug__:
+                logging.getLogger('hyperdb').info('re-encoding %d journal '
+                    'entries of %s'%(len(rows), cn))
+            self.sql("delete from %s__journal where params not like '%s%%'"%(
+                cn, self.journal_prefix))
+            self.sql_insert_rows('%s__journal'%cn, cols, rows)
+
+    def fix_version_7_tables(self):
+        # index the session and OTK times, for clean() (the values are
+        # now encoded with sessions_rdbms.encode_value() instead of repr(),
+        # but the old ones are still read)
+        self.create_session_time_indexes()
+
+    def create_session_time_indexes(self):
+        for name in ('otk', 'session'):
+            index_name = '%ss_time_idx'%name
+            if not self.sql_index_exists('%ss'%name, index_name):
+                self.sql('CREATE INDEX %s ON %ss(%s_time)'%(index_name, name,
+                    name))
+
     def _convert_journal_tables(self):
         """Get current journal table contents, drop the table and re-create"""
         c = self.cursor
@@ -369,6 +583,8 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
             classes = [self.getclass(classname)]
         else:
             classes = self.classes.values()
+        # let the indexer store the texts in bulk
+        self.indexer.begin_batch()
         for klass in classes:
             if show_progress:
                 for nodeid in support.Progress('Reindex %s'%klass.classname,
@@ -776,9 +992,8 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
             logging.getLogger('hyperdb').debug('addnode %s%s %r'%(classname,
                 nodeid, node))
 
-        # determine the column definitions and multilink tables
-        cl = self.classes[classname]
-        cols, mls = self.determine_columns(cl.properties.items())
+        # the column definitions and multilink tables
+        codec = self.row_codec(classname)
 
         # we'll be supplied these props if we're doing an import
         values = node.copy()
@@ -788,61 +1003,28 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
             values['creation'] = values['activity'] = date.Date()
             values['actor'] = values['creator'] = self.getuid()
 
-        cl = self.classes[classname]
-        props = cl.getprops(protected=1)
-        del props['id']
-
         # default the non-multilink columns
-        for col, prop in props.items():
-            if not values.has_key(col):
+        for col, prop in codec.props.items():
+            if not values.has_key(col) and col != 'id':
                 if isinstance(prop, Multilink):
                     values[col] = []
                 else:
                     values[col] = None
 
         # clear this node out of the cache if it's in there
-        key = (classname, nodeid)
-        if self.cache.has_key(key):
-            del self.cache[key]
-            self.cache_lru.remove(key)
-
-        # figure the values to insert
-        vals = []
-        for col,dt in cols:
-            # this is somewhat dodgy....
-            if col.endswith('_int__'):
-                # XXX eugh, this test suxxors
-                value = values[col[2:-6]]
-                # this is an Interval special "int" column
-                if value is not None:
-                    vals.append(value.as_seconds())
-                else:
-                    vals.append(value)
-                continue
-
-            prop = props[col[1:]]
-            value = values[col[1:]]
-            if value is not None:
-                value = self.hyperdb_to_sql_value[prop.__class__](value)
-            vals.append(value)
-        vals.append(nodeid)
-        vals = tuple(vals)
-
-        # make sure the ordering is correct for column name -> column value
-        s = ','.join([self.arg for x in cols]) + ',%s'%self.arg
-        cols = ','.join([col for col,dt in cols]) + ',id'
+        self.cache.pop((classname, nodeid))
+        self.noteChange(classname)
 
         # perform the inserts
-        sql = 'insert into _%s (%s) values (%s)'%(classname, cols, s)
-        self.sql(sql, vals)
+        vals = codec.node_to_row(values)
+        vals.append(nodeid)
+        self.sql(codec.insert_sql, tuple(vals))
 
         # insert the multilink rows
-        for col in mls:
-            t = '%s_%s'%(classname, col)
+        for col in codec.mls:
+            sql = codec.ml_insert_sql[col]
             for entry in node[col]:
-                sql = 'insert into %s (linkid, nodeid) values (%s,%s)'%(t,
-                    self.arg, self.arg)
-                self.sql(sql, (entry, nodeid))
+                self.sql(sql, (nodeid, entry))
 
     def setnode(self, classname, nodeid, values, multilink_changes={}):
         """ Change the specified node.
@@ -852,13 +1034,11 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
                 % (classname, nodeid, values))
 
         # clear this node out of the cache if it's in there
-        key = (classname, nodeid)
-        if self.cache.has_key(key):
-            del self.cache[key]
-            self.cache_lru.remove(key)
+        self.cache.pop((classname, nodeid))
+        self.noteChange(classname)
 
-        cl = self.classes[classname]
-        props = cl.getprops()
+        codec = self.row_codec(classname)
+        props = codec.props
 
         cols = []
         mls = []
@@ -883,19 +1063,17 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
                 # XXX eugh, this test suxxors
                 # Intervals store the seconds value too
                 col = col[1:-6]
-                prop = props[col]
                 value = values[col]
                 if value is None:
                     vals.append(None)
                 else:
                     vals.append(value.as_seconds())
             else:
-                prop = props[col]
                 value = values[col]
                 if value is None:
                     e = None
                 else:
-                    e = self.hyperdb_to_sql_value[prop.__class__](value)
+                    e = codec.to_sql_value[col](value)
                 vals.append(e)
 
         vals.append(int(nodeid))
@@ -914,10 +1092,7 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         # we're probably coming from an import, not a change
         if not multilink_changes:
             for name in mls:
-                prop = props[name]
-                value = values[name]
-
-                t = '%s_%s'%(classname, name)
+                t = codec.ml_tables[name]
 
                 # clear out previous values for this node
                 # XXX numeric ids
@@ -925,24 +1100,20 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
                         (nodeid,))
 
                 # insert the values for this node
+                sql = codec.ml_insert_sql[name]
                 for entry in values[name]:
-                    sql = 'insert into %s (linkid, nodeid) values (%s,%s)'%(t,
-                        self.arg, self.arg)
                     # XXX numeric ids
-                    self.sql(sql, (entry, nodeid))
+                    self.sql(sql, (nodeid, entry))
 
         # we have multilink changes to apply
         for col, (add, remove) in multilink_changes.items():
-            tn = '%s_%s'%(classname, col)
             if add:
-                sql = 'insert into %s (nodeid, linkid) values (%s,%s)'%(tn,
-                    self.arg, self.arg)
+                sql = codec.ml_insert_sql[col]
                 for addid in add:
                     # XXX numeric ids
                     self.sql(sql, (int(nodeid), int(addid)))
             if remove:
-                sql = 'delete from %s where nodeid=%s and linkid=%s'%(tn,
-                    self.arg, self.arg)
+                sql = codec.ml_delete_sql[col]
                 for removeid in remove:
                     # XXX numeric ids
                     self.sql(sql, (int(nodeid), int(removeid)))
@@ -961,74 +1132,128 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
     def getnode(self, classname, nodeid):
         """ Get a node from the database.
         """
-        # see if we have this node cached
+        # see if we have this node cached (this pushes it back to the
+        # top of the LRU)
         key = (classname, nodeid)
-        if self.cache.has_key(key):
-            # push us back to the top of the LRU
-            self.cache_lru.remove(key)
-            self.cache_lru.insert(0, key)
+        node = self.cache.get(key)
+        if node is not None:
             if __debug__:
                 self.stats['cache_hits'] += 1
             # return the cached information
-            return self.cache[key]
+            return node
 
         if __debug__:
             self.stats['cache_misses'] += 1
             start_t = time.time()
 
-        # figure the columns we're fetching
-        cl = self.classes[classname]
-        cols, mls = self.determine_columns(cl.properties.items())
-        scols = ','.join([col for col,dt in cols])
-
         # perform the basic property fetch
-        sql = 'select %s from _%s where id=%s'%(scols, classname, self.arg)
-        self.sql(sql, (nodeid,))
+        codec = self.row_codec(classname)
+        self.sql(codec.select_sql, (nodeid,))
 
         values = self.sql_fetchone()
         if values is None:
             raise IndexError, 'no such %s node %s'%(classname, nodeid)
 
         # make up the node
-        node = {}
-        props = cl.getprops(protected=1)
-        for col in range(len(cols)):
-            name = cols[col][0][1:]
-            if name.endswith('_int__'):
-                # XXX eugh, this test suxxors
-                # ignore the special Interval-as-seconds column
-                continue
-            value = values[col]
-            if value is not None:
-                value = self.sql_to_hyperdb_value[props[name].__class__](value)
-            node[name] = value
-
+        node = codec.row_to_node(values)
 
         # now the multilinks
-        for col in mls:
+        for col in codec.mls:
             # get the link ids
-            sql = 'select linkid from %s_%s where nodeid=%s'%(classname, col,
-                self.arg)
-            self.cursor.execute(sql, (nodeid,))
+            self.cursor.execute(codec.ml_select_sql[col], (nodeid,))
             # extract the first column from the result
             # XXX numeric ids
             items = [int(x[0]) for x in self.cursor.fetchall()]
             items.sort ()
             node[col] = [str(x) for x in items]
 
-        # save off in the cache
-        key = (classname, nodeid)
+        # save off in the cache, possibly evicting the least recently
+        # used row
         self.cache[key] = node
-        # update the LRU
-        self.cache_lru.insert(0, key)
-        if len(self.cache_lru) > ROW_CACHE_SIZE:
-            del self.cache[self.cache_lru.pop()]
 
         if __debug__:
+            self.stats['cache_evictions'] = self.cache.evictions
             self.stats['get_items'] += (time.time() - start_t)
 
         return node
 
+    # maximum number of ids passed in one "where id in (...)" clause
+    max_in_args = 500
+    def getnodes(self, classname, nodeids):
+        """ Get many nodes from the database at once.
+
+            Returns a dict mapping nodeid to node. Nodes that aren't
+            cached are loaded with one query for the class table plus
+            one query per multilink table for each chunk of
+            "max_in_args" ids, and are then added to the row cache.
+            Ids that don't exist in the database are ignored.
+        """
+        result = {}
+        todo = []
+        seen = {}
+        for nodeid in nodeids:
+            if seen.has_key(nodeid):
+                continue
+            seen[nodeid] = 1
+            node = self.cache.get((classname, nodeid))
+            if node is not None:
+                if __debug__:
+                    self.stats['cache_hits'] += 1
+                result[nodeid] = node
+            else:
+                todo.append(nodeid)
+        if not todo:
+            return result
+
+        if __debug__:
+            self.stats['cache_misses'] += len(todo)
+            start_t = time.time()
+
+        # figure the columns we're fetching
+        codec = self.row_codec(classname)
+        ncols = len(codec.cols)
+
+        for i in range(0, len(todo), self.max_in_args):
+            chunk = todo[i:i+self.max_in_args]
+            args = ','.join([self.arg] * len(chunk))
+
+            # perform the basic property fetch
+            sql = 'select %s,id from _%s where id in (%s)'%(codec.scols,
+                classname, args)
+            self.sql(sql, tuple(chunk))
+            nodes = {}
+            for values in self.sql_fetchall():
+                # XXX numeric ids
+                nodes[str(values[ncols])] = codec.row_to_node(values)
+
+            # now the multilinks, one query per multilink table
+            for col in codec.mls:
+                links = {}
+                for nodeid in nodes.keys():
+                    links[nodeid] = []
+                sql = 'select nodeid,linkid from %s where nodeid in (%s)'%(
+                    codec.ml_tables[col], args)
+                self.sql(sql, tuple(chunk))
+                for nodeid, linkid in self.sql_fetchall():
+                    # XXX numeric ids
+                    l = links.get(str(nodeid))
+                    if l is not None:
+                        l.append(int(linkid))
+                for nodeid, items in links.items():
+                    items.sort()
+                    nodes[nodeid][col] = [str(x) for x in items]
+
+            # save off in the cache
+            for nodeid, node in nodes.items():
+                self.cache[(classname, nodeid)] = node
+            result.update(nodes)
+
+        if __debug__:
+            self.stats['cache_evictions'] = self.cache.evictions
+            self.stats['get_items'] += (time.time() - start_t)
+
+        return result
+
     def destroynode(self, classname, nodeid):
         """Remove a node from the database. Called exclusively by the
            destroy() method on Class.
@@ -1040,8 +1265,8 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
             raise IndexError, '%s has no node %s'%(classname, nodeid)
 
         # see if we have this node cached
-        if self.cache.has_key((classname, nodeid)):
-            del self.cache[(classname, nodeid)]
+        self.cache.pop((classname, nodeid))
+        self.noteChange(classname)
 
         # see if there's any obvious commit actions that we should get rid of
         for entry in self.transactions[:]:
@@ -1053,11 +1278,11 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         self.sql(sql, (nodeid,))
 
         # remove from multilnks
-        cl = self.getclass(classname)
-        x, mls = self.determine_columns(cl.properties.items())
-        for col in mls:
+        codec = self.row_codec(classname)
+        for col in codec.mls:
             # get the link ids
-            sql = 'delete from %s_%s where nodeid=%s'%(classname, col, self.arg)
+            sql = 'delete from %s where nodeid=%s'%(codec.ml_tables[col],
+                self.arg)
             self.sql(sql, (nodeid,))
 
         # remove journal entries
@@ -1108,20 +1333,19 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
             logging.getLogger('hyperdb').debug('addjournal %s%s %r %s %s %r'%(classname,
                 nodeid, journaldate, journaltag, action, params))
 
-        # make the journalled data marshallable
-        if isinstance(params, type({})):
-            self._journal_marshal(params, classname)
-
-        params = repr(params)
+        params = self.journal_encode(classname, params)
 
         dc = self.hyperdb_to_sql_value[hyperdb.Date]
         journaldate = dc(journaldate)
 
         self.save_journal(classname, cols, nodeid, journaldate,
             journaltag, action, params)
+        self.noteChange(classname)
 
     def setjournal(self, classname, nodeid, journal):
         """Set the journal to the "journal" list."""
+        self.noteChange(classname)
+
         # clear out any existing entries
         self.sql('delete from %s__journal where nodeid=%s'%(classname,
             self.arg), (nodeid,))
@@ -1136,31 +1360,54 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
                     classname, nodeid, journaldate, journaltag, action,
                     params))
 
-            # make the journalled data marshallable
-            if isinstance(params, type({})):
-                self._journal_marshal(params, classname)
-            params = repr(params)
+            params = self.journal_encode(classname, params)
 
             self.save_journal(classname, cols, nodeid, dc(journaldate),
                 journaltag, action, params)
 
     def _journal_marshal(self, params, classname):
-        """Convert the journal params values into safely repr'able and
-        eval'able values."""
-        properties = self.getclass(classname).getprops()
+        """Convert the journal params values into marshallable values."""
+        cvts = self.row_codec(classname).journal_to_sql
         for param, value in params.items():
-            if not value:
-                continue
-            property = properties[param]
-            cvt = self.hyperdb_to_sql_value[property.__class__]
-            if isinstance(property, Password):
-                params[param] = cvt(value)
-            elif isinstance(property, Date):
-                params[param] = cvt(value)
-            elif isinstance(property, Interval):
-                params[param] = cvt(value)
-            elif isinstance(property, Boolean):
-                params[param] = cvt(value)
+            if value and cvts.has_key(param):
+                params[param] = cvts[param](value)
+
+    # the params column holds the marshalled params, base64-encoded (to
+    # keep the column text) after this prefix; before version 7 of the
+    # database they were repr()s
+    journal_prefix = 'M:'
+
+    def journal_encode(self, classname, params):
+        """Encode the params of a journal entry for the params column."""
+        # make the journalled data marshallable
+        if isinstance(params, type({})):
+            self._journal_marshal(params, classname)
+        return self._journal_encode(params)
+
+    def _journal_encode(self, params):
+        return self.journal_prefix + base64.encodestring(
+            marshal.dumps(params)).replace('\n', '')
+
+    def journal_decode(self, classname, params):
+        """Decode the params column of a journal entry."""
+        prefix = self.journal_prefix
+        if params.startswith(prefix):
+            params = marshal.loads(base64.decodestring(params[len(prefix):]))
+        else:
+            params = self._journal_eval(params)
+        if isinstance(params, type({})):
+            cvts = self.row_codec(classname).journal_from_sql
+            for param, value in params.items():
+                # deleted properties have no converter
+                if value and cvts.has_key(param):
+                    params[param] = cvts[param](value)
+        return params
+
+    def _journal_eval(self, params,
+            names={'__builtins__': {}, 'None': None, 'True': True,
+            'False': False}):
+        """Decode a journal params repr() written before version 7."""
+        return eval(params, names.copy())
 
     def getjournal(self, classname, nodeid):
         """ get the journal for id
@@ -1174,31 +1421,77 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
 
         # now unmarshal the data
         dc = self.sql_to_hyperdb_value[hyperdb.Date]
+        decode = self.journal_decode
         res = []
-        properties = self.getclass(classname).getprops()
         for nodeid, date_stamp, user, action, params in journal:
-            params = eval(params)
-            if isinstance(params, type({})):
-                for param, value in params.items():
-                    if not value:
-                        continue
-                    property = properties.get(param, None)
-                    if property is None:
-                        # deleted property
-                        continue
-                    cvt = self.sql_to_hyperdb_value[property.__class__]
-                    if isinstance(property, Password):
-                        params[param] = cvt(value)
-                    elif isinstance(property, Date):
-                        params[param] = cvt(value)
-                    elif isinstance(property, Interval):
-                        params[param] = cvt(value)
-                    elif isinstance(property, Boolean):
-                        params[param] = cvt(value)
             # XXX numeric ids
-            res.append((str(nodeid), dc(date_stamp), user, action, params))
+            res.append((str(nodeid), dc(date_stamp), user, action,
+                decode(classname, params)))
         return res
 
+    # the number of journal rows fetched at a time by iterjournals()
+    journal_fetch_size = 500
+
+    def iterjournals(self, classname, nodeids=None, since=None):
+        """ Generate the journal entries of the nodes of the class, or of
+            the "nodeids" given, in order of nodeid and date; only those
+            made since the "since" date if given.
+
+            The entries are fetched "journal_fetch_size" rows at a time
+            from a cursor of their own (see sql_stream_cursor()) with one
+            query for all the nodes, or for each chunk of "max_in_args"
+            nodeids, and are decoded as they are generated. Don't commit
+            before the end of the entries.
+        """
+        cols = ','.join('nodeid date tag action params'.split())
+        where = []
+        args = []
+        if since is not None:
+            where.append('date>=%s'%self.arg)
+            args.append(self.hyperdb_to_sql_value[hyperdb.Date](since))
+        if nodeids is None:
+            chunks = [None]
+        else:
+            # XXX numeric ids
+            nodeids = dict([(int(nodeid), 1) for nodeid in nodeids]).keys()
+            nodeids.sort()
+            chunks = [nodeids[i:i+self.max_in_args]
+                for i in range(0, len(nodeids), self.max_in_args)]
+
+        dc = self.sql_to_hyperdb_value[hyperdb.Date]
+        decode = self.journal_decode
+        for chunk in chunks:
+            w = where[:]
+            a = args[:]
+            if chunk is not None:
+                w.append('nodeid in (%s)'%','.join([self.arg] * len(chunk)))
+                a.extend(chunk)
+            sql = 'select %s from %s__journal'%(cols, classname)
+            if w:
+                sql += ' where ' + ' and '.join(w)
+            sql += ' order by nodeid, date'
+            if __debug__:
+                logging.getLogger('hyperdb').debug('SQL %r %r'%(sql, a))
+            cursor = self.sql_stream_cursor()
+            if a:
+                cursor.execute(sql, tuple(a))
+            else:
+                cursor.execute(sql)
+            while 1:
+                rows = cursor.fetchmany(self.journal_fetch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    # XXX numeric ids
+                    yield (str(row[0]), dc(row[1]), row[2], row[3],
+                        decode(classname, row[4]))
+            cursor.close()
+
+    def sql_stream_cursor(self):
+        """ Return a new cursor to fetch many rows from, bit by bit.
+        """
+        return self.conn.cursor()
+
     def save_journal(self, classname, cols, nodeid, journaldate,
             journaltag, action, params):
         """ Save the journal entry to the database
@@ -1266,6 +1559,11 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         # clear out the transactions
         self.transactions = []
 
+        self.renewChangeStamps()
+
+        for store in self.sessionStores():
+            store.commit()
+
     def sql_rollback(self):
         self.conn.rollback()
 
@@ -1285,17 +1583,25 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
             if method == self.doStoreFile:
                 self.rollbackStoreFile(*args)
         self.transactions = []
+        self.forgetChanges()
+        for store in self.sessionStores():
+            store.rollback()
 
         # clear the cache
         self.clearCache()
 
     def sql_close(self):
         logging.getLogger('hyperdb').info('close')
-        self.conn.close()
+        if self.connection_pool is not None:
+            self.connection_pool.put(self.conn)
+        else:
+            self.conn.close()
 
     def close(self):
         """ Close off the connection.
         """
+        for store in self.sessionStores():
+            store.close()
         self.indexer.close()
         self.sql_close()
 
@@ -1309,6 +1615,9 @@ class Class(hyperdb.Class):
         concrete backend Class.
     """
 
+    # filter() uses LIMIT/OFFSET and filter_count() uses COUNT(*)
+    supports_limit = 1
+
     def schema(self):
         """ A dumpable version of the schema that we can store in the
             database
@@ -1545,6 +1854,41 @@ class Class(hyperdb.Class):
 
         return d[propname]
 
+    def prefetch(self, ids, propnames=[]):
+        """Load the items with the given ids into the row cache using a
+        few bulk queries rather than a query per item.
+
+        If any of the 'propnames' are Link or Multilink properties, the
+        items they point to are prefetched too. No more rows than fit
+        in the row cache are loaded.
+        """
+        room = self.db.cache.size
+        ids = list(ids)[:room]
+        nodes = self.db.getnodes(self.classname, ids)
+        room = room - len(nodes)
+
+        # gather the linked ids per class
+        props = self.getprops()
+        linked = {}
+        for propname in propnames:
+            prop = props.get(propname)
+            if not isinstance(prop, (Link, Multilink)):
+                continue
+            l = linked.setdefault(prop.classname, [])
+            for nodeid in ids:
+                value = nodes.get(nodeid, {}).get(propname)
+                if not value:
+                    continue
+                if isinstance(prop, Link):
+                    l.append(value)
+                else:
+                    l.extend(value)
+        for classname, linkids in linked.items():
+            if room <= 0:
+                break
+            linkids = linkids[:room]
+            room = room - len(self.db.getnodes(classname, linkids))
+
     def set(self, nodeid, **propvalues):
         """Modify a property on an existing node of this class.
 
@@ -1799,6 +2143,7 @@ class Class(hyperdb.Class):
         sql = 'update _%s set __retired__=%s where id=%s'%(self.classname,
             self.db.arg, self.db.arg)
         self.db.sql(sql, (nodeid, nodeid))
+        self.db.noteChange(self.classname)
         if self.do_journal:
             self.db.addjournal(self.classname, nodeid, ''"retired", None)
 
@@ -1829,6 +2174,7 @@ class Class(hyperdb.Class):
         sql = 'update _%s set __retired__=%s where id=%s'%(self.classname,
             self.db.arg, self.db.arg)
         self.db.sql(sql, (0, nodeid))
+        self.db.noteChange(self.classname)
         if self.do_journal:
             self.db.addjournal(self.classname, nodeid, ''"restored", None)
 
@@ -2087,7 +2433,8 @@ class Class(hyperdb.Class):
     # The format parameter is replaced with the attribute.
     order_by_null_values = None
 
-    def filter(self, search_matches, filterspec, sort=[], group=[]):
+    def filter(self, search_matches, filterspec, sort=[], group=[],
+            limit=None, offset=None):
         """Return a list of the ids of the active nodes in this class that
         match the 'filter' spec, sorted by the group spec and then the
         sort spec
@@ -2101,6 +2448,10 @@ class Class(hyperdb.Class):
 
         "search_matches" is {nodeid: marker} or None
 
+        "limit" and "offset" select a slice of the sorted result. When
+        the sort can be done completely in SQL they are passed on to the
+        database as LIMIT/OFFSET.
+
         The filter must match all properties specificed. If the property
         value to match is a list:
 
@@ -2114,6 +2465,69 @@ class Class(hyperdb.Class):
         if __debug__:
             start_t = time.time()
 
+        proptree, auxcols, sql, args = self._filter_sql(search_matches,
+            filterspec, sort, group)
+
+        # if the database does all of the sorting it can do the slicing
+        # too
+        sql_slice = limit is not None and not [s for s in proptree.sortattr
+            if not s.attr_sort_done]
+        if sql_slice:
+            sql = sql + ' limit %d offset %d'%(limit, offset or 0)
+
+        __traceback_info__ = (sql, args)
+        self.db.sql(sql, args)
+        l = self.db.sql_fetchall()
+
+        # Compute values needed for sorting in proptree.sort
+        for p in auxcols.itervalues():
+            p.sort_ids = p.sort_result = [row[p.auxcol] for row in l]
+        # return the IDs (the first column)
+        # XXX numeric ids
+        l = [str(row[0]) for row in l]
+        l = proptree.sort (l)
+        if not sql_slice and (limit is not None or offset):
+            offset = offset or 0
+            if limit is None:
+                l = l[offset:]
+            else:
+                l = l[offset:offset+limit]
+
+        if __debug__:
+            self.db.stats['filtering'] += (time.time() - start_t)
+        return l
+
+    def filter_count(self, search_matches, filterspec):
+        """Return the number of active nodes in this class that match
+        the 'filter' spec; see filter() for the arguments.
+
+        The matching nodes are counted by the database.
+        """
+        # we can't match anything if search_matches is empty
+        if search_matches == {}:
+            return 0
+
+        if __debug__:
+            start_t = time.time()
+
+        proptree, auxcols, sql, args = self._filter_sql(search_matches,
+            filterspec, count=1)
+        __traceback_info__ = (sql, args)
+        self.db.sql(sql, args)
+        n = int(self.db.sql_fetchone()[0])
+
+        if __debug__:
+            self.db.stats['filtering'] += (time.time() - start_t)
+        return n
+
+    def _filter_sql(self, search_matches, filterspec, sort=[], group=[],
+            count=0):
+        """Construct the SQL for filter() or, if "count" is set, for
+        filter_count().
+
+        Returns the property tree, the auxiliary sort columns, the SQL
+        and its arguments.
+        """
         icn = self.classname
 
         # vars to hold the components of the SQL statement
@@ -2331,6 +2745,14 @@ class Class(hyperdb.Class):
             where = ' where ' + (' and '.join(where))
         else:
             where = ''
+        if count:
+            if mlfilt:
+                # don't count the dupes from the Multilink table joins
+                cols = 'count(distinct(_%s.id))'%icn
+            else:
+                cols = 'count(*)'
+            sql = 'select %s from %s %s'%(cols, frum, where)
+            return proptree, {}, sql, tuple(args)
         if mlfilt:
             # we're joining tables on the id, so we will get dupes if we
             # don't distinct()
@@ -2356,22 +2778,7 @@ class Class(hyperdb.Class):
         cols = ','.join(cols)
         loj = ' '.join(loj)
         sql = 'select %s from %s %s %s%s'%(cols, frum, loj, where, order)
-        args = tuple(args)
-        __traceback_info__ = (sql, args)
-        self.db.sql(sql, args)
-        l = self.db.sql_fetchall()
-
-        # Compute values needed for sorting in proptree.sort
-        for p in auxcols.itervalues():
-            p.sort_ids = p.sort_result = [row[p.auxcol] for row in l]
-        # return the IDs (the first column)
-        # XXX numeric ids
-        l = [str(row[0]) for row in l]
-        l = proptree.sort (l)
-
-        if __debug__:
-            self.db.stats['filtering'] += (time.time() - start_t)
-        return l
+        return proptree, auxcols, sql, tuple(args)
 
     def filter_sql(self, sql):
         """Return a list of the ids of the items in this class that match
@@ -2428,6 +2835,7 @@ class Class(hyperdb.Class):
             if self.properties.has_key(key):
                 raise ValueError, key
         self.properties.update(properties)
+        self.db.row_codecs.pop(self.classname, None)
 
     def index(self, nodeid):
         """Add (or refresh) the node to search indexes
@@ -2554,33 +2962,33 @@ class Class(hyperdb.Class):
         """
         properties = self.getprops()
         r = []
-        for nodeid in self.getnodeids():
-            for nodeid, date, user, action, params in self.history(nodeid):
-                date = date.get_tuple()
-                if action == 'set':
-                    export_data = {}
-                    for propname, value in params.items():
-                        if not properties.has_key(propname):
-                            # property no longer in the schema
-                            continue
-
-                        prop = properties[propname]
-                        # make sure the params are eval()'able
-                        if value is None:
-                            pass
-                        elif isinstance(prop, Date):
-                            value = value.get_tuple()
-                        elif isinstance(prop, Interval):
-                            value = value.get_tuple()
-                        elif isinstance(prop, Password):
-                            value = str(value)
-                        export_data[propname] = value
-                    params = export_data
-                elif action == 'create' and params:
-                    # old tracker with data stored in the create!
-                    params = {}
-                l = [nodeid, date, user, action, params]
-                r.append(map(repr, l))
+        for nodeid, date, user, action, params in \
+                self.db.iterjournals(self.classname):
+            date = date.get_tuple()
+            if action == 'set':
+                export_data = {}
+                for propname, value in params.items():
+                    if not properties.has_key(propname):
+                        # property no longer in the schema
+                        continue
+
+                    prop = properties[propname]
+                    # make sure the params are eval()'able
+                    if value is None:
+                        pass
+                    elif isinstance(prop, Date):
+                        value = value.get_tuple()
+                    elif isinstance(prop, Interval):
+                        value = value.get_tuple()
+                    elif isinstance(prop, Password):
+                        value = str(value)
+                    export_data[propname] = value
+                params = export_data
+            elif action == 'create' and params:
+                # old tracker with data stored in the create!
+                params = {}
+            l = [nodeid, date, user, action, params]
+            r.append(map(repr, l))
         return r
 
     def import_journals(self, entries):
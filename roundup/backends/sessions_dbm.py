@@ -15,6 +15,10 @@ class BasicDatabase:
     ''' Provide a nice encapsulation of an anydbm store.
 
         Keys are id strings, values are automatically marshalled data.
+
+        The store is opened once, when first used, and closed again by
+        commit(), rollback() or close(). Changes are kept in memory until
+        commit() (or close()) writes them all through that one handle.
     '''
     _db_type = None
 
@@ -22,15 +26,16 @@ class BasicDatabase:
         self.config = db.config
         self.dir = db.config.DATABASE
         os.umask(db.config.UMASK)
+        self.handle = None
+        # the values changed since the last commit, by id (None if
+        # destroyed)
+        self.pending = {}
 
     def exists(self, infoid):
-        db = self.opendb('c')
-        try:
-            return db.has_key(infoid)
-        finally:
-            db.close()
+        return self.load(infoid) is not None
 
     def clear(self):
+        self.rollback()
         path = os.path.join(self.dir, self.name)
         if os.path.exists(path):
             os.remove(path)
@@ -54,58 +59,82 @@ class BasicDatabase:
             db_type = 'dbm'
         self.__class__._db_type = db_type
 
+    def gethandle(self):
+        '''Return the open store, opening it if necessary.
+        '''
+        # Keeping it open for writing (some dbm modules lock it while it
+        # is) until the end of the transaction doesn't hold up the other
+        # processes: these stores are only used by the anydbm backend,
+        # whose Database holds an exclusive lock on the database (see
+        # back_anydbm.Database.__init__) for as long as it's open anyway.
+        if self.handle is None:
+            self.handle = self.opendb('c')
+        return self.handle
+
+    def load(self, infoid):
+        '''Return the values stored for the id, or None.
+        '''
+        if self.pending.has_key(infoid):
+            return self.pending[infoid]
+        db = self.gethandle()
+        if not db.has_key(infoid):
+            return None
+        return marshal.loads(db[infoid])
+
     _marker = []
     def get(self, infoid, value, default=_marker):
-        db = self.opendb('c')
-        try:
-            if db.has_key(infoid):
-                values = marshal.loads(db[infoid])
-            else:
-                if default != self._marker:
-                    return default
-                raise KeyError, 'No such %s "%s"'%(self.name, infoid)
-            return values.get(value, None)
-        finally:
-            db.close()
+        values = self.load(infoid)
+        if values is None:
+            if default != self._marker:
+                return default
+            raise KeyError, 'No such %s "%s"'%(self.name, infoid)
+        return values.get(value, None)
 
     def getall(self, infoid):
-        db = self.opendb('c')
-        try:
-            try:
-                d = marshal.loads(db[infoid])
-                del d['__timestamp']
-                return d
-            except KeyError:
-                raise KeyError, 'No such %s "%s"'%(self.name, infoid)
-        finally:
-            db.close()
+        values = self.load(infoid)
+        if values is None:
+            raise KeyError, 'No such %s "%s"'%(self.name, infoid)
+        d = values.copy()
+        if d.has_key('__timestamp'):
+            del d['__timestamp']
+        return d
+
+    def get_many(self, infoids):
+        '''Return the values of those of the ids that exist, by id.
+        '''
+        result = {}
+        for infoid in infoids:
+            values = self.load(infoid)
+            if values is not None:
+                values = values.copy()
+                if values.has_key('__timestamp'):
+                    del values['__timestamp']
+                result[infoid] = values
+        return result
 
     def set(self, infoid, **newvalues):
-        db = self.opendb('c')
-        try:
-            if db.has_key(infoid):
-                values = marshal.loads(db[infoid])
-            else:
-                values = {'__timestamp': time.time()}
-            values.update(newvalues)
-            db[infoid] = marshal.dumps(values)
-        finally:
-            db.close()
+        values = self.load(infoid)
+        if values is None:
+            values = {'__timestamp': time.time()}
+        else:
+            values = values.copy()
+        values.update(newvalues)
+        self.pending[infoid] = values
 
     def list(self):
-        db = self.opendb('r')
-        try:
-            return db.keys()
-        finally:
-            db.close()
+        keys = {}
+        for key in self.gethandle().keys():
+            keys[key] = 1
+        for key, values in self.pending.items():
+            if values is None:
+                if keys.has_key(key):
+                    del keys[key]
+            else:
+                keys[key] = 1
+        return keys.keys()
 
     def destroy(self, infoid):
-        db = self.opendb('c')
-        try:
-            if db.has_key(infoid):
-                del db[infoid]
-        finally:
-            db.close()
+        self.pending[infoid] = None
 
     def opendb(self, mode):
         '''Low-level database opener that gets around anydbm/dbm
@@ -127,10 +156,33 @@ class BasicDatabase:
         return dbm.open(path, mode)
 
     def commit(self):
-        pass
+        '''Write the changes, and close the store.
+        '''
+        if self.pending:
+            db = self.gethandle()
+            for infoid, values in self.pending.items():
+                if values is not None:
+                    db[infoid] = marshal.dumps(values)
+                elif db.has_key(infoid):
+                    del db[infoid]
+            self.pending = {}
+        self.closehandle()
+
+    def rollback(self):
+        '''Forget the changes, and close the store.
+        '''
+        self.pending = {}
+        self.closehandle()
 
     def close(self):
-        pass
+        '''Write the changes left, and close the store.
+        '''
+        self.commit()
+
+    def closehandle(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
 
     def updateTimestamp(self, sessid):
         ''' don't update every hit - once a minute should be OK '''
@@ -141,15 +193,17 @@ class BasicDatabase:
 
     def clean(self, now):
         """Age sessions, remove when they haven't been used for a week.
+
+        This is a single pass over the store; the changes are written by
+        the next commit().
         """
         week = 60*60*24*7
         for sessid in self.list():
-            sess = self.get(sessid, '__timestamp', None)
+            values = self.load(sessid)
+            sess = values.get('__timestamp')
             if sess is None:
-                sess=time.time()
-                self.updateTimestamp(sessid)
-            interval = now - sess
-            if interval > week:
+                self.set(sessid, __timestamp=time.time())
+            elif now - sess > week:
                 self.destroy(sessid)
 
 class Sessions(BasicDatabase):
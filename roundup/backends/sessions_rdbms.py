@@ -7,7 +7,26 @@ class. It's now also used for One Time Key handling too.
 """
 __docformat__ = 'restructuredtext'
 
-import os, time
+import os, time, marshal, base64
+
+# the prefix of the values encoded by encode_value()
+value_prefix = 'M:'
+
+def encode_value(values):
+    '''Encode the dict of values of a session or one-time key for the
+    value column.
+    '''
+    return value_prefix + base64.encodestring(
+        marshal.dumps(values)).replace('\n', '')
+
+def decode_value(value, names={'__builtins__': {}, 'None': None,
+        'True': True, 'False': False}):
+    '''Decode a value column, written by encode_value() or (before
+    version 8 of the database) repr().
+    '''
+    if value.startswith(value_prefix):
+        return marshal.loads(base64.decodestring(value[len(value_prefix):]))
+    return eval(value, names.copy())
 
 class BasicDatabase:
     ''' Provide a nice encapsulation of an RDBMS table.
@@ -16,80 +35,131 @@ class BasicDatabase:
     '''
     def __init__(self, db):
         self.db = db
-        self.cursor = self.db.cursor
+        # the values of the ids read or written by the transaction, or
+        # None for those known not to exist: set() needs no select for them
+        self.known = {}
 
     def clear(self):
-        self.cursor.execute('delete from %ss'%self.name)
+        self.db.cursor.execute('delete from %ss'%self.name)
+        self.known = {}
+
+    def load(self, infoid):
+        '''Return the values stored for the id, or None.
+        '''
+        if self.known.has_key(infoid):
+            return self.known[infoid]
+        n = self.name
+        c = self.db.cursor
+        c.execute('select %s_value from %ss where %s_key=%s'%(n, n, n,
+            self.db.arg), (infoid,))
+        res = c.fetchone()
+        if res:
+            values = decode_value(res[0])
+        else:
+            values = None
+        self.known[infoid] = values
+        return values
 
     def exists(self, infoid):
-        n = self.name
-        self.cursor.execute('select count(*) from %ss where %s_key=%s'%(n,
-            n, self.db.arg), (infoid,))
-        return int(self.cursor.fetchone()[0])
+        return self.load(infoid) is not None
 
     _marker = []
     def get(self, infoid, value, default=_marker):
-        n = self.name
-        self.cursor.execute('select %s_value from %ss where %s_key=%s'%(n,
-            n, n, self.db.arg), (infoid,))
-        res = self.cursor.fetchone()
-        if not res:
+        values = self.load(infoid)
+        if values is None:
             if default != self._marker:
                 return default
             raise KeyError, 'No such %s "%s"'%(self.name, infoid)
-        values = eval(res[0])
         return values.get(value, None)
 
     def getall(self, infoid):
-        n = self.name
-        self.cursor.execute('select %s_value from %ss where %s_key=%s'%(n,
-            n, n, self.db.arg), (infoid,))
-        res = self.cursor.fetchone()
-        if not res:
+        values = self.load(infoid)
+        if values is None:
             raise KeyError, 'No such %s "%s"'%(self.name, infoid)
-        return eval(res[0])
+        return values.copy()
+
+    def get_many(self, infoids):
+        '''Return the values of those of the ids that exist, by id, with
+        a single select.
+        '''
+        result = {}
+        missing = []
+        for infoid in infoids:
+            if not self.known.has_key(infoid):
+                missing.append(infoid)
+            elif self.known[infoid] is not None:
+                result[infoid] = self.known[infoid].copy()
+        if missing:
+            n = self.name
+            c = self.db.cursor
+            c.execute('select %s_key, %s_value from %ss where %s_key in (%s)'%(
+                n, n, n, n, ','.join([self.db.arg] * len(missing))),
+                tuple(missing))
+            for infoid in missing:
+                self.known[infoid] = None
+            for infoid, value in c.fetchall():
+                values = decode_value(value)
+                self.known[infoid] = values
+                result[infoid] = values.copy()
+        return result
 
     def set(self, infoid, **newvalues):
-        c = self.cursor
+        c = self.db.cursor
         n = self.name
         a = self.db.arg
-        c.execute('select %s_value from %ss where %s_key=%s'%(n, n, n, a),
-            (infoid,))
-        res = c.fetchone()
-        if res:
-            values = eval(res[0])
-        else:
+        old = self.load(infoid)
+        if old is None:
             values = {}
+        else:
+            values = old.copy()
         values.update(newvalues)
 
-        if res:
+        if old is not None:
             sql = 'update %ss set %s_value=%s where %s_key=%s'%(n, n,
                 a, n, a)
-            args = (repr(values), infoid)
+            args = (encode_value(values), infoid)
         else:
             sql = 'insert into %ss (%s_key, %s_time, %s_value) '\
                 'values (%s, %s, %s)'%(n, n, n, n, a, a, a)
-            args = (infoid, time.time(), repr(values))
+            args = (infoid, time.time(), encode_value(values))
         c.execute(sql, args)
+        self.known[infoid] = values
 
     def destroy(self, infoid):
-        self.cursor.execute('delete from %ss where %s_key=%s'%(self.name,
+        self.db.cursor.execute('delete from %ss where %s_key=%s'%(self.name,
             self.name, self.db.arg), (infoid,))
+        self.known[infoid] = None
 
     def updateTimestamp(self, infoid):
         """ don't update every hit - once a minute should be OK """
         now = time.time()
-        self.cursor.execute('''update %ss set %s_time=%s where %s_key=%s
+        self.db.cursor.execute('''update %ss set %s_time=%s where %s_key=%s
             and %s_time < %s'''%(self.name, self.name, self.db.arg,
             self.name, self.db.arg, self.name, self.db.arg),
             (now, infoid, now-60))
 
     def clean(self, now):
         """Age sessions, remove when they haven't been used for a week.
+
+        The time column is indexed, so only the old rows are looked at.
         """
         old = now - 60*60*24*7
-        self.cursor.execute('delete from %ss where %s_time < %s'%(self.name,
-            self.name, self.db.arg), (old, ))
+        self.db.cursor.execute('delete from %ss where %s_time < %s'%(
+            self.name, self.name, self.db.arg), (old, ))
+        # (the rows removed aren't known)
+        self.known = {}
+
+    def commit(self):
+        '''Forget the values known: other transactions may change them
+        once this one is committed.
+        '''
+        self.known = {}
+
+    def rollback(self):
+        self.known = {}
+
+    def close(self):
+        self.known = {}
 
 class Sessions(BasicDatabase):
     name = 'session'
@@ -15,6 +15,10 @@
 # 1. removed all Zope-specific code (doesn't even try to import that stuff now)
 # 2. removed all Acquisition
 # 3. removed blocking of leading-underscore URL components
+# 4. plain paths (no "?var" or empty components) are traversed by
+#    traverse(), with less overhead than restrictedTraverse()
+# 5. the expressions may be pickled (they're compiled again when
+#    unpickled)
 
 """Page Template Expression Engine
 
@@ -98,6 +102,16 @@ def render(ob, ns):
                     raise
     return ob
 
+class Recompiled:
+    """Mix-in for the expressions pickled as their type and text only,
+    and compiled again when unpickled.
+    """
+    def __getstate__(self):
+        return {'_name': self._name, '_s': self._s}
+
+    def __setstate__(self, state):
+        self.__init__(state['_name'], state['_s'], getEngine())
+
 class SubPathExpr:
     def __init__(self, path):
         self._path = path = path.strip().split('/')
@@ -111,11 +125,18 @@ class SubPathExpr:
             if e[:1] == '?' and _valid_name(e[1:]):
                 dp.append((i, e[1:]))
         dp.reverse()
+        # the names of a plain path, traversed directly
+        if dp or '' in path:
+            self._names = None
+        else:
+            self._names = tuple(path)
+        self._info = 'path expression "%s"'%('/'.join(path))
 
     def _eval(self, econtext,
               list=list, isinstance=isinstance, StringType=type('')):
         vars = econtext.vars
         path = self._path
+        names = self._names
         if self._dp:
             path = list(path) # Copy!
             for i, varname in self._dp:
@@ -127,18 +148,20 @@ class SubPathExpr:
                     # of path names.
                     path[i:i+1] = list(val)
         base = self._base
-        __traceback_info__ = 'path expression "%s"'%('/'.join(self._path))
+        __traceback_info__ = self._info
         if base == 'CONTEXTS' or not base:
             ob = econtext.contexts
         else:
             ob = vars[base]
         if isinstance(ob, DeferWrapper):
             ob = ob()
+        if names is not None:
+            return traverse(ob, names)
         if path:
             ob = restrictedTraverse(ob, path, getSecurityManager())
         return ob
 
-class PathExpr:
+class PathExpr(Recompiled):
     def __init__(self, name, expr, engine):
         self._s = expr
         self._name = name
@@ -202,7 +225,9 @@ class PathExpr:
 
 _interp = re.compile(r'\$(%(n)s)|\${(%(n)s(?:/[^}]*)*)}' % {'n': NAME_RE})
 
-class StringExpr:
+class StringExpr(Recompiled):
+    _name = 'string'
+
     def __init__(self, name, expr, engine):
         self._s = expr
         if '%' in expr:
@@ -243,7 +268,9 @@ class StringExpr:
     def __repr__(self):
         return 'string:%s' % `self._s`
 
-class NotExpr:
+class NotExpr(Recompiled):
+    _name = 'not'
+
     def __init__(self, name, expr, compiler):
         self._s = expr = expr.lstrip()
         self._c = compiler.compile(expr)
@@ -268,7 +295,9 @@ class DeferWrapper:
     def __call__(self):
         return self._expr(self._econtext)
 
-class DeferExpr:
+class DeferExpr(Recompiled):
+    _name = 'defer'
+
     def __init__(self, name, expr, compiler):
         self._s = expr = expr.lstrip()
         self._c = compiler.compile(expr)
@@ -341,3 +370,25 @@ def restrictedTraverse(object, path, securityManager,
         object = o
 
     return object
+
+def traverse(object, path, get=guarded_getattr, M=[]):
+    """Traverse a path of (non-empty) names from the object, the same
+    as restrictedTraverse() would.
+    """
+    done = []
+    try:
+        for name in path:
+            o = get(object, name, M)
+            if o is M:
+                try:
+                    o = object[name]
+                except (AttributeError, TypeError):
+                    # raise the error restrictedTraverse would
+                    o = restrictedTraverse(object, [name],
+                        getSecurityManager())
+            done.append((name, o))
+            object = o
+    except:
+        __traceback_info__ = TraversalError(done, name)
+        raise
+    return object
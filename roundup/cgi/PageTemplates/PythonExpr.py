@@ -13,6 +13,7 @@
 # Modified for Roundup:
 # 
 # 1. more informative traceback info
+# 2. may be pickled (with the code of the expression)
 
 """Generic Python Expression Handler
 """
@@ -21,6 +22,7 @@ __version__='$Revision: 1.6 $'[11:-2]
 
 from TALES import CompilerError
 from sys import exc_info
+import marshal, new
 
 class getSecurityManager:
     '''Null security manager'''
@@ -68,6 +70,17 @@ class PythonExpr:
         f.func_globals.update(self._bind_used_names(econtext))
         return f()
 
+    def __getstate__(self):
+        # functions can't be pickled, their code can
+        state = self.__dict__.copy()
+        state['_f'] = marshal.dumps(self._f.func_code)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._f = new.function(marshal.loads(state['_f']),
+            {'__builtins__': __builtins__})
+
     def __str__(self):
         return 'Python expression "%s"' % self.expr
     def __repr__(self):
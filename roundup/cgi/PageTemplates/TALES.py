@@ -165,6 +165,8 @@ class Context:
     def __init__(self, compiler, contexts):
         self._compiler = compiler
         self.contexts = contexts
+        # the source files of the templates rendered in this context
+        self.source_files = {}
         contexts['nothing'] = None
         contexts['default'] = Default
 
@@ -255,6 +257,7 @@ class Context:
 
     def setSourceFile(self, source_file):
         self.source_file = source_file
+        self.source_files[source_file] = 1
 
     def setPosition(self, position):
         self.position = position
@@ -62,6 +62,7 @@ class DummyEngine:
         self.locals = self.globals = dict
         self.stack = [dict]
         self.translationService = DummyTranslationService()
+        self.source_files = {}
 
     def getCompilerError(self):
         return CompilerError
@@ -71,6 +72,7 @@ class DummyEngine:
 
     def setSourceFile(self, source_file):
         self.source_file = source_file
+        self.source_files[source_file] = 1
 
     def setPosition(self, position):
         self.position = position
@@ -0,0 +1,413 @@
+"""Compiler of cooked TAL programs to Python functions.
+
+The TALInterpreter renders a program by dispatching each of its
+instructions to a handler method, and does the same for every block
+(loop body, condition, ...) each time it's run. The TALCompiler instead
+generates, once, the Python code doing what those handlers would do:
+static text is written as literals, the blocks of loops, conditions and
+substitutions are inlined, and the engine methods and output stream are
+looked up once per function and kept in local variables.
+
+The compiled program is still a list of the same instructions (with its
+separately run blocks, such as macros and slots, compiled too), so it may
+also be interpreted, eg. as a macro used by a template that isn't
+compiled. The CompiledTALInterpreter runs the functions of the compiled
+programs it's given, and interprets the others.
+
+The compiled programs may be pickled along with the generated code (see
+TALCompiler.linkage()), and their functions restored by link().
+"""
+
+from types import StringType, UnicodeType, IntType, TupleType, NoneType
+from cgi import escape
+
+from TALInterpreter import TALInterpreter, ustr
+
+class CompiledProgram(list):
+    """A TAL program compiled by the TALCompiler: "render(interpreter)"
+    does what interpreting the program would.
+    """
+    render = None
+
+    def __getstate__(self):
+        # the function is restored by link()
+        return None
+
+class CompiledTALInterpreter(TALInterpreter):
+    """TALInterpreter running the compiled programs (including macros
+    and slots) rather than interpreting them.
+
+    Only for rendering templates: "tal" and "metal" must be set, and
+    "showtal" and "debug" not.
+    """
+    def __init__(self, program, macros, engine, stream=None, **kw):
+        TALInterpreter.__init__(self, program, macros, engine, stream,
+            **kw)
+        assert self.tal and self.metal and not self.showtal \
+            and not self.debug
+
+    def interpret(self, program):
+        render = getattr(program, 'render', None)
+        if render is None:
+            TALInterpreter.interpret(self, program)
+            return
+        oldlevel = self.level
+        self.level = oldlevel + 1
+        try:
+            render(self)
+        finally:
+            self.level = oldlevel
+
+# the engine methods the generated code may use
+ENGINE_METHODS = ('setPosition', 'setSourceFile', 'beginScope',
+    'endScope', 'setLocal', 'setGlobal', 'setRepeat', 'evaluateValue',
+    'evaluateBoolean', 'evaluateText', 'evaluateStructure')
+
+# the positions of the blocks in the arguments of the instructions that
+# are run by the interpreter's handlers (rather than inlined), which must
+# be compiled separately
+HANDLER_BLOCKS = {
+    'optTag': (4, 5),
+    'i18nVariable': (1,),
+    'insertTranslation': (1,),
+    'defineMacro': (1,),
+    'useMacro': (3,),
+    'defineSlot': (1,),
+    'onError': (0, 1),
+    'cache': (2,),
+}
+
+class TALCompiler:
+    """Compiles the program and macros of a cooked template, see
+    compile().
+    """
+    def __init__(self, filename='<template>'):
+        # the name the generated code is compiled under (for tracebacks)
+        self.filename = filename
+        # the compiled programs, by id() of the source program
+        self.programs = {}
+        # (compiled program, source program) still to generate code for
+        self.todo = []
+        # the lines of the generated module
+        self.lines = []
+        # the objects the generated code refers to, by name
+        self.constants = {}
+        self.counter = 0
+        # (compiled program, name of its function)
+        self.functions = []
+        self.code = None
+
+    def compile(self, program, macros):
+        """Return the compiled program and macros (as a CompiledProgram
+        and a dictionary of CompiledPrograms).
+        """
+        compiled = self.compile_program(program)
+        compiled_macros = {}
+        for name, macro in macros.items():
+            compiled_macros[name] = self.compile_program(macro)
+
+        while self.todo:
+            cprogram, program = self.todo.pop()
+            self.functions.append((cprogram, self.generate(program)))
+        self.code = compile('\n'.join(self.lines) + '\n', self.filename,
+            'exec')
+        link(self.code, self.constants, self.functions)
+        return compiled, compiled_macros
+
+    def linkage(self):
+        """Return what link() needs to give the compiled programs their
+        functions (again), once they've been compiled: the code object
+        generated, the objects it refers to and the names of the
+        functions of the programs.
+        """
+        return self.code, self.constants, self.functions
+
+    def compile_program(self, program):
+        """Return the CompiledProgram for the (source) program, its
+        function to be generated later.
+        """
+        key = id(program)
+        if self.programs.has_key(key):
+            return self.programs[key][0]
+        cprogram = CompiledProgram()
+        # (keep the source program alive so its id() isn't reused)
+        self.programs[key] = (cprogram, program)
+        for item in program:
+            cprogram.append(self.instruction(item))
+        self.todo.append((cprogram, program))
+        return cprogram
+
+    def instruction(self, item):
+        """Return the instruction with the blocks its handler will run
+        replaced by their CompiledPrograms.
+        """
+        opcode, args = item
+        positions = HANDLER_BLOCKS.get(opcode)
+        if positions is None:
+            return item
+        args = list(args)
+        for i in positions:
+            args[i] = self.compile_program(args[i])
+        if opcode == 'useMacro':
+            slots = {}
+            for name, slot in args[2].items():
+                slots[name] = self.compile_program(slot)
+            args[2] = slots
+        return opcode, tuple(args)
+
+    #
+    # code generation
+    #
+    def name(self, prefix):
+        self.counter = self.counter + 1
+        return '%s%d'%(prefix, self.counter)
+
+    def literal(self, value):
+        """Return the Python expression for the value: a literal if
+        possible, or else the name of a constant.
+        """
+        if type(value) in (StringType, UnicodeType, IntType, NoneType):
+            return repr(value)
+        if type(value) is TupleType:
+            for item in value:
+                if type(item) not in (StringType, IntType, NoneType):
+                    break
+            else:
+                return repr(value)
+        name = self.name('_c')
+        self.constants[name] = value
+        return name
+
+    def generate(self, program):
+        """Generate the function rendering the program, return its name.
+        """
+        name = self.name('_render')
+        self.body = []
+        self.uses = {}
+        self.emit_block(program, 1)
+        if not self.body:
+            self.body.append('    pass')
+
+        self.lines.append('def %s(self):'%name)
+        if self.uses:
+            self.lines.append('    engine = self.engine')
+        for method in ENGINE_METHODS:
+            if self.uses.has_key(method):
+                self.lines.append('    %s = engine.%s'%(method, method))
+        if self.uses.has_key('write'):
+            self.lines.append('    write = self._stream_write')
+        if self.uses.has_key('Default'):
+            self.lines.append('    Default = self.Default')
+        self.lines.extend(self.body)
+        self.lines.append('')
+        return name
+
+    def emit(self, indent, line, *uses):
+        self.body.append('    '*indent + line)
+        for name in uses:
+            self.uses[name] = 1
+
+    def emit_block(self, program, indent):
+        start = len(self.body)
+        for item in program:
+            opcode, args = item
+            method = getattr(self, 'do_' + opcode, None)
+            if method is None:
+                # let the interpreter handle it
+                opcode, args = self.instruction(item)
+                self.emit(indent, 'self.dispatch[%r](self, %s)'%(opcode,
+                    self.literal(args)))
+            else:
+                method(args, indent)
+        if len(self.body) == start:
+            self.emit(indent, 'pass')
+
+    def emit_handler(self, handler, item, indent):
+        opcode, args = self.instruction(item)
+        self.emit(indent, 'self.%s(%s)'%(handler, self.literal(args)))
+
+    def emit_text(self, indent, var):
+        """Write the text in "var" and update the column.
+        """
+        self.emit(indent, 'write(%s)'%var, 'write')
+        self.emit(indent, 'i = %s.rfind("\\n")'%var)
+        self.emit(indent, 'if i < 0:')
+        self.emit(indent + 1, 'self.col = self.col + len(%s)'%var)
+        self.emit(indent, 'else:')
+        self.emit(indent + 1, 'self.col = len(%s) - (i + 1)'%var)
+
+    def do_version(self, version, indent):
+        # there's nothing to check: the interpreter runs what we compile
+        pass
+
+    def do_mode(self, mode, indent):
+        self.emit(indent, 'self.do_mode(%r)'%mode)
+
+    def do_setSourceFile(self, source_file, indent):
+        source_file = self.literal(source_file)
+        self.emit(indent, 'self.sourceFile = %s'%source_file)
+        self.emit(indent, 'setSourceFile(%s)'%source_file, 'setSourceFile')
+
+    def do_setPosition(self, position, indent):
+        position = self.literal(position)
+        self.emit(indent, 'self.position = %s'%position)
+        self.emit(indent, 'setPosition(%s)'%position, 'setPosition')
+
+    def do_startTag(self, args, indent):
+        self.emit(indent, 'self.do_startTag(%s)'%self.literal(args))
+
+    def do_startEndTag(self, args, indent):
+        self.emit(indent, 'self.do_startEndTag(%s)'%self.literal(args))
+
+    def do_rawtextColumn(self, (s, col), indent):
+        self.emit(indent, 'write(%r)'%s, 'write')
+        self.emit(indent, 'self.col = %d'%col)
+
+    def do_rawtextOffset(self, (s, offset), indent):
+        self.emit(indent, 'write(%r)'%s, 'write')
+        self.emit(indent, 'self.col = self.col + %d'%offset)
+
+    def do_rawtextBeginScope(self, (s, col, position, closeprev, dict),
+            indent):
+        self.do_rawtextColumn((s, col), indent)
+        self.do_setPosition(position, indent)
+        if closeprev:
+            self.emit(indent, 'endScope()', 'endScope')
+            self.emit(indent, 'beginScope()', 'beginScope')
+        else:
+            self.emit(indent, 'beginScope()', 'beginScope')
+            self.emit(indent, 'self.scopeLevel = self.scopeLevel + 1')
+        self.emit(indent, 'setLocal("attrs", %s)'%self.literal(dict),
+            'setLocal')
+
+    def do_beginScope(self, dict, indent):
+        self.emit(indent, 'beginScope()', 'beginScope')
+        self.emit(indent, 'setLocal("attrs", %s)'%self.literal(dict),
+            'setLocal')
+        self.emit(indent, 'self.scopeLevel = self.scopeLevel + 1')
+
+    def do_endScope(self, notused, indent):
+        self.emit(indent, 'endScope()', 'endScope')
+        self.emit(indent, 'self.scopeLevel = self.scopeLevel - 1')
+
+    def do_setLocal(self, (name, expr), indent):
+        self.emit(indent, 'setLocal(%r, evaluateValue(%s))'%(name,
+            self.literal(expr)), 'setLocal', 'evaluateValue')
+
+    def do_setGlobal(self, (name, expr), indent):
+        self.emit(indent, 'setGlobal(%r, evaluateValue(%s))'%(name,
+            self.literal(expr)), 'setGlobal', 'evaluateValue')
+
+    def do_insertText(self, (expr, block), indent):
+        self.emit(indent, 'text = evaluateText(%s)'%self.literal(expr),
+            'evaluateText')
+        self.emit(indent, 'if text is Default:', 'Default')
+        self.emit_block(block, indent + 1)
+        self.emit(indent, 'elif text is not None:')
+        self.emit(indent + 1, 's = escape(text)')
+        self.emit_text(indent + 1, 's')
+
+    def do_insertStructure(self, (expr, repldict, block), indent):
+        self.emit(indent, 'structure = evaluateStructure(%s)'%
+            self.literal(expr), 'evaluateStructure')
+        self.emit(indent, 'if structure is Default:', 'Default')
+        self.emit_block(block, indent + 1)
+        self.emit(indent, 'elif structure is not None:')
+        self.emit(indent + 1, 'text = ustr(structure)')
+        if repldict:
+            self.emit(indent + 1, 'if self.html:')
+        else:
+            self.emit(indent + 1, 'if not self.strictinsert:')
+            self.emit(indent + 2, 'self.stream_write(text)')
+            self.emit(indent + 1, 'elif self.html:')
+        self.emit(indent + 2, 'self.insertHTMLStructure(text, %s)'%
+            self.literal(repldict))
+        self.emit(indent + 1, 'else:')
+        self.emit(indent + 2, 'self.insertXMLStructure(text, %s)'%
+            self.literal(repldict))
+
+    def do_loop(self, (name, expr, block), indent):
+        iterator = self.name('iterator')
+        self.emit(indent, '%s = setRepeat(%r, %s)'%(iterator, name,
+            self.literal(expr)), 'setRepeat')
+        self.emit(indent, 'while %s.next():'%iterator)
+        self.emit_block(block, indent + 1)
+
+    def do_condition(self, (condition, block), indent):
+        self.emit(indent, 'if evaluateBoolean(%s):'%
+            self.literal(condition), 'evaluateBoolean')
+        self.emit_block(block, indent + 1)
+
+    def do_optTag(self, args, indent):
+        name, cexpr, tag_ns, isend, start, program = args
+        omit = self.instruction(('optTag', args))[1]
+        omit = 'self.no_tag(%s, %s)'%(self.literal(omit[4]),
+            self.literal(omit[5]))
+        if tag_ns or cexpr == '':
+            # the tag is always left out
+            self.emit(indent, omit)
+            return
+        if cexpr is not None:
+            self.emit(indent, 'if evaluateBoolean(%s):'%
+                self.literal(cexpr), 'evaluateBoolean')
+            self.emit(indent + 1, omit)
+            self.emit(indent, 'else:')
+            indent = indent + 1
+        self.emit_block(start, indent)
+        if not isend:
+            self.emit_block(program, indent)
+            end = '</%s>'%name
+            self.emit(indent, 'write(%r)'%end, 'write')
+            self.emit(indent, 'self.col = self.col + %d'%len(end))
+
+    def do_fillSlot(self, (slotName, block), indent):
+        # only run when the macro used is "default"
+        self.emit_block(block, indent)
+
+    def do_defineMacro(self, args, indent):
+        self.emit_handler('do_defineMacro', ('defineMacro', args), indent)
+
+    def do_useMacro(self, args, indent):
+        self.emit_handler('do_useMacro', ('useMacro', args), indent)
+
+    def do_defineSlot(self, args, indent):
+        self.emit_handler('do_defineSlot', ('defineSlot', args), indent)
+
+    def do_onError(self, args, indent):
+        self.emit_handler('do_onError_tal', ('onError', args), indent)
+
+    def do_cache(self, args, indent):
+        self.emit_handler('do_cache_tal', ('cache', args), indent)
+
+    def do_i18nVariable(self, args, indent):
+        self.emit_handler('do_i18nVariable', ('i18nVariable', args),
+            indent)
+
+    def do_insertTranslation(self, args, indent):
+        self.emit_handler('do_insertTranslation',
+            ('insertTranslation', args), indent)
+
+    def do_beginI18nContext(self, settings, indent):
+        self.emit(indent, 'self.do_beginI18nContext(%s)'%
+            self.literal(settings))
+
+    def do_endI18nContext(self, notused, indent):
+        self.emit(indent, 'self.do_endI18nContext()')
+
+def link(code, constants, functions):
+    """Run the generated code (see TALCompiler.linkage()), giving the
+    compiled programs their functions.
+    """
+    namespace = {'escape': escape, 'ustr': ustr}
+    namespace.update(constants)
+    exec code in namespace
+    for cprogram, name in functions:
+        cprogram.render = namespace[name]
+
+def compile_template(program, macros, filename='<template>'):
+    """Compile the program and macros of a cooked template, see
+    TALCompiler.compile().
+    """
+    return TALCompiler(filename).compile(program, macros)
+
+# vim: set et sts=4 sw=4 :
@@ -13,6 +13,7 @@
 ##############################################################################
 # Modifications for Roundup:
 # 1. commented out ITALES references
+# 2. added the tal:cache attribute
 """
 Common definitions used by TAL and METAL compilation an transformation.
 """
@@ -51,6 +52,7 @@ KNOWN_TAL_ATTRIBUTES = [
     "attributes",
     "on-error",
     "omit-tag",
+    "cache",
     "tal tag",
     ]
 
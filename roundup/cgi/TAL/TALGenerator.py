@@ -11,6 +11,8 @@
 # FOR A PARTICULAR PURPOSE.
 #
 ##############################################################################
+# Modifications for Roundup:
+# 1. added the tal:cache attribute (the "cache" instruction)
 """
 Code generator for TALInterpreter intermediate code.
 """
@@ -299,6 +301,11 @@ class TALGenerator:
         program = self.popProgram()
         self.emit("condition", cexpr, program)
 
+    def emitCache(self, expr):
+        cexpr = self.compileExpression(expr)
+        program = self.popProgram()
+        self.emit("cache", cexpr, self.position, program)
+
     def emitRepeat(self, arg):
         m = re.match("(?s)\s*(%s)\s+(.*)\Z" % NAME_RE, arg)
         if not m:
@@ -512,6 +519,7 @@ class TALGenerator:
         define = taldict.get("define")
         condition = taldict.get("condition")
         repeat = taldict.get("repeat")
+        cache = taldict.get("cache")
         content = taldict.get("content")
         replace = taldict.get("replace")
         attrsubst = taldict.get("attributes")
@@ -627,6 +635,9 @@ class TALGenerator:
         if condition:
             self.pushProgram()
             todo["condition"] = condition
+        if cache:
+            self.pushProgram()
+            todo["cache"] = cache
         if repeat:
             todo["repeat"] = repeat
             self.pushProgram()
@@ -724,6 +735,7 @@ class TALGenerator:
         content = todo.get("content")
         replace = todo.get("replace")
         condition = todo.get("condition")
+        cache = todo.get("cache")
         onError = todo.get("onError")
         define = todo.get("define")
         repldict = todo.get("repldict", {})
@@ -798,6 +810,8 @@ class TALGenerator:
                 self.emitTranslation(msgid, i18ndata)
         if repeat:
             self.emitRepeat(repeat)
+        if cache:
+            self.emitCache(cache)
         if condition:
             self.emitCondition(condition)
         if onError:
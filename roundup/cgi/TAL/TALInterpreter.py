@@ -13,6 +13,7 @@
 ##############################################################################
 # Modifications for Roundup:
 # 1. implemented ustr as str
+# 2. added the "cache" instruction (tal:cache) and the "cache" argument
 """
 Interpreter for a pre-compiled TAL program.
 """
@@ -20,7 +21,7 @@ Interpreter for a pre-compiled TAL program.
 import sys
 import getopt
 import re
-from types import ListType
+from types import ListType, StringType, UnicodeType, IntType, LongType
 from cgi import escape
 # Do not use cStringIO here!  It's not unicode aware. :(
 from StringIO import StringIO
@@ -81,6 +82,9 @@ def interpolate(text, mapping):
     return text
 
 
+# the types of the tal:cache values that are cached
+CacheKeyTypes = (StringType, UnicodeType, IntType, LongType)
+
 class AltTALGenerator(TALGenerator):
 
     def __init__(self, repldict, expressionCompiler=None, xml=0):
@@ -117,7 +121,8 @@ class TALInterpreter:
 
     def __init__(self, program, macros, engine, stream=None,
                  debug=0, wrap=60, metal=1, tal=1, showtal=-1,
-                 strictinsert=1, stackLimit=100, i18nInterpolate=1):
+                 strictinsert=1, stackLimit=100, i18nInterpolate=1,
+                 cache=None):
         self.program = program
         self.macros = macros
         self.engine = engine # Execution engine (aka context)
@@ -150,6 +155,9 @@ class TALInterpreter:
         self.i18nStack = []
         self.i18nInterpolate = i18nInterpolate
         self.i18nContext = TranslationContext()
+        # the cache of the elements with tal:cache: its get(key) returns
+        # the text stored by set(key, text), or None
+        self.cache = cache
 
     def StringIO(self):
         # Third-party products wishing to provide a full Unicode-aware
@@ -632,6 +640,51 @@ class TALInterpreter:
             self.interpret(block)
     bytecode_handlers["condition"] = do_condition
 
+    def do_cache(self, (expr, position, block)):
+        self.interpret(block)
+    bytecode_handlers["cache"] = do_cache
+
+    def do_cache_tal(self, (expr, position, block)):
+        # the element is rendered once for each value of the expression
+        # (a string or an integer, not nothing), and its text reused
+        # from the cache
+        cache = self.cache
+        key = None
+        if cache is not None:
+            key = self.engine.evaluateValue(expr)
+        # (other values may be unhashable, or compare by identity and
+        # keep the objects of the request in the cache)
+        if not isinstance(key, CacheKeyTypes):
+            self.interpret(block)
+            return
+        # (the rendering may depend on the column, for wrapping)
+        key = (self.sourceFile, position, self.col, key)
+        # the engine records the source files of the templates rendered
+        # (see TALES.Context.setSourceFile): those of the element are
+        # cached with it, for the cache to tell when they're edited
+        engine = self.engine
+        cached = cache.get(key)
+        if cached is None:
+            sources = engine.source_files
+            engine.source_files = {self.sourceFile: 1}
+            state = self.saveState()
+            self.stream = stream = self.StringIO()
+            self._stream_write = stream.write
+            try:
+                self.interpret(block)
+            finally:
+                used = engine.source_files
+                sources.update(used)
+                engine.source_files = sources
+            self.restoreOutputState(state)
+            text = stream.getvalue()
+            cache.set(key, text, used.keys())
+        else:
+            text, used = cached
+            for source_file in used:
+                engine.source_files[source_file] = 1
+        self.stream_write(text)
+
     def do_defineMacro(self, (macroName, macro)):
         macs = self.macroStack
         if len(macs) == 1:
@@ -731,6 +784,7 @@ class TALInterpreter:
     bytecode_handlers_tal["insertText"] = do_insertText_tal
     bytecode_handlers_tal["loop"] = do_loop_tal
     bytecode_handlers_tal["onError"] = do_onError_tal
+    bytecode_handlers_tal["cache"] = do_cache_tal
     bytecode_handlers_tal["<attrAction>"] = attrAction_tal
     bytecode_handlers_tal["optTag"] = do_optTag_tal
 
@@ -0,0 +1,356 @@
+'''Caches of the output of the web interface: the pages rendered for the
+anonymous user, and the template fragments marked with tal:cache.
+
+What's cached is keyed on the change stamps (see
+roundupdb.Database.getChangeStamp()) of the classes it's derived from,
+so it isn't used any more once they change: those of the class of the
+page, and of the classes its Link and Multilink properties refer to. The
+keys also include the tracker, the user's roles, language and charset.
+
+What's cached is also checked against the modification times of the
+templates it was rendered with (see templating.Templates.changed()).
+
+The output is kept in a store, configured by the "cache" options of the
+"web" section of the tracker configuration, see get_store(): the
+MemoryStore keeps the most recently used entries in each process, the
+DiskStore keeps them in a directory shared by the processes.
+'''
+__docformat__ = 'restructuredtext'
+
+import os, marshal, md5, tempfile, logging
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
+
+from roundup import hyperdb
+from roundup.support import LRUCache
+
+class Store:
+    '''Keeps values (strings, or tuples and dicts of them) by key (a
+    tuple of strings and numbers), and statistics of its use.
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0}
+
+    def get(self, key):
+        '''Return the value stored under the key, or None.
+        '''
+        value = self.load(key)
+        if value is None:
+            self.stats['misses'] += 1
+        else:
+            self.stats['hits'] += 1
+        return value
+
+    def set(self, key, value):
+        '''Store the value under the key.
+        '''
+        self.stats['stores'] += 1
+        self.store(key, value)
+
+    def hit_ratio(self):
+        '''Return the proportion of the lookups that found a value.
+        '''
+        lookups = self.stats['hits'] + self.stats['misses']
+        if not lookups:
+            return 0.0
+        return float(self.stats['hits']) / lookups
+
+    def load(self, key):
+        raise NotImplementedError
+
+    def store(self, key, value):
+        raise NotImplementedError
+
+    def clear(self):
+        '''Remove all the values.
+        '''
+        raise NotImplementedError
+
+class MemoryStore(Store):
+    '''Keeps the "size" most recently used values in memory.
+    '''
+    def __init__(self, size):
+        Store.__init__(self, size)
+        self.cache = LRUCache(size)
+        self.stats['evictions'] = 0
+        self.lock = threading.Lock()
+
+    def load(self, key):
+        self.lock.acquire()
+        try:
+            return self.cache.get(key)
+        finally:
+            self.lock.release()
+
+    def store(self, key, value):
+        self.lock.acquire()
+        try:
+            self.cache[key] = value
+            self.stats['evictions'] = self.cache.evictions
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.cache.clear()
+        finally:
+            self.lock.release()
+
+class DiskStore(Store):
+    '''Keeps values in the files of a directory, which may be shared by
+    processes (their permissions follow the "umask"). Once there are more
+    than "size" of them, the oldest are removed.
+    '''
+    def __init__(self, dir, size, umask=022):
+        Store.__init__(self, size)
+        self.dir = dir
+        self.umask = umask
+        self.stats['evictions'] = 0
+        # the directory is pruned once every so many values stored
+        self.prune_interval = max(size / 10, 1)
+        self.stored = 0
+
+    def filename(self, key):
+        return os.path.join(self.dir, md5.md5(repr(key)).hexdigest())
+
+    def load(self, key):
+        try:
+            f = open(self.filename(key), 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                stored_key, value = marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                # (being written on Windows, or corrupt)
+                return None
+        finally:
+            f.close()
+        if stored_key != key:
+            return None
+        return value
+
+    def store(self, key, value):
+        try:
+            data = marshal.dumps((key, value))
+        except ValueError:
+            # (eg. an object in the key)
+            return
+        tmp = None
+        try:
+            if not os.path.isdir(self.dir):
+                os.makedirs(self.dir)
+            fd, tmp = tempfile.mkstemp('.tmp', '', self.dir)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+            # (mkstemp() makes the file private)
+            os.chmod(tmp, 0666 & ~self.umask)
+            filename = self.filename(key)
+            try:
+                os.rename(tmp, filename)
+            except OSError:
+                # Windows won't replace a file
+                os.remove(filename)
+                os.rename(tmp, filename)
+        except (IOError, OSError), message:
+            logging.getLogger('roundup').warning('output not cached: %s'%
+                message)
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        self.stored += 1
+        if self.stored % self.prune_interval == 0:
+            self.prune()
+
+    def prune(self):
+        '''Remove the oldest values beyond "size".
+        '''
+        entries = []
+        for name in os.listdir(self.dir):
+            path = os.path.join(self.dir, name)
+            try:
+                entries.append((os.stat(path)[os.path.stat.ST_MTIME], path))
+            except OSError:
+                # removed by another process
+                pass
+        if len(entries) <= self.size:
+            return
+        entries.sort()
+        for mtime, path in entries[:len(entries) - self.size]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            else:
+                self.stats['evictions'] += 1
+
+    def clear(self):
+        if not os.path.isdir(self.dir):
+            return
+        for name in os.listdir(self.dir):
+            try:
+                os.remove(os.path.join(self.dir, name))
+            except OSError:
+                pass
+
+# the stores of this process, by kind and settings
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_store(config):
+    '''Return the store configured by the "web" section of the tracker
+    configuration, or None if the output isn't cached.
+    '''
+    kind = config.WEB_CACHE
+    if kind == 'none':
+        return None
+    if kind == 'memory':
+        key = (kind, config.TRACKER_HOME, config.WEB_CACHE_SIZE)
+    else:
+        key = (kind, config.WEB_CACHE_DIR, config.WEB_CACHE_SIZE)
+    _stores_lock.acquire()
+    try:
+        store = _stores.get(key)
+        if store is None:
+            if kind == 'memory':
+                store = MemoryStore(config.WEB_CACHE_SIZE)
+            else:
+                store = DiskStore(config.WEB_CACHE_DIR,
+                    config.WEB_CACHE_SIZE, config.UMASK)
+            _stores[key] = store
+    finally:
+        _stores_lock.release()
+    return store
+
+class OutputCache:
+    '''The cache of the output of a web client (for one request).
+    '''
+    # (changed when the values stored change)
+    version = 2
+
+    def __init__(self, client, store):
+        self.client = client
+        self.db = client.db
+        self.store = store
+        self.templates = client.instance.templates
+        # the source files of the templates rendered by the request
+        self.sources = {}
+
+    def dependencies(self, classname):
+        '''Return the names of the classes the output about the class is
+        derived from: the class and those its Link and Multilink
+        properties refer to (all the classes if "classname" isn't one).
+        '''
+        try:
+            cl = self.db.getclass(classname)
+        except KeyError:
+            names = self.db.getclasses()
+        else:
+            names = {classname: 1}
+            for prop in cl.getprops().values():
+                if isinstance(prop, hyperdb.Link) or \
+                        isinstance(prop, hyperdb.Multilink):
+                    names[prop.classname] = 1
+            names = names.keys()
+        names.sort()
+        return names
+
+    def key(self, classname):
+        '''Return the key prefix of the output about the class, or None if
+        it may not be cached (the database has uncommitted changes).
+        '''
+        if self.db.hasChanges():
+            return None
+        stamps = []
+        for name in self.dependencies(classname):
+            stamps.append((name, self.db.getChangeStamp(name)))
+        client = self.client
+        roles = self.db.user.get(client.userid, 'roles') or ''
+        roles = [role.lower().strip() for role in roles.split(',')]
+        roles.sort()
+        # (the languages accepted by the browser are a list)
+        language = client.language
+        if isinstance(language, list):
+            language = tuple(language)
+        return (self.version, self.db.config.TRACKER_HOME, ','.join(roles),
+            language, client.charset, tuple(stamps))
+
+    def get_page(self, classname, parts):
+        '''Return the (content type, text) of the page about the class
+        identified by the "parts" tuple, or None.
+        '''
+        key = self.key(classname)
+        if key is None:
+            return None
+        value = self.store.get(key + ('page',) + parts)
+        if value is None:
+            return None
+        content_type, text, mtimes = value
+        if self.templates.changed(mtimes):
+            return None
+        return content_type, text
+
+    def set_page(self, classname, parts, content_type, text):
+        '''Store the page, rendered with the templates given to
+        add_sources().
+        '''
+        key = self.key(classname)
+        if key is not None:
+            mtimes = self.templates.mtimes(self.sources.keys())
+            self.store.set(key + ('page',) + parts,
+                (content_type, text, mtimes))
+
+    def add_sources(self, source_files):
+        '''Note the source files of templates rendered.
+        '''
+        for source_file in source_files:
+            self.sources[source_file] = 1
+
+    def fragments(self, classname):
+        '''Return the cache of the tal:cache fragments of the templates
+        rendered about the class, or None.
+        '''
+        key = self.key(classname)
+        if key is None:
+            return None
+        return FragmentCache(self.store, key + ('fragment',), self.templates)
+
+class FragmentCache:
+    '''The cache of the tal:cache fragments as given to the
+    TALInterpreter, whose keys are prefixed with "key".
+
+    The fragments are stored with the modification times of the source
+    files of the templates they're rendered with, and not used once
+    those change (if "templates", the templating.Templates, is given).
+    '''
+    def __init__(self, store, key, templates=None):
+        self.store = store
+        self.key = key
+        self.templates = templates
+
+    def get(self, key):
+        '''Return the (text, source files) of the fragment, or None.
+        '''
+        value = self.store.get(self.key + key)
+        if value is None:
+            return None
+        text, mtimes = value
+        if self.templates is not None and self.templates.changed(mtimes):
+            return None
+        return text, [source_file for source_file, mtime in mtimes]
+
+    def set(self, key, text, source_files):
+        if self.templates is not None:
+            mtimes = self.templates.mtimes(source_files)
+        else:
+            mtimes = tuple([(source_file, None)
+                for source_file in source_files if source_file is not None])
+        self.store.set(self.key + key, (text, mtimes))
+
+# vim: set et sts=4 sw=4 :
@@ -10,7 +10,7 @@ import Cookie, socket, errno
 from Cookie import CookieError, BaseCookie, SimpleCookie
 
 from roundup import roundupdb, date, hyperdb, password
-from roundup.cgi import templating, cgitb, TranslationService
+from roundup.cgi import templating, cgitb, TranslationService, cache
 from roundup.cgi.actions import *
 from roundup.exceptions import *
 from roundup.cgi.exceptions import *
@@ -163,6 +163,12 @@ class Client:
         errno.ETIMEDOUT,
     )
 
+    # the size of the pieces files are read and sent in by _serve_file()
+    FILE_CHUNK_SIZE = 65536
+
+    # the "Range" header of a request for a single range of bytes
+    RANGE_RE = re.compile(r'^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$', re.I)
+
     def __init__(self, instance, request, env, form=None, translator=None):
         # re-seed the random number generator
         random.seed()
@@ -227,6 +233,14 @@ class Client:
         self.classname = None
         self.template = None
 
+        # the template file lookups made for this request (see
+        # templating.find_template)
+        self.template_lookups = {}
+
+        # the cache of the pages and template fragments rendered, if the
+        # tracker has one (see renderContext)
+        self.output_cache = None
+
     def setTranslator(self, translator=None):
         """Replace the translation engine
 
@@ -716,10 +730,21 @@ class Client:
                 "this file.")
 
         mime_type = klass.get(nodeid, 'type')
-        content = klass.get(nodeid, 'content')
         lmt = klass.get(nodeid, 'activity').timestamp()
 
-        self._serve_file(lmt, mime_type, content)
+        # send the file holding the content if there's one, rather than
+        # reading it all into memory
+        filename = None
+        if hasattr(klass, 'content_filename'):
+            try:
+                filename = klass.content_filename(nodeid)
+            except IOError:
+                # let get() report the problem
+                pass
+        if filename is None:
+            self._serve_file(lmt, mime_type, klass.get(nodeid, 'content'))
+        else:
+            self._serve_file(lmt, mime_type, filename=filename)
 
     def serve_static_file(self, file):
         ''' Serve up the file named from the templates dir
@@ -750,45 +775,135 @@ class Client:
             else:
                 mime_type = 'text/plain'
 
-        # snarf the content
-        f = open(filename, 'rb')
-        try:
-            content = f.read()
-        finally:
-            f.close()
+        self._serve_file(lmt, mime_type, filename=filename)
 
-        self._serve_file(lmt, mime_type, content)
+    def _serve_file(self, lmt, mime_type, content=None, filename=None):
+        ''' guts of serve_file() and serve_static_file(): send the content,
+            or that of the named file, read and sent a piece at a time
 
-    def _serve_file(self, lmt, mime_type, content):
-        ''' guts of serve_file() and serve_static_file()
+            Conditional requests (If-None-Match and If-Modified-Since)
+            and requests for a single range of bytes are handled.
         '''
+        if filename is not None:
+            size = os.stat(filename)[stat.ST_SIZE]
+        else:
+            size = len(content)
+        last_modified = rfc822.formatdate(lmt)
+        etag = '"%x-%x"'%(int(lmt), size)
+
         # spit out headers
         self.additional_headers['Content-Type'] = mime_type
-        self.additional_headers['Content-Length'] = str(len(content))
-        self.additional_headers['Last-Modified'] = rfc822.formatdate(lmt)
-
-        ims = None
-        # see if there's an if-modified-since...
-        # XXX see which interfaces set this
-        #if hasattr(self.request, 'headers'):
-            #ims = self.request.headers.getheader('if-modified-since')
-        if self.env.has_key('HTTP_IF_MODIFIED_SINCE'):
-            # cgi will put the header in the env var
-            ims = self.env['HTTP_IF_MODIFIED_SINCE']
-        if ims:
-            ims = rfc822.parsedate(ims)[:6]
-            lmtt = time.gmtime(lmt)[:6]
-            if lmtt <= ims:
+        self.additional_headers['Last-Modified'] = last_modified
+        self.additional_headers['ETag'] = etag
+        self.additional_headers['Accept-Ranges'] = 'bytes'
+
+        # the ETag the client has takes precedence over its date
+        inm = self.env.get('HTTP_IF_NONE_MATCH')
+        if inm:
+            tags = [tag.strip() for tag in inm.split(',')]
+            if etag in tags or '*' in tags:
                 raise NotModified
+        else:
+            ims = None
+            # see if there's an if-modified-since...
+            if self.env.has_key('HTTP_IF_MODIFIED_SINCE'):
+                # cgi will put the header in the env var
+                ims = self.env['HTTP_IF_MODIFIED_SINCE']
+            if ims:
+                ims = rfc822.parsedate(ims)
+                lmtt = time.gmtime(lmt)[:6]
+                if ims and lmtt <= ims[:6]:
+                    raise NotModified
+
+        # only send part of the file if asked to, and the client's copy
+        # of the rest (if it says which) is current
+        first, last = 0, size - 1
+        if_range = self.env.get('HTTP_IF_RANGE')
+        if not if_range or if_range.strip() in (etag, last_modified):
+            part = self._content_range(size)
+            if part is not None:
+                first, last = part
+                if first > last:
+                    # none of it
+                    self.response_code = 416
+                    self.additional_headers['Content-Range'] = \
+                        'bytes */%d'%size
+                    self.additional_headers['Content-Length'] = '0'
+                    self.header()
+                    return
+                self.response_code = 206
+                self.additional_headers['Content-Range'] = \
+                    'bytes %d-%d/%d'%(first, last, size)
+        length = last - first + 1
+        self.additional_headers['Content-Length'] = str(length)
+
+        if filename is None:
+            self.write(content[first:last + 1])
+            return
+
+        self.header()
+        if self.env['REQUEST_METHOD'] == 'HEAD':
+            # client doesn't care about content
+            return
+        f = open(filename, 'rb')
+        f.seek(first)
+        if hasattr(self.request, 'write_file'):
+            # the request sends it (and closes the file) itself
+            self.request.write_file(f, length)
+            return
+        try:
+            while length > 0:
+                data = f.read(min(length, self.FILE_CHUNK_SIZE))
+                if not data:
+                    # the file has been truncated under us
+                    break
+                self._socket_op(self.request.wfile.write, data)
+                length -= len(data)
+        finally:
+            f.close()
+
+    def _content_range(self, size):
+        ''' Determine the range of bytes asked for by the "Range" header
+            of the request from a file of "size" bytes.
 
-        self.write(content)
+            Return the (first, last) byte positions (first is greater
+            than last if the range isn't satisfiable), or None for the
+            whole file (including when several ranges are asked for, or
+            the header isn't understood).
+        '''
+        m = self.RANGE_RE.match(self.env.get('HTTP_RANGE', ''))
+        if m is None:
+            return None
+        first, last = m.groups()
+        if first:
+            first = int(first)
+            if last:
+                last = int(last)
+                if last < first:
+                    return None
+                last = min(last, size - 1)
+            else:
+                last = size - 1
+        elif last:
+            # the final "last" bytes
+            first = max(size - int(last), 0)
+            last = size - 1
+        else:
+            return None
+        return (first, last)
 
     def renderContext(self):
         ''' Return a PageTemplate for the named page
         '''
         name = self.classname
         extension = self.template
-        pt = self.instance.templates.get(name, extension)
+        pt = self.instance.templates.get(name, extension,
+            self.template_lookups)
+
+        store = cache.get_store(self.instance.config)
+        if store is not None:
+            self.output_cache = cache.OutputCache(self, store)
+        page_key = self.page_cache_key(pt)
 
         # catch errors so we can handle PT rendering errors more nicely
         args = {
@@ -796,9 +911,19 @@ class Client:
             'error_message': self.error_message
         }
         try:
-            # let the template render figure stuff out
-            result = pt.render(self, None, None, **args)
-            self.additional_headers['Content-Type'] = pt.content_type
+            cached = None
+            if page_key is not None:
+                cached = self.output_cache.get_page(name, page_key)
+            if cached is None:
+                # let the template render figure stuff out
+                result = pt.render(self, None, None, **args)
+                content_type = pt.content_type
+                if page_key is not None:
+                    self.output_cache.set_page(name, page_key, content_type,
+                        result)
+            else:
+                content_type, result = cached
+            self.additional_headers['Content-Type'] = content_type
             if self.env.get('CGI_SHOW_TIMING', ''):
                 if self.env['CGI_SHOW_TIMING'].upper() == 'COMMENT':
                     timings = {'starttag': '<!-- ', 'endtag': ' -->'}
@@ -814,6 +939,13 @@ class Client:
                         " Loading items: %(get_items)f secs."
                         " Filtering: %(filtering)f secs."
                         "%(endtag)s\n") % timings
+                if self.output_cache is not None:
+                    store = self.output_cache.store
+                    timings.update(store.stats)
+                    timings['ratio'] = store.hit_ratio() * 100
+                    s += self._("%(starttag)sOutput cache hits: %(hits)d,"
+                        " misses %(misses)d (%(ratio).1f%% hits)."
+                        "%(endtag)s\n") % timings
                 s += '</body>'
                 result = result.replace('</body>', s)
             return result
@@ -825,6 +957,22 @@ class Client:
             # everything else
             return cgitb.pt_html(i18n=self.translator)
 
+    def page_cache_key(self, pt):
+        """Return what identifies the page rendered with the template among
+        those cached, or None if it mustn't be cached.
+
+        Only the pages rendered for the anonymous user (without messages)
+        in reply to GET requests are cached.
+        """
+        if self.output_cache is None or \
+                not self.instance.config.WEB_CACHE_PAGES:
+            return None
+        if self.user != 'anonymous' or self.response_code != 200 or \
+                self.ok_message or self.error_message or \
+                self.env.get('REQUEST_METHOD') not in ('GET', 'HEAD'):
+            return None
+        return (pt.id, self.path, self.env.get('QUERY_STRING', ''))
+
     # these are the actions that are available
     actions = (
         ('edit',        EditItemAction),
@@ -914,22 +1062,25 @@ class Client:
             self._socket_op(self.request.wfile.write, content)
 
     def write_html(self, content):
+        if self.charset != self.STORAGE_CHARSET:
+            # recode output
+            content = content.decode(self.STORAGE_CHARSET, 'replace')
+            content = content.encode(self.charset, 'xmlcharrefreplace')
+
         if not self.headers_done:
             # at this point, we are sure about Content-Type
             if not self.additional_headers.has_key('Content-Type'):
                 self.additional_headers['Content-Type'] = \
                     'text/html; charset=%s' % self.charset
+            # and the page is all there is to send, which lets the
+            # connection be kept open for the next request
+            self.additional_headers['Content-Length'] = str(len(content))
             self.header()
 
         if self.env['REQUEST_METHOD'] == 'HEAD':
             # client doesn't care about content
             return
 
-        if self.charset != self.STORAGE_CHARSET:
-            # recode output
-            content = content.decode(self.STORAGE_CHARSET, 'replace')
-            content = content.encode(self.charset, 'xmlcharrefreplace')
-
         # and write
         self._socket_op(self.request.wfile.write, content)
 
@@ -21,7 +21,7 @@ __docformat__ = 'restructuredtext'
 
 
 import sys, cgi, urllib, os, re, os.path, time, errno, mimetypes, csv
-import calendar, textwrap
+import calendar, textwrap, logging, marshal, md5, imp, tempfile
 
 from roundup import hyperdb, date, support
 from roundup import i18n
@@ -50,7 +50,7 @@ except ImportError:
 # bring in the templating support
 from roundup.cgi.PageTemplates import PageTemplate, GlobalTranslationService
 from roundup.cgi.PageTemplates.Expressions import getEngine
-from roundup.cgi.TAL import TALInterpreter
+from roundup.cgi.TAL import TALInterpreter, TALCompiler, TALDefs
 from roundup.cgi import TranslationService, ZTUtils
 
 ### i18n services
@@ -78,9 +78,24 @@ class Unauthorised(Exception):
             'items of class %(class)s') % {
             'action': self.action, 'class': self.klass}
 
-def find_template(dir, name, view):
+def find_template(dir, name, view, lookups=None):
     """ Find a template in the nominated dir
+
+        If a "lookups" dict is given, the results of earlier lookups
+        (including failed ones) are remembered in it.
     """
+    if lookups is not None:
+        key = (dir, name, view)
+        if not lookups.has_key(key):
+            try:
+                lookups[key] = find_template(dir, name, view)
+            except NoTemplate, error:
+                lookups[key] = error
+        result = lookups[key]
+        if isinstance(result, NoTemplate):
+            raise result
+        return result
+
     # find the source
     if view:
         filename = '%s.%s'%(name, view)
@@ -119,11 +134,137 @@ def find_template(dir, name, view):
         'with template "%s" (neither "%s" nor "%s")'%(name, view,
         filename, generic)
 
+def has_item_template(client, classname):
+    """ Determine whether the class has an item template of its own (not
+        the _generic one), ie. whether its items may be linked to.
+
+        The template lookups are remembered for the rest of the request
+        in the client's "template_lookups" (if it has them).
+    """
+    try:
+        template = find_template(client.db.config.TEMPLATES, classname,
+            'item', getattr(client, 'template_lookups', None))
+    except NoTemplate:
+        return 0
+    return not template[1].startswith('_generic')
+
+class TemplateCache:
+    """A directory of parsed (and compiled) templates, pickled, which
+    processes load rather than parse the template sources again.
+
+    Each template is kept in a file of its own, which is valid for the
+    path, modification time and size of the source, whether the template
+    is compiled, and the versions of the templating engine and Python.
+    The files are replaced atomically, so several processes may use the
+    directory. Their permissions follow the "umask" (of the tracker).
+
+    As loading a pickle may run arbitrary code, files which aren't owned
+    by the user of the process, or which anybody may write (or replace,
+    if the directory is writable by anybody), are ignored.
+    """
+    # change whenever what's cached (or how) changes
+    version = 2
+
+    def __init__(self, dir, umask=022):
+        self.dir = dir
+        self.umask = umask
+
+    def filename(self, src, compile):
+        name = md5.md5(repr((os.path.abspath(src), compile))).hexdigest()
+        return os.path.join(self.dir, name + '.pt')
+
+    def key(self, src, compile):
+        stat = os.stat(src)
+        return (self.version, TALDefs.TAL_VERSION, imp.get_magic(),
+            os.path.abspath(src), compile, stat[os.path.stat.ST_MTIME],
+            stat[os.path.stat.ST_SIZE])
+
+    def trusted(self, f):
+        """Return whether the open cache file "f" may be loaded.
+        """
+        if not hasattr(os, 'geteuid'):
+            # (eg. Windows)
+            return 1
+        stat = os.fstat(f.fileno())
+        if stat[os.path.stat.ST_UID] != os.geteuid():
+            return 0
+        if stat[os.path.stat.ST_MODE] & 002:
+            return 0
+        return not os.stat(self.dir)[os.path.stat.ST_MODE] & 002
+
+    def load(self, pt, src):
+        """Set up the template from the cache, return whether it was
+        there (and up to date).
+        """
+        try:
+            f = open(self.filename(src, pt.compile), 'rb')
+        except IOError:
+            return 0
+        try:
+            try:
+                if not self.trusted(f):
+                    logging.getLogger('roundup').warning('cached template '
+                        '%s not loaded: not owned by this user, or writable '
+                        'by anybody'%pt.id)
+                    return 0
+                if pickle.load(f) != self.key(src, pt.compile):
+                    return 0
+                state = pickle.load(f)
+            except Exception, message:
+                # (eg. pickled by another version of Roundup)
+                logging.getLogger('roundup').info('cached template %s '
+                    'not loaded: %s'%(pt.id, message))
+                return 0
+        finally:
+            f.close()
+        pt.pt_load(open(src).read(), state)
+        return 1
+
+    def save(self, pt, src):
+        """Store the (freshly parsed) template in the cache, if it has no
+        errors.
+        """
+        state = pt.pt_state()
+        if state is None:
+            return
+        filename = self.filename(src, pt.compile)
+        tmp = None
+        try:
+            if not os.path.isdir(self.dir):
+                os.makedirs(self.dir)
+            fd, tmp = tempfile.mkstemp('.tmp', '', self.dir)
+            f = os.fdopen(fd, 'wb')
+            try:
+                pickle.dump(self.key(src, pt.compile), f, 2)
+                pickle.dump(state, f, 2)
+            finally:
+                f.close()
+            # (mkstemp() makes the file private)
+            os.chmod(tmp, 0666 & ~self.umask)
+            try:
+                os.rename(tmp, filename)
+            except OSError:
+                # Windows won't replace a file
+                os.remove(filename)
+                os.rename(tmp, filename)
+        except Exception, message:
+            # (eg. expressions of a type that can't be pickled)
+            logging.getLogger('roundup').warning('template %s not '
+                'cached: %s'%(pt.id, message))
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+
 class Templates:
     templates = {}
 
-    def __init__(self, dir):
+    def __init__(self, dir, compile=0, cache_dir=None, umask=022):
         self.dir = dir
+        # compile the templates to Python code?
+        self.compile = compile
+        if cache_dir:
+            self.cache = TemplateCache(cache_dir, umask)
+        else:
+            self.cache = None
 
     def precompileTemplates(self):
         """ Go through a directory and precompile all the templates therein
@@ -150,7 +291,7 @@ class Templates:
             else:
                 self.get(filename, None)
 
-    def get(self, name, extension=None):
+    def get(self, name, extension=None, lookups=None):
         """ Interface to get a template, possibly loading a compiled template.
 
             "name" and "extension" indicate the template we're after, which in
@@ -159,6 +300,8 @@ class Templates:
 
             If the file "name.extension" doesn't exist, we look for
             "_generic.extension" as a fallback.
+
+            "lookups" is passed on to find_template().
         """
         # default the name to "home"
         if name is None:
@@ -168,7 +311,7 @@ class Templates:
             name, extension = name.split('.')
 
         # find the source
-        src, filename = find_template(self.dir, name, extension)
+        src, filename = find_template(self.dir, name, extension, lookups)
 
         # has it changed?
         try:
@@ -178,16 +321,22 @@ class Templates:
                 raise
 
         if self.templates.has_key(src) and \
-                stime <= self.templates[src].mtime:
+                stime <= self.templates[src].mtime and \
+                self.templates[src].compile == self.compile:
             # compiled template is up to date
             return self.templates[src]
 
         # compile the template
         self.templates[src] = pt = RoundupPageTemplate()
+        pt.compile = self.compile
+        pt.id = filename
         # use pt_edit so we can pass the content_type guess too
         content_type = mimetypes.guess_type(filename)[0] or 'text/html'
-        pt.pt_edit(open(src).read(), content_type)
-        pt.id = filename
+        pt.content_type = content_type
+        if self.cache is None or not self.cache.load(pt, src):
+            pt.pt_edit(open(src).read(), content_type)
+            if self.cache is not None:
+                self.cache.save(pt, src)
         pt.mtime = stime
         return pt
 
@@ -200,6 +349,41 @@ class Templates:
         except NoTemplate, message:
             raise KeyError, message
 
+    def mtimes(self, filenames):
+        """ Return the (file name, modification time) of the templates
+            loaded from the files, for changed().
+        """
+        result = []
+        for filename in filenames:
+            if filename is None:
+                continue
+            src = os.path.join(self.dir, filename)
+            if self.templates.has_key(src):
+                mtime = self.templates[src].mtime
+            else:
+                mtime = file_mtime(src)
+            result.append((filename, mtime))
+        result.sort()
+        return tuple(result)
+
+    def changed(self, mtimes):
+        """ Tell whether any of the template files listed by mtimes()
+            has changed since.
+        """
+        for filename, mtime in mtimes:
+            if file_mtime(os.path.join(self.dir, filename)) != mtime:
+                return 1
+        return 0
+
+def file_mtime(path):
+    """ Return the modification time of the file, or None if it doesn't
+        exist.
+    """
+    try:
+        return os.stat(path)[os.path.stat.ST_MTIME]
+    except os.error:
+        return None
+
 def context(client, template=None, classname=None, request=None):
     """Return the rendering context dictionary
 
@@ -301,6 +485,10 @@ class RoundupPageTemplate(PageTemplate.PageTemplate):
 
     """
 
+    # compile the cooked template to Python code?
+    compile = 0
+    _v_compiled = 0
+
     # 06-jun-2004 [als] i am not sure if this method is used yet
     def getContext(self, client, classname, request):
         return context(client, self, classname, request)
@@ -321,12 +509,81 @@ class RoundupPageTemplate(PageTemplate.PageTemplate):
         c = context(client, self, classname, request)
         c.update({'options': options})
 
+        # the cache of the tal:cache fragments
+        cache = None
+        if client.output_cache:
+            cache = client.output_cache.fragments(classname or
+                client.classname)
+
         # and go
         output = StringIO.StringIO()
-        TALInterpreter.TALInterpreter(self._v_program, self.macros,
-            getEngine().getContext(c), output, tal=1, strictinsert=0)()
+        if self._v_compiled:
+            interpreter = TALCompiler.CompiledTALInterpreter
+        else:
+            interpreter = TALInterpreter.TALInterpreter
+        engine_context = getEngine().getContext(c)
+        interpreter(self._v_program, self.macros, engine_context, output,
+            tal=1, strictinsert=0, cache=cache)()
+        if client.output_cache:
+            # (the page cached depends on the templates rendered)
+            client.output_cache.add_sources(
+                engine_context.source_files.keys())
         return output.getvalue()
 
+    def pt_source_file(self):
+        # (identifies the fragments cached, see TALInterpreter.do_cache_tal,
+        # and the template file they depend on, see Templates.mtimes())
+        return self.id
+
+    def _cook(self):
+        PageTemplate.PageTemplate._cook(self)
+        self._v_compiled = 0
+        if self.compile and not self._v_errors:
+            compiler = TALCompiler.TALCompiler('<compiled template %s>'%
+                self.id)
+            try:
+                self._v_program, self._v_macros = compiler.compile(
+                    self._v_program, self._v_macros)
+            except (SyntaxError, RuntimeError), message:
+                # (eg. nested too deeply for Python) it'll be interpreted
+                logging.getLogger('roundup').warning('template %s not '
+                    'compiled: %s'%(self.id, message))
+            else:
+                self._v_compiled = 1
+                self._v_linkage = compiler.linkage()
+
+    def pt_state(self):
+        """Return the result of parsing (and compiling) the template, for
+        pt_load() to set up the template from, or None if the template
+        has errors.
+        """
+        if not self._v_cooked:
+            self._cook()
+        if self._v_errors:
+            return None
+        linkage = None
+        if self._v_compiled:
+            code, constants, functions = self._v_linkage
+            linkage = (marshal.dumps(code), constants, functions)
+        return self._v_program, self._v_macros, self._v_warnings, linkage
+
+    def pt_load(self, text, state):
+        """Set up the template (with the "text" source) from the
+        pt_state() of another.
+        """
+        self._text = text
+        program, macros, warnings, linkage = state
+        if linkage is not None:
+            code, constants, functions = linkage
+            code = marshal.loads(code)
+            TALCompiler.link(code, constants, functions)
+            self._v_linkage = (code, constants, functions)
+        self._v_program, self._v_macros = program, macros
+        self._v_warnings = warnings
+        self._v_errors = ()
+        self._v_compiled = linkage is not None
+        self._v_cooked = 1
+
     def __repr__(self):
         return '<Roundup PageTemplate %r>'%self.id
 
@@ -600,13 +857,10 @@ class HTMLClass(HTMLInputMixin, HTMLPermissions):
         l.sort(sortfunc)
 
         # check perms
-        check = self._client.db.security.hasPermission
-        userid = self._client.userid
-
-        l = [HTMLItem(self._client, self._classname, id) for id in l
-            if check('View', userid, self._classname, itemid=id)]
+        l = self._client.db.security.filterPermitted('View',
+            self._client.userid, self._classname, l)
 
-        return l
+        return [HTMLItem(self._client, self._classname, id) for id in l]
 
     def csv(self):
         """ Return the items of this class as a chunk of CSV text.
@@ -646,13 +900,9 @@ class HTMLClass(HTMLInputMixin, HTMLPermissions):
             sort = request.sort
             group = request.group
 
-        check = self._db.security.hasPermission
-        userid = self._client.userid
-
-        l = [HTMLItem(self._client, self.classname, id)
-             for id in self._klass.filter(None, filterspec, sort, group)
-             if check('View', userid, self.classname, itemid=id)]
-        return l
+        l = self._db.security.filterPermitted('View', self._client.userid,
+            self.classname, self._klass.filter(None, filterspec, sort, group))
+        return [HTMLItem(self._client, self.classname, id) for id in l]
 
     def classhelp(self, properties=None, label=''"(list)", width='500',
             height='400', property='', form='itemSynopsis',
@@ -749,7 +999,8 @@ class HTMLClass(HTMLInputMixin, HTMLPermissions):
         req.update(kwargs)
 
         # new template, using the specified classname and request
-        pt = self._client.instance.templates.get(self.classname, name)
+        pt = self._client.instance.templates.get(self.classname, name,
+            getattr(self._client, 'template_lookups', None))
 
         # use our fabricated request
         args = {
@@ -883,14 +1134,7 @@ class _HTMLItem(HTMLInputMixin, HTMLPermissions):
             if (self._props.has_key(prop_n) and
                     isinstance(self._props[prop_n], hyperdb.Link)):
                 classname = self._props[prop_n].classname
-                try:
-                    template = find_template(self._db.config.TEMPLATES,
-                        classname, 'item')
-                    if template[1].startswith('_generic'):
-                        raise NoTemplate, 'not really...'
-                except NoTemplate:
-                    pass
-                else:
+                if has_item_template(self._client, classname):
                     id = self._klass.get(self._nodeid, prop_n, None)
                     current[prop_n] = '<a href="%s%s">%s</a>'%(
                         classname, id, current[prop_n])
@@ -900,6 +1144,36 @@ class _HTMLItem(HTMLInputMixin, HTMLPermissions):
         history.sort()
         history.reverse()
 
+        # fetch the users and linked items mentioned in the journal with
+        # one prefetch per class, rather than one by one below
+        linked = {}
+        for id, evt_date, user, action, args in history:
+            if dre.match(user):
+                linked.setdefault('user', {})[user] = 1
+            if type(args) != type({}):
+                continue
+            for k, value in args.items():
+                prop = self._props.get(k)
+                if not value or not isinstance(prop, (hyperdb.Link,
+                        hyperdb.Multilink)):
+                    continue
+                ids = linked.setdefault(prop.classname, {})
+                if isinstance(prop, hyperdb.Link):
+                    ids[value] = 1
+                    continue
+                for linkid in value:
+                    if isinstance(linkid, type(())):
+                        for linkid in linkid[1]:
+                            ids[linkid] = 1
+                    else:
+                        ids[linkid] = 1
+        for classname, ids in linked.items():
+            if self._db.classes.has_key(classname):
+                self._db.getclass(classname).prefetch(ids.keys())
+
+        # the (class, label property, hrefable) of each linked class
+        linkinfo = {}
+
         timezone = self._db.getUserTimezone()
         l = []
         comments = {}
@@ -943,22 +1217,21 @@ class _HTMLItem(HTMLInputMixin, HTMLPermissions):
                             isinstance(prop, hyperdb.Link)):
                         # figure what the link class is
                         classname = prop.classname
-                        try:
-                            linkcl = self._db.getclass(classname)
-                        except KeyError:
-                            labelprop = None
+                        if not linkinfo.has_key(classname):
+                            try:
+                                linkcl = self._db.getclass(classname)
+                            except KeyError:
+                                linkinfo[classname] = (None, None, 0)
+                            else:
+                                linkinfo[classname] = (linkcl,
+                                    linkcl.labelprop(1),
+                                    has_item_template(self._client,
+                                    classname))
+                        linkcl, labelprop, hrefable = linkinfo[classname]
+                        if linkcl is None:
                             comments[classname] = self._(
                                 "The linked class %(classname)s no longer exists"
                             ) % locals()
-                        labelprop = linkcl.labelprop(1)
-                        try:
-                            template = find_template(self._db.config.TEMPLATES,
-                                classname, 'item')
-                            if template[1].startswith('_generic'):
-                                raise NoTemplate, 'not really...'
-                            hrefable = 1
-                        except NoTemplate:
-                            hrefable = 0
 
                     if isinstance(prop, hyperdb.Multilink) and args[k]:
                         ml = []
@@ -1867,10 +2140,9 @@ class LinkHTMLProperty(HTMLProperty):
         else:
             sort_on = ('+', find_sort_key(linkcl))
 
-        options = [opt
-            for opt in linkcl.filter(None, conditions, sort_on, (None, None))
-            if self._db.security.hasPermission("View", self._client.userid,
-                linkcl.classname, itemid=opt)]
+        options = self._db.security.filterPermitted("View",
+            self._client.userid, linkcl.classname,
+            linkcl.filter(None, conditions, sort_on, (None, None)))
 
         # make sure we list the current value if it's retired
         if value and value not in options:
@@ -1942,12 +2214,10 @@ class MultilinkHTMLProperty(HTMLProperty):
 
     def viewableGenerator(self, values):
         """Used to iterate over only the View'able items in a class."""
-        check = self._db.security.hasPermission
-        userid = self._client.userid
         classname = self._prop.classname
-        for value in values:
-            if check('View', userid, classname, itemid=value):
-                yield HTMLItem(self._client, classname, value)
+        for value in self._db.security.filterPermitted('View',
+                self._client.userid, classname, values):
+            yield HTMLItem(self._client, classname, value)
 
     def __iter__(self):
         """ iterate and return a new HTMLItem
@@ -2053,10 +2323,9 @@ class MultilinkHTMLProperty(HTMLProperty):
         else:
             sort_on = ('+', find_sort_key(linkcl))
 
-        options = [opt
-            for opt in linkcl.filter(None, conditions, sort_on)
-            if self._db.security.hasPermission("View", self._client.userid,
-                linkcl.classname, itemid=opt)]
+        options = self._db.security.filterPermitted("View",
+            self._client.userid, linkcl.classname,
+            linkcl.filter(None, conditions, sort_on))
         height = height or min(len(options), 7)
         l = ['<select multiple name="%s" size="%s">'%(self._formname, height)]
         k = linkcl.labelprop(1)
@@ -2508,15 +2777,65 @@ function help_window(helpurl, width, height) {
         else:
             matches = None
 
-        # filter for visibility
-        check = self._client.db.security.hasPermission
+        security = self._client.db.security
         userid = self._client.userid
-        l = [id for id in klass.filter(matches, filterspec, sort, group)
-            if check('View', userid, self.classname, itemid=id)]
+        if klass.supports_limit and security.hasUncheckedPermission('View',
+                userid, self.classname):
+            # every item is visible, so let the database count the
+            # matches and only fetch the ids of the batches we display
+            l = FilterResult(klass, matches, filterspec, sort, group,
+                self.pagesize)
+        else:
+            # filter for visibility
+            l = security.filterPermitted('View', userid, self.classname,
+                klass.filter(matches, filterspec, sort, group))
+
+        # the displayed, grouped and sorted properties of the items in
+        # the batch are prefetched together
+        propnames = self.columns + [p for d, p in group + sort if p]
 
         # return the batch object, using IDs only
         return Batch(self.client, l, self.pagesize, self.startwith,
-            classname=self.classname)
+            classname=self.classname, propnames=propnames)
+
+class FilterResult:
+    """ The sorted list of ids of the items matching a filter.
+
+        Its length is determined by Class.filter_count() and the ids
+        are fetched a page at a time, when they are first accessed, so
+        that batching over a huge result doesn't load all of the ids.
+        Only useful if the class "supports_limit"; otherwise each page
+        would run the full filter again.
+    """
+    def __init__(self, klass, matches, filterspec, sort, group, pagesize):
+        self.klass = klass
+        self.matches = matches
+        self.filterspec = filterspec
+        self.sort = sort
+        self.group = group
+        # one extra id covers Batch probing for a next batch
+        self.pagesize = pagesize + 1
+        self.count = klass.filter_count(matches, filterspec)
+        self.offset = 0
+        self.ids = []
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index = index + self.count
+        if index < 0 or index >= self.count:
+            raise IndexError, index
+        if not self.offset <= index < self.offset + len(self.ids):
+            self.offset = index
+            self.ids = self.klass.filter(self.matches, self.filterspec,
+                self.sort, self.group, limit=self.pagesize, offset=index)
+        try:
+            return self.ids[index - self.offset]
+        except IndexError:
+            # items were retired since we counted them
+            raise IndexError, index
 
 # extend the standard ZTUtils Batch object to remove dependency on
 # Acquisition and add a couple of useful methods
@@ -2529,6 +2848,8 @@ class Batch(ZTUtils.Batch):
         ========= ========================================================
         sequence  a list of HTMLItems or item ids
         classname if sequence is a list of ids, this is the class of item
+        propnames if sequence is a list of ids, the (Link and Multilink)
+                  properties whose items are prefetched with the batch
         size      how big to make the sequence.
         start     where to start (0-indexed) in the sequence.
         end       where to end (0-indexed) in the sequence.
@@ -2545,11 +2866,13 @@ class Batch(ZTUtils.Batch):
         "sequence_length" is the length of the original, unbatched, sequence.
     """
     def __init__(self, client, sequence, size, start, end=0, orphan=0,
-            overlap=0, classname=None):
+            overlap=0, classname=None, propnames=[]):
         self.client = client
         self.last_index = self.last_item = None
         self.current_item = None
         self.classname = classname
+        self.propnames = propnames
+        self.prefetched = 0
         self.sequence_length = len(sequence)
         ZTUtils.Batch.__init__(self, sequence, size, start, end, orphan,
             overlap)
@@ -2571,11 +2894,23 @@ class Batch(ZTUtils.Batch):
 
         item = self._sequence[index + self.first]
         if self.classname:
+            # load all the items of this batch in one go
+            if not self.prefetched:
+                self.prefetch()
             # map the item ids to instances
             item = HTMLItem(self.client, self.classname, item)
         self.current_item = item
         return item
 
+    def prefetch(self):
+        """ Ask the database to load the items of this batch (and the
+            items they link to through "propnames") in bulk
+        """
+        self.prefetched = 1
+        klass = self.client.db.getclass(self.classname)
+        ids = [self._sequence[i] for i in range(self.first, self.end)]
+        klass.prefetch(ids, self.propnames)
+
     def propchanged(self, *properties):
         """ Detect if one of the properties marked as being a group
             property changed in the last iteration fetch
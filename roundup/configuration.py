@@ -295,6 +295,19 @@ class RunDetectorOption(Option):
         else:
             raise OptionValueError(self, value, self.class_description)
 
+class CacheStoreOption(Option):
+
+    """Where the web output is cached: nowhere, in memory or on disk"""
+
+    class_description = "Allowed values: none, memory, disk"
+
+    def str2value(self, value):
+        _val = value.lower()
+        if _val in ("none", "memory", "disk"):
+            return _val
+        else:
+            raise OptionValueError(self, value, self.class_description)
+
 class MailAddressOption(Option):
 
     """Email address
@@ -477,6 +490,19 @@ SETTINGS = (
             "for these files prior to the TEMPLATES directory\n"
             "specified above.  If this option is not set, all static\n"
             "files are taken from the TEMPLATES directory"),
+        (BooleanOption, "compile_templates", "no",
+            "Compile the HTML templates to Python code when they're\n"
+            "loaded, instead of interpreting them each time they're\n"
+            "rendered, which makes rendering faster."),
+        (NullableFilePathOption, "template_cache", "",
+            "Path to a directory where the HTML templates are cached\n"
+            "once parsed (and compiled), for the processes starting\n"
+            "later to load them from rather than parse them again.\n"
+            "Only the files written by the user running the tracker are\n"
+            "loaded, and none if anybody may write to the directory, so\n"
+            "it should belong to that user and not be shared with the\n"
+            "trackers of other users.\n"
+            "If this option is not set, templates aren't cached."),
         (MailAddressOption, "admin_email", "roundup-admin",
             "Email address that roundup will complain to"
             " if it runs into trouble."),
@@ -526,6 +552,14 @@ SETTINGS = (
             "stop-words (eg. A,AND,ARE,AS,AT,BE,BUT,BY, ...)"),
         (OctalNumberOption, "umask", "02",
             "Defines the file creation mode mask."),
+        (BooleanOption, "cache_schema", "no",
+            "Set up the schema, security settings and detectors only once\n"
+            "per process, for the first database opened, instead of for\n"
+            "each web request. Only applies when the tracker is opened\n"
+            "with optimization (as done by the roundup server and the\n"
+            "WSGI and mod_python handlers unless debugging).\n"
+            "The schema and detectors must not keep references to the\n"
+            "database they're set up with."),
     )),
     ("tracker", (
         (Option, "name", "Roundup issue tracker",
@@ -562,6 +596,24 @@ SETTINGS = (
             "Setting this option makes Roundup display error tracebacks\n"
             "in the user's browser rather than emailing them to the\n"
             "tracker admin."),
+        (CacheStoreOption, "cache", "none",
+            "Where the pages rendered for the anonymous user and the\n"
+            "template fragments marked with tal:cache are cached:\n"
+            "'memory' keeps the most recently used in each process,\n"
+            "'disk' keeps them in the cache_dir directory, shared by\n"
+            "the processes. 'none' disables the cache.\n"
+            "What's cached is used until the classes it's about change."),
+        (IntegerNumberOption, "cache_size", 1000,
+            "Maximum number of pages and fragments cached."),
+        (FilePathOption, "cache_dir", "db/cache",
+            "Directory of the 'disk' cache.\n"
+            "Empty it when the schema of the tracker changes.\n"
+            "The path may be either absolute or relative\n"
+            "to the directory containig this config file."),
+        (BooleanOption, "cache_pages", "yes",
+            "Whether whole pages rendered for the anonymous user are\n"
+            "cached (if the cache is enabled), in addition to the\n"
+            "template fragments marked with tal:cache."),
     )),
     ("rdbms", (
         (Option, 'name', 'roundup',
@@ -587,8 +639,24 @@ SETTINGS = (
         (NullableOption, 'read_default_group', 'roundup',
             "Name of the group to use in the MySQL defaults file (.my.cnf).\n"
             "Only used in MySQL connections."),
+        (IntegerNumberOption, 'cache_size', 100,
+            "Number of most recently used rows (of any class) kept\n"
+            "in memory by each database connection.\n"
+            "Also used by the SQLite backend."),
+        (IntegerNumberOption, 'pool_size', 5,
+            "Maximum number of idle database connections kept open\n"
+            "by each process (eg. the roundup server) to be reused\n"
+            "when the tracker database is next opened.\n"
+            "Set to 0 to open a new connection each time."),
+        (IntegerNumberOption, 'pool_min', 1,
+            "Number of idle database connections kept open however\n"
+            "long they are unused."),
+        (IntegerNumberOption, 'pool_idle_timeout', 600,
+            "Number of seconds after which idle database connections\n"
+            "(beyond pool_min) are closed."),
     ), "Settings in this section are used"
-        " by Postgresql and MySQL backends only"
+        " by Postgresql and MySQL backends only\n"
+        "(except cache_size, also used by the SQLite backend)"
     ),
     ("logging", (
         (FilePathOption, "config", "",
@@ -22,7 +22,7 @@
 __docformat__ = 'restructuredtext'
 
 # standard python modules
-import os, re, shutil, weakref
+import os, re, shutil, weakref, copy
 from sets import Set
 
 # roundup modules
@@ -597,7 +597,7 @@ All methods except __repr__ must be implemented by a concrete backend Database.
     BACKEND_MISSING_NUMBER = None
     BACKEND_MISSING_BOOLEAN = None
 
-    def __init__(self, config, journaltag=None):
+    def __init__(self, config, journaltag=None, cached_security=None):
         """Open a hyperdatabase given a specifier to some storage.
 
         The 'storagelocator' is obtained from config.DATABASE.
@@ -610,6 +610,10 @@ All methods except __repr__ must be implemented by a concrete backend Database.
         entries for any edits done on the database.  If 'journaltag' is
         None, the database is opened in read-only mode: the Class.create(),
         Class.set(), and Class.retire() methods are disabled.
+
+        If 'cached_security' is given, the database uses a copy of that
+        Security (see roundup.security.Security.bind()) instead of
+        setting up a new one.
         """
         raise NotImplementedError
 
@@ -684,6 +688,21 @@ All methods except __repr__ must be implemented by a concrete backend Database.
         '''
         raise NotImplementedError
 
+    def getnodes(self, classname, nodeids):
+        '''Get many nodes from the database at once.
+
+        Returns a dict mapping nodeid to node; ids that don't exist are
+        ignored. Backends that can load nodes in bulk should override
+        this.
+        '''
+        d = {}
+        for nodeid in nodeids:
+            try:
+                d[nodeid] = self.getnode(classname, nodeid)
+            except IndexError:
+                pass
+        return d
+
     def hasnode(self, classname, nodeid):
         '''Determine if the database has a given node.
         '''
@@ -722,6 +741,35 @@ All methods except __repr__ must be implemented by a concrete backend Database.
         '''
         raise NotImplementedError
 
+    def iterjournals(self, classname, nodeids=None, since=None):
+        ''' Generate the journal entries (as returned by getjournal()) of
+            the nodes of the class, or of the "nodeids" given, in order of
+            nodeid and date.
+
+            If "since" (a date.Date) is given only the entries made since
+            then are generated. Nodes that don't exist are skipped.
+
+            This implementation just calls getjournal() for each node;
+            backends may fetch the entries of many nodes at once.
+        '''
+        if nodeids is None:
+            nodeids = self.getclass(classname).getnodeids()
+        # XXX numeric ids
+        nodeids = dict([(int(nodeid), 1) for nodeid in nodeids]).keys()
+        nodeids.sort()
+        for nodeid in nodeids:
+            try:
+                journal = self.getjournal(classname, str(nodeid))
+            except IndexError:
+                continue
+            l = []
+            for entry in journal:
+                if since is None or entry[1] >= since:
+                    l.append((entry[1], len(l), entry))
+            l.sort()
+            for entry in l:
+                yield entry[2]
+
     def pack(self, pack_before):
         ''' pack the database
         '''
@@ -766,6 +814,11 @@ class Class:
         concrete backend Class.
     """
 
+    # set by backends that apply the "limit" and "offset" of filter()
+    # and count filter_count() in the database, rather than by slicing
+    # and counting the full result
+    supports_limit = 0
+
     def __init__(self, db, classname, **properties):
         """Create a new class with a given name and property specification.
 
@@ -798,6 +851,17 @@ class Class:
         '''
         return '<hyperdb.Class "%s">'%self.classname
 
+    def bind(self, db):
+        """Return a copy of this class for the database "db".
+
+        The copy shares the properties, auditors and reactors of this
+        class, so the schema and detectors needn't be set up again for
+        each database opened (see the "cache_schema" tracker option).
+        """
+        cl = copy.copy(self)
+        cl.db = weakref.proxy(db)
+        return cl
+
     # Editing nodes:
 
     def create(self, **propvalues):
@@ -831,6 +895,16 @@ class Class:
         """
         raise NotImplementedError
 
+    def prefetch(self, ids, propnames=[]):
+        '''Hint that the items with the given ids (and the items linked
+        from them through the Link/Multilink properties in 'propnames')
+        are about to be accessed.
+
+        Backends that can load items in bulk use this to avoid a
+        database round trip per item; the default does nothing.
+        '''
+        pass
+
     # not in spec
     def getnode(self, nodeid):
         ''' Return a convenience wrapper for the node.
@@ -1113,7 +1187,8 @@ class Class:
             sortattr.append(('+', 'id'))
         return sortattr
 
-    def filter(self, search_matches, filterspec, sort=[], group=[]):
+    def filter(self, search_matches, filterspec, sort=[], group=[],
+            limit=None, offset=None):
         """Return a list of the ids of the active nodes in this class that
         match the 'filter' spec, sorted by the group spec and then the
         sort spec.
@@ -1127,6 +1202,9 @@ class Class:
 
         "search_matches" is {nodeid: marker}
 
+        "limit" and "offset" select a slice of the sorted result: at
+        most "limit" ids, starting at index "offset".
+
         The filter must match all properties specificed. If the property
         value to match is a list:
 
@@ -1150,7 +1228,23 @@ class Class:
         sortattr = self._sortattr(sort = sort, group = group)
         proptree = self._proptree(filterspec, sortattr)
         proptree.search(search_matches)
-        return proptree.sort()
+        l = proptree.sort()
+        if limit is not None or offset:
+            offset = offset or 0
+            if limit is None:
+                l = l[offset:]
+            else:
+                l = l[offset:offset+limit]
+        return l
+
+    def filter_count(self, search_matches, filterspec):
+        """Return the number of active nodes in this class that match
+        the 'filter' spec; see filter() for the arguments.
+
+        Backends that can count the matches without fetching them all
+        should override this (and set "supports_limit").
+        """
+        return len(self.filter(search_matches, filterspec))
 
     def count(self):
         """Get the number of nodes in this class.
@@ -1296,6 +1390,14 @@ class FileClass:
         if not properties.has_key('content'):
             properties['content'] = String(indexme='yes')
 
+    def content_filename(self, nodeid):
+        ''' Return the name of the file holding the "content" property of
+            the node, to read it piecemeal (eg. to serve a large file).
+
+            Raise IOError if there's no such file.
+        '''
+        return self.db.filename(self.classname, nodeid)
+
     def export_propnames(self):
         ''' Don't export the "content" property
         '''
@@ -50,7 +50,9 @@ class Tracker:
         self.cgi_actions = {}
         self.templating_utils = {}
         self.load_interfaces()
-        self.templates = templating.Templates(self.config["TEMPLATES"])
+        self.templates = templating.Templates(self.config["TEMPLATES"],
+            self.config["COMPILE_TEMPLATES"], self.config["TEMPLATE_CACHE"],
+            self.config["UMASK"])
         self.backend = backends.get_backend(self.get_backend_name())
         if self.optimize:
             libdir = os.path.join(self.tracker_home, 'lib')
@@ -71,6 +73,9 @@ class Tracker:
             self.detectors = self.get_extensions('detectors')
             # db_open is set to True after first open()
             self.db_open = 0
+            # the (classes, security) set up by the first open() if the
+            # "cache_schema" option is set
+            self.cached_schema = None
             if libdir in sys.path:
                 sys.path.remove(libdir)
 
@@ -85,8 +90,10 @@ class Tracker:
         # load the database schema
         # we cannot skip this part even if self.optimize is set
         # because the schema has security settings that must be
-        # applied to each database instance
+        # applied to each database instance (unless they're cached)
         backend = self.backend
+        if self.optimize and self.cached_schema is not None:
+            return self.open_cached(name)
         vars = {
             'Class': backend.Class,
             'FileClass': backend.FileClass,
@@ -129,6 +136,21 @@ class Tracker:
         if not (self.optimize and self.db_open):
             db.post_init()
             self.db_open = 1
+        if self.optimize and self.config.CACHE_SCHEMA:
+            # keep pristine copies: the classes of this database may be
+            # modified while it's used (eg. journalling disabled)
+            classes = [cl.bind(db) for cl in db.classes.values()]
+            self.cached_schema = (classes, db.security.bind(db))
+        return db
+
+    def open_cached(self, name=None):
+        """Open the database with the schema, security settings and
+        detectors set up by the first open().
+        """
+        classes, security = self.cached_schema
+        db = self.backend.Database(self.config, name, cached_security=security)
+        for cl in classes:
+            db.classes[cl.classname] = cl.bind(db)
         return db
 
     def load_interfaces(self):
@@ -242,7 +264,9 @@ class OldStyleTrackers:
         tracker.dbinit.config = tracker.config
 
         tracker.optimize = optimize
-        tracker.templates = templating.Templates(tracker.config["TEMPLATES"])
+        tracker.templates = templating.Templates(tracker.config["TEMPLATES"],
+            tracker.config["COMPILE_TEMPLATES"],
+            tracker.config["TEMPLATE_CACHE"], tracker.config["UMASK"])
         if optimize:
             tracker.templates.precompileTemplates()
 
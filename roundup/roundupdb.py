@@ -22,7 +22,7 @@ from __future__ import nested_scopes
 """
 __docformat__ = 'restructuredtext'
 
-import re, os, smtplib, socket, time, random
+import re, os, smtplib, socket, time, random, errno, tempfile
 import cStringIO, base64, quopri, mimetypes
 import os.path
 
@@ -86,6 +86,87 @@ class Database:
             timezone = self.config['TIMEZONE']
         return timezone
 
+    #
+    # Change stamps
+    #
+    # Each class has a change stamp, renewed whenever a transaction changing
+    # the class (its items or their journals) is committed, by any process.
+    # They're kept in the "changes" directory of the database, a file per
+    # class, and read once per transaction. What's derived from a class (eg.
+    # the web pages cached, see roundup.cgi.cache) may be keyed on its stamp.
+    #
+    # The backends' __init__() sets "changed_classes" and "change_stamps"
+    # to empty dicts, their addnode(), setnode(), destroynode(), etc. call
+    # noteChange(), and their commit() calls renewChangeStamps().
+    #
+    def noteChange(self, classname):
+        """Note that the current transaction changes the class.
+        """
+        self.changed_classes[classname] = 1
+
+    def hasChanges(self):
+        """Determine whether the current transaction changes any class.
+        """
+        return len(self.changed_classes) > 0
+
+    def getChangeStamp(self, classname):
+        """Return the change stamp of the class, a string ("0" if the class
+        has never been changed).
+        """
+        stamp = self.change_stamps.get(classname)
+        if stamp is None:
+            try:
+                f = open(os.path.join(self.dir, 'changes', classname))
+            except IOError, error:
+                if error.errno != errno.ENOENT:
+                    raise
+                stamp = '0'
+            else:
+                try:
+                    stamp = f.read()
+                finally:
+                    f.close()
+            self.change_stamps[classname] = stamp
+        return stamp
+
+    def renewChangeStamps(self):
+        """Renew the change stamps of the classes changed by the transaction
+        just committed.
+        """
+        self.change_stamps = {}
+        changed = self.changed_classes.keys()
+        if not changed:
+            return
+        self.changed_classes = {}
+        dir = os.path.join(self.dir, 'changes')
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+        # unique, so that no stamp is ever renewed to a value it had
+        stamp = '%f-%d-%d'%(time.time(), os.getpid(),
+            random.randrange(1<<30))
+        for classname in changed:
+            fd, tmp = tempfile.mkstemp('.tmp', classname, dir)
+            try:
+                os.write(fd, stamp)
+            finally:
+                os.close(fd)
+            # (mkstemp() makes the file private, and the other interfaces
+            # may run as another user)
+            os.chmod(tmp, 0666 & ~self.config.UMASK)
+            filename = os.path.join(dir, classname)
+            try:
+                os.rename(tmp, filename)
+            except OSError:
+                # Windows won't replace a file
+                os.remove(filename)
+                os.rename(tmp, filename)
+
+    def forgetChanges(self):
+        """Forget the classes changed by the transaction rolled back.
+        """
+        self.changed_classes = {}
+        self.change_stamps = {}
+
     def confirm_registration(self, otk):
         props = self.getOTKManager().getall(otk)
         for propname, proptype in self.user.getprops().items():
@@ -21,8 +21,9 @@ $Id: roundup_server.py,v 1.94 2007/09/25 04:27:12 jpend Exp $
 """
 __docformat__ = 'restructuredtext'
 
-import errno, cgi, getopt, os, socket, sys, traceback, urllib, time
-import ConfigParser, BaseHTTPServer, SocketServer, StringIO
+import errno, cgi, getopt, os, re, signal, socket, sys, traceback, urllib
+import time, ConfigParser, BaseHTTPServer, SocketServer, StringIO
+import asyncore, asynchat
 
 try:
     from OpenSSL import SSL
@@ -35,6 +36,7 @@ from roundup import __version__ as roundup_version
 
 # Roundup modules of use here
 from roundup.cgi import cgitb, client
+from roundup.backends import connpool
 from roundup.cgi.PageTemplates.PageTemplate import PageTemplate
 import roundup.instance
 from roundup.i18n import _
@@ -63,12 +65,15 @@ DEFAULT_PORT = 8080
 # "debug" means "none" + no tracker/template cache
 MULTIPROCESS_TYPES = ["debug", "none"]
 try:
-    import thread
+    import thread, threading, Queue
 except ImportError:
     pass
 else:
     MULTIPROCESS_TYPES.append("thread")
+    if hasattr(asyncore, 'file_dispatcher'):
+        MULTIPROCESS_TYPES.append("async")
 if hasattr(os, 'fork'):
+    MULTIPROCESS_TYPES.append("prefork")
     MULTIPROCESS_TYPES.append("fork")
 DEFAULT_MULTIPROCESS = MULTIPROCESS_TYPES[-1]
 
@@ -122,13 +127,15 @@ class SecureHTTPServer(BaseHTTPServer.HTTPServer):
 
                 def readline(self, *args):
                     """ SSL.Connection can return WantRead """
-                    line = None
-                    while not line:
+                    while 1:
                         try:
-                            line = self.__fileobj.readline(*args)
+                            return self.__fileobj.readline(*args)
                         except SSL.WantReadError:
-                            line = None
-                    return line
+                            pass
+                        except SSL.ZeroReturnError:
+                            # the client closed the connection (eg. a
+                            # persistent one, between requests)
+                            return ''
 
                 def __getattr__(self, attrib):
                     return getattr(self.__fileobj, attrib)
@@ -148,6 +155,457 @@ class SecureHTTPServer(BaseHTTPServer.HTTPServer):
             conn = ConnFixer(conn)
         return (conn, info)
 
+class PreforkingMixIn:
+    """Mix-in class to handle the requests in a pool of long-lived
+    worker processes forked at startup, which accept the connections
+    on the shared listening socket.
+
+    The server process itself only replaces the workers as they exit:
+    after "max_requests" requests (unless 0) a worker exits so that a
+    fresh one is forked. On SIGHUP the server calls reload() and tells
+    the current workers to exit once they're done with the request at
+    hand, forking new ones. On SIGTERM (or KeyboardInterrupt) it stops
+    the workers in the same way and returns.
+    """
+    workers = 4
+    max_requests = 1000
+    # seconds after which a worker waiting for a request wakes up to see
+    # whether it's been told to stop
+    timeout = 1
+
+    def reload(self):
+        """Called in the server process on SIGHUP before the new workers
+        are forked.
+        """
+        pass
+
+    def serve_forever(self):
+        # worker process ids, and those of the ones told to stop
+        self.children = {}
+        self.stopped = {}
+        self.running = 1
+        self.reloading = 0
+        signal.signal(signal.SIGHUP, self.handle_hangup)
+        signal.signal(signal.SIGTERM, self.handle_terminate)
+        try:
+            while self.running:
+                if self.reloading:
+                    self.reloading = 0
+                    self.stop_workers()
+                    self.reload()
+                while len(self.children) < self.workers:
+                    self.fork_worker()
+                try:
+                    pid, status = os.waitpid(-1, 0)
+                except OSError, error:
+                    if error.errno != errno.EINTR:
+                        raise
+                    continue
+                if self.children.has_key(pid):
+                    del self.children[pid]
+                    if status:
+                        # don't fork workers failing at once too eagerly
+                        time.sleep(1)
+                elif self.stopped.has_key(pid):
+                    del self.stopped[pid]
+        finally:
+            self.stop_workers()
+            while self.stopped:
+                try:
+                    pid, status = os.waitpid(-1, 0)
+                except OSError, error:
+                    if error.errno == errno.EINTR:
+                        continue
+                    if error.errno != errno.ECHILD:
+                        raise
+                    break
+                if self.stopped.has_key(pid):
+                    del self.stopped[pid]
+
+    def handle_hangup(self, signum, frame):
+        self.reloading = 1
+
+    def handle_terminate(self, signum, frame):
+        self.running = 0
+
+    def stop_workers(self):
+        for pid in self.children.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                # already gone
+                pass
+            self.stopped[pid] = 1
+        self.children = {}
+
+    def fork_worker(self):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = 1
+            return
+        # we're the worker: handle requests until told to stop
+        status = 0
+        try:
+            try:
+                self.serve_requests()
+            except:
+                traceback.print_exc()
+                status = 1
+        finally:
+            # close this worker's idle database connections before going
+            connpool.clear_pools()
+            os._exit(status)
+
+    def serve_requests(self):
+        """Handle at most "max_requests" requests in a worker process.
+        """
+        self.stopping = 0
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        self.handled = 0
+        while not self.stopping:
+            if self.max_requests and self.handled >= self.max_requests:
+                break
+            self.handle_request()
+
+    def handle_stop(self, signum, frame):
+        # the request at hand, if any, is finished first
+        self.stopping = 1
+
+    def process_request(self, request, client_address):
+        self.handled += 1
+        SocketServer.BaseServer.process_request(self, request,
+            client_address)
+
+if hasattr(asyncore, 'file_dispatcher'):
+    class Trigger(asyncore.file_dispatcher):
+        """Lets other threads have functions called by the asyncore loop,
+        waking it up through a pipe.
+        """
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.calls = []
+            self.reader, self.writer = os.pipe()
+            asyncore.file_dispatcher.__init__(self, self.reader)
+
+        def call(self, function, *args):
+            self.lock.acquire()
+            try:
+                self.calls.append((function, args))
+            finally:
+                self.lock.release()
+            os.write(self.writer, 'x')
+
+        def writable(self):
+            return 0
+
+        def handle_read(self):
+            try:
+                self.recv(8192)
+            except (OSError, socket.error):
+                pass
+            self.lock.acquire()
+            try:
+                calls = self.calls
+                self.calls = []
+            finally:
+                self.lock.release()
+            for function, args in calls:
+                try:
+                    function(*args)
+                except:
+                    traceback.print_exc()
+else:
+    Trigger = None
+
+class AsyncChannel(asynchat.async_chat):
+    """A client connection of the AsyncHTTPServer.
+
+    The requests are read (headers, then body) and the responses sent
+    without blocking, so a slow client holds no thread. Each complete
+    request is handed to the server's worker threads, one at a time.
+    """
+    # the most we'll read of request headers
+    max_headers = 65536
+
+    def __init__(self, server, sock, addr):
+        asynchat.async_chat.__init__(self, sock)
+        self.server = server
+        self.addr = addr
+        self.data = []
+        self.size = 0
+        self.headers = None
+        # the requests read but not handled yet (pipelined ones), and
+        # whether one is being handled
+        self.pending = []
+        self.busy = 0
+        self.request_count = 0
+        self.last_activity = time.time()
+        self.set_terminator('\r\n\r\n')
+
+    content_length_re = re.compile(r'^content-length:[ \t]*(\d+)',
+        re.I | re.M)
+    expect_continue_re = re.compile(r'^expect:[ \t]*100-continue',
+        re.I | re.M)
+
+    def collect_incoming_data(self, data):
+        self.data.append(data)
+        self.size += len(data)
+        self.last_activity = time.time()
+        if self.headers is None and self.size > self.max_headers:
+            self.close()
+
+    def found_terminator(self):
+        data = ''.join(self.data)
+        self.data = []
+        self.size = 0
+        if self.headers is not None:
+            # that's the body
+            request = self.headers + data
+            self.headers = None
+            self.set_terminator('\r\n\r\n')
+            self.queue(request)
+            return
+        # there may be blank lines before the request line
+        headers = data.lstrip('\r\n')
+        if not headers:
+            return
+        headers += '\r\n\r\n'
+        m = self.content_length_re.search(headers)
+        if m is None or not int(m.group(1)):
+            self.queue(headers)
+            return
+        # read the body first
+        self.headers = headers
+        self.set_terminator(int(m.group(1)))
+        if (self.expect_continue_re.search(headers) and
+                headers.split('\r\n', 1)[0].endswith('HTTP/1.1')):
+            self.push('HTTP/1.1 100 Continue\r\n\r\n')
+
+    def queue(self, request):
+        if self.busy:
+            self.pending.append(request)
+        else:
+            self.busy = 1
+            self.server.requests.put((self, request))
+
+    def request_done(self, close, request_count):
+        """Called (in the asyncore loop) once a request is handled and
+        its response pushed.
+        """
+        if not self.busy:
+            return
+        self.busy = 0
+        self.request_count = request_count
+        self.last_activity = time.time()
+        if close:
+            self.pending = []
+            self.close_when_done()
+        elif self.pending:
+            self.queue(self.pending.pop(0))
+
+    def readable(self):
+        # don't read further requests while one is being handled
+        return not self.busy and not self.pending and \
+            asynchat.async_chat.readable(self)
+
+    def idle(self):
+        """Determine whether we're waiting for the client to make a
+        request.
+        """
+        return not self.busy and not self.writable()
+
+    def handle_error(self):
+        if sys.exc_info()[0] is not socket.error:
+            traceback.print_exc()
+        self.close()
+
+class ChannelWriter:
+    """File-like object a worker thread writes a response to, pushed to
+    the channel (to be sent by the asyncore loop) when flushed.
+    """
+    closed = 0
+    # how much is buffered before it's pushed
+    bufsize = 65536
+
+    def __init__(self, channel, trigger):
+        self.channel = channel
+        self.trigger = trigger
+        self.data = []
+        self.size = 0
+
+    def write(self, data):
+        self.data.append(data)
+        self.size += len(data)
+        if self.size >= self.bufsize:
+            self.flush()
+
+    def flush(self):
+        if self.data:
+            self.trigger.call(self.channel.push, ''.join(self.data))
+            self.data = []
+            self.size = 0
+
+class FileProducer:
+    """Producer (for an AsyncChannel) of "length" bytes read a piece at
+    a time from the file, which is closed at the end.
+    """
+    bufsize = 65536
+
+    def __init__(self, file, length):
+        self.file = file
+        self.remaining = length
+
+    def more(self):
+        data = ''
+        if self.remaining > 0:
+            data = self.file.read(min(self.remaining, self.bufsize))
+            self.remaining -= len(data)
+        if not data:
+            self.remaining = 0
+            self.file.close()
+        return data
+
+class AsyncRequestHandler:
+    """Mix-in class for the RoundupRequestHandler to handle a request
+    already read by an AsyncChannel.
+    """
+    def setup(self):
+        self.channel, data = self.request
+        self.rfile = StringIO.StringIO(data)
+        self.wfile = ChannelWriter(self.channel, self.server.trigger)
+
+    def handle(self):
+        self.request_count = self.channel.request_count
+        self.waiting = 0
+        self.close_connection = 1
+        self.handle_one_request()
+
+    def write_file(self, file, length):
+        """Send "length" bytes of the file (from its current position) as
+        the client takes them, rather than reading it all in this thread.
+        """
+        self.wfile.flush()
+        self.server.trigger.call(self.channel.push_with_producer,
+            FileProducer(file, length))
+
+    def finish(self):
+        self.wfile.flush()
+        self.server.trigger.call(self.channel.request_done,
+            self.close_connection, self.request_count)
+
+class AsyncHTTPServer(asyncore.dispatcher):
+    """HTTP server reading the requests and sending the responses of all
+    its connections in a single thread (with asyncore), while the
+    requests themselves are handled in a fixed number of worker threads.
+
+    The RequestHandlerClass must derive from AsyncRequestHandler.
+    Connections idle for more than its KEEPALIVE_TIMEOUT are closed.
+    """
+    workers = 4
+
+    def __init__(self, server_address, RequestHandlerClass):
+        asyncore.dispatcher.__init__(self)
+        self.RequestHandlerClass = RequestHandlerClass
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(server_address)
+        host, port = self.socket.getsockname()[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.listen(socket.SOMAXCONN)
+        self.requests = Queue.Queue()
+        self.trigger = Trigger()
+
+    def handle_accept(self):
+        try:
+            pair = self.accept()
+        except socket.error:
+            return
+        if pair is None:
+            return
+        sock, addr = pair
+        AsyncChannel(self, sock, addr)
+
+    def writable(self):
+        return 0
+
+    def serve_forever(self):
+        for i in range(self.workers):
+            worker = threading.Thread(target=self.work)
+            worker.setDaemon(1)
+            worker.start()
+        timeout = self.RequestHandlerClass.KEEPALIVE_TIMEOUT or 60
+        while 1:
+            asyncore.poll(1.0)
+            # close the connections left idle
+            now = time.time()
+            for channel in asyncore.socket_map.values():
+                if (isinstance(channel, AsyncChannel) and channel.idle()
+                        and now - channel.last_activity > timeout):
+                    channel.close()
+
+    def work(self):
+        """Handle the requests read by the channels (in a worker thread).
+        """
+        while 1:
+            channel, request = self.requests.get()
+            try:
+                self.RequestHandlerClass((channel, request), channel.addr,
+                    self)
+            except:
+                traceback.print_exc()
+                self.trigger.call(channel.close)
+
+class RequestBody:
+    """The body of a request, read from the connection.
+
+    Reading stops at the end of the body (as given by its length) so the
+    next request on a persistent connection is left alone.
+    """
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if size <= 0:
+            return ''
+        data = self.rfile.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if size <= 0:
+            return ''
+        line = self.rfile.readline(size)
+        self.remaining -= len(line)
+        return line
+
+class ChunkedWriter:
+    """Write a response body of unknown length with the "chunked"
+    transfer coding of HTTP/1.1.
+    """
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, data):
+        # an empty chunk would end the body
+        if data:
+            self.wfile.write('%x\r\n%s\r\n'%(len(data), data))
+
+    def flush(self):
+        self.wfile.flush()
+
+    def close(self):
+        """Write the last chunk (this doesn't close the connection).
+        """
+        self.wfile.write('0\r\n\r\n')
+
 class RoundupRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     TRACKER_HOMES = {}
     TRACKERS = None
@@ -155,6 +613,103 @@ class RoundupRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     DEBUG_MODE = False
     CONFIG = None
 
+    # connections are kept open for further requests (HTTP/1.1) for at
+    # most KEEPALIVE_TIMEOUT idle seconds and KEEPALIVE_REQUESTS requests
+    protocol_version = "HTTP/1.1"
+    KEEPALIVE_TIMEOUT = 5
+    KEEPALIVE_REQUESTS = 100
+    # buffer the responses (they're flushed at the end of each request)
+    wbufsize = -1
+
+    def handle(self):
+        """Handle the requests made over the connection.
+        """
+        self.request_count = 0
+        self.request_timeout = self.connection.gettimeout()
+        self.waiting = 0
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection:
+            # wait for the next request, for a while only
+            self.waiting = 1
+            self.connection.settimeout(self.KEEPALIVE_TIMEOUT)
+            try:
+                self.handle_one_request()
+            except socket.timeout:
+                break
+
+    def handle_one_request(self):
+        self.body = None
+        self.chunked = 0
+        BaseHTTPServer.BaseHTTPRequestHandler.handle_one_request(self)
+        if self.chunked:
+            self.wfile.close()
+            self.wfile = self.wfile.wfile
+        if self.body is not None and self.body.remaining:
+            # the next request would be garbled by the rest of this body
+            self.close_connection = 1
+        if not self.wfile.closed:
+            self.wfile.flush()
+
+    def parse_request(self):
+        # we've got the request line: the request itself may take the
+        # usual time
+        if self.waiting:
+            self.waiting = 0
+            self.connection.settimeout(self.request_timeout)
+        if not BaseHTTPServer.BaseHTTPRequestHandler.parse_request(self):
+            return 0
+        self.request_count += 1
+        if self.request_count >= self.KEEPALIVE_REQUESTS:
+            self.close_connection = 1
+        if self.headers.getheader('transfer-encoding'):
+            # we can only tell where bodies end by their length
+            self.close_connection = 1
+        return 1
+
+    def send_response(self, code, message=None):
+        self.response_code = code
+        self.response_length = None
+        self.response_connection = None
+        BaseHTTPServer.BaseHTTPRequestHandler.send_response(self, code,
+            message)
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == 'content-length':
+            self.response_length = value
+        elif keyword.lower() == 'connection':
+            self.response_connection = value
+            if value.lower() == 'close':
+                self.close_connection = 1
+        BaseHTTPServer.BaseHTTPRequestHandler.send_header(self, keyword,
+            value)
+
+    def end_headers(self):
+        """Make sure the client can tell where the response ends: by its
+        length, the chunked transfer coding, or the connection closing.
+        """
+        if self.response_length is None and self.command != 'HEAD' \
+                and self.response_code >= 200 \
+                and self.response_code not in (204, 304) \
+                and not self.close_connection:
+            if self.request_version >= 'HTTP/1.1':
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.chunked = 1
+            else:
+                self.close_connection = 1
+        if self.close_connection and self.response_connection is None \
+                and self.request_version >= 'HTTP/1.1':
+            self.send_header('Connection', 'close')
+        BaseHTTPServer.BaseHTTPRequestHandler.end_headers(self)
+        if self.chunked:
+            self.wfile = ChunkedWriter(self.wfile)
+
+    def log_error(self, format, *args):
+        # persistent connections time out when idle, that's no error
+        if not self.waiting:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_error(self, format,
+                *args)
+
     def get_tracker(self, name):
         """Return a tracker instance for given tracker name"""
         # Note: try/except KeyError works faster that has_key() check
@@ -182,8 +737,12 @@ class RoundupRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         """ Execute the CGI command. Wrap an innner call in an error
             handler so all errors can be caught.
         """
-        save_stdin = sys.stdin
-        sys.stdin = self.rfile
+        try:
+            length = int(self.headers.getheader('content-length') or 0)
+        except ValueError:
+            length = 0
+            self.close_connection = 1
+        self.body = RequestBody(self.rfile, length)
         try:
             self.inner_run_cgi()
         except client.NotFound:
@@ -192,6 +751,8 @@ class RoundupRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             self.send_error(403, '%s (%s)'%(self.path, message))
         except:
             exc, val, tb = sys.exc_info()
+            # the response may have been cut short
+            self.close_connection = 1
             if hasattr(socket, 'timeout') and isinstance(val, socket.timeout):
                 self.log_error('timeout')
             else:
@@ -220,7 +781,6 @@ class RoundupRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                     # out to the logfile
                     print 'EXCEPTION AT', ts
                     traceback.print_exc()
-        sys.stdin = save_stdin
 
     do_GET = do_POST = do_HEAD = run_cgi
 
@@ -231,10 +791,11 @@ class RoundupRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         if len(keys) == 1:
             self.send_response(302)
             self.send_header('Location', urllib.quote(keys[0]) + '/index')
+            self.send_header('Content-Length', '0')
             self.end_headers()
-        else:
-            self.send_response(200)
+            return
 
+        self.send_response(200)
         self.send_header('Content-Type', 'text/html')
         self.end_headers()
         w = self.wfile.write
@@ -356,10 +917,19 @@ class RoundupRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         if os.environ.has_key('CGI_SHOW_TIMING'):
             env['CGI_SHOW_TIMING'] = os.environ['CGI_SHOW_TIMING']
         env['HTTP_ACCEPT_LANGUAGE'] = self.headers.get('accept-language')
+        # for conditional requests and requests for part of a file
+        for header in ('if-modified-since', 'if-none-match', 'if-range',
+                'range'):
+            value = self.headers.getheader(header)
+            if value:
+                env['HTTP_' + header.upper().replace('-', '_')] = value
 
         # do the roundup thing
         tracker = self.get_tracker(tracker_name)
-        tracker.Client(tracker, self, env).main()
+        # (the form is read from the request body here rather than from
+        # sys.stdin, which is shared by the threads)
+        form = cgi.FieldStorage(fp=self.body, environ=env)
+        tracker.Client(tracker, self, env, form).main()
 
     def address_string(self):
         if self.LOG_IPADDRESS:
@@ -489,6 +1059,28 @@ class ServerConfig(configuration.Config):
             (configuration.Option, "multiprocess", DEFAULT_MULTIPROCESS,
                 "Set processing of each request in separate subprocess.\n"
                 "Allowed values: %s." % ", ".join(MULTIPROCESS_TYPES)),
+            (configuration.IntegerNumberOption, "workers", "4",
+                "Number of worker processes handling the requests\n"
+                "in the \"prefork\" multiprocess mode, or of worker\n"
+                "threads in the \"async\" mode."),
+            (configuration.IntegerNumberOption, "max_requests", "1000",
+                "Number of requests handled by each worker process\n"
+                "in the \"prefork\" multiprocess mode before it is\n"
+                "replaced by a new one. Set to 0 for no limit."),
+            (configuration.IntegerNumberOption, "keepalive_timeout", "5",
+                "Number of seconds a connection is kept open waiting\n"
+                "for the client's next request (not in the \"none\"\n"
+                "and \"debug\" multiprocess modes, nor in the \"prefork\"\n"
+                "mode unless prefork_keepalive is set).\n"
+                "Set to 0 to close the connections after each request."),
+            (configuration.IntegerNumberOption, "keepalive_requests", "100",
+                "Number of requests handled over a connection\n"
+                "before it is closed."),
+            (configuration.BooleanOption, "prefork_keepalive", "no",
+                "Keep the connections open in the \"prefork\"\n"
+                "multiprocess mode too. Each idle connection then\n"
+                "holds a worker: a few clients may keep the others\n"
+                "waiting for up to keepalive_timeout seconds."),
             (configuration.NullableFilePathOption, "template", "",
                 "Tracker index template. If unset, built-in will be used."),
             (configuration.BooleanOption, "ssl", "no",
@@ -516,6 +1108,8 @@ class ServerConfig(configuration.Config):
         "nodaemon": "D",
         "log_hostnames": "N",
         "multiprocess": "t:",
+        "workers": "w:",
+        "max_requests": "r:",
         "template": "i:",
         "ssl": "s",
         "pem": "e:",
@@ -575,12 +1169,20 @@ class ServerConfig(configuration.Config):
                 for (name, home) in tracker_homes])
 
         # build customized request handler class
-        class RequestHandler(RoundupRequestHandler):
+        if self["MULTIPROCESS"] == "async" and Trigger is not None:
+            class BaseRequestHandler(AsyncRequestHandler,
+                    RoundupRequestHandler):
+                pass
+        else:
+            BaseRequestHandler = RoundupRequestHandler
+        class RequestHandler(BaseRequestHandler):
             LOG_IPADDRESS = not self["LOG_HOSTNAMES"]
             TRACKER_HOMES = dict(tracker_homes)
             TRACKERS = trackers
             DEBUG_MODE = self["MULTIPROCESS"] == "debug"
             CONFIG = self
+            KEEPALIVE_TIMEOUT = self["KEEPALIVE_TIMEOUT"]
+            KEEPALIVE_REQUESTS = self["KEEPALIVE_REQUESTS"]
 
         if self["SSL"]:
             base_server = SecureHTTPServer
@@ -598,6 +1200,30 @@ class ServerConfig(configuration.Config):
                 base_server):
                     pass
             server_class = ForkingServer
+        elif self["MULTIPROCESS"] == "prefork":
+            class PreforkingServer(PreforkingMixIn, base_server):
+                workers = self["WORKERS"]
+                max_requests = self["MAX_REQUESTS"]
+                def reload(server):
+                    # open the trackers again for the new workers,
+                    # keeping the old ones if that fails
+                    try:
+                        reopened = [(name,
+                            roundup.instance.open(home, optimize=1))
+                            for (name, home) in tracker_homes]
+                    except:
+                        print _('Unable to reload the trackers:')
+                        traceback.print_exc()
+                        return
+                    trackers.update(dict(reopened))
+            server_class = PreforkingServer
+        elif self["MULTIPROCESS"] == "async":
+            if self["SSL"]:
+                raise ValueError, _("SSL is not supported in the "
+                    "\"async\" multiprocess mode")
+            class AsyncServer(AsyncHTTPServer):
+                workers = self["WORKERS"]
+            server_class = AsyncServer
         elif self["MULTIPROCESS"] == "thread":
             class ThreadingServer(SocketServer.ThreadingMixIn,
                 base_server):
@@ -606,6 +1232,15 @@ class ServerConfig(configuration.Config):
         else:
             server_class = base_server
 
+        # a single-process server couldn't handle any other request while
+        # a kept-alive connection is idle, and a few idle connections
+        # would hold all the workers of a preforking one
+        if not self["KEEPALIVE_TIMEOUT"] or \
+                self["MULTIPROCESS"] in ("none", "debug") or \
+                (self["MULTIPROCESS"] == "prefork" and
+                    not self["PREFORK_KEEPALIVE"]):
+            RequestHandler.protocol_version = "HTTP/1.0"
+
         # obtain server before changing user id - allows to
         # use port < 1024 if started as root
         try:
@@ -715,6 +1350,10 @@ Options:
  -e <fname>    PEM file containing SSL key and certificate
  -t <mode>     multiprocess mode (default: %(mp_def)s).
                Allowed values: %(mp_types)s.
+ -w <number>   number of worker processes in "prefork" mode, or of
+               worker threads in "async" mode (default: 4)
+ -r <number>   number of requests after which a "prefork" worker is
+               replaced (default: 1000, 0 for no limit)
 %(os_part)s
 
 Long options:
@@ -2,7 +2,7 @@
 """
 __docformat__ = 'restructuredtext'
 
-import weakref
+import weakref, copy
 
 from roundup import hyperdb, support
 
@@ -98,6 +98,9 @@ class Security:
         # roles are mapped by name to the Role
         self.role = {}
 
+        # compiled permission lookup tables by userid, see _lookup()
+        self.clearCache()
+
         # the default Roles
         self.addRole(name="User", description="A regular user, no privs")
         self.addRole(name="Admin", description="An admin user, full privs")
@@ -119,6 +122,18 @@ class Security:
         from roundup import mailgw
         mailgw.initialiseSecurity(self)
 
+    def bind(self, db):
+        ''' Return a copy of this Security for the database "db", sharing
+            the Roles and Permissions of this one.
+
+            The copy compiles its own lookup tables, which last as long
+            as the database (eg. one request).
+        '''
+        security = copy.copy(self)
+        security.db = weakref.proxy(db)
+        security.clearCache()
+        return security
+
     def getPermission(self, permission, classname=None, properties=None,
             check=None):
         ''' Find the Permission matching the name and for the class, if the
@@ -166,22 +181,121 @@ class Security:
            Note that this functionality is actually implemented by the
            Permission.test() method.
         '''
-        roles = self.db.user.get(userid, 'roles')
-        if roles is None:
-            return 0
         if itemid and classname is None:
             raise ValueError, 'classname must accompany itemid'
-        for rolename in [x.lower().strip() for x in roles.split(',')]:
-            if not rolename or not self.role.has_key(rolename):
-                continue
-            # for each of the user's Roles, check the permissions
-            for perm in self.role[rolename].permissions:
-                # permission match?
-                if perm.test(self.db, permission, classname, property,
-                        userid, itemid):
-                    return 1
+        unchecked, checks = self._lookup(permission, userid, classname,
+            property)
+        if unchecked:
+            return 1
+        if itemid is None:
+            # check functions only apply to items
+            return checks and 1 or 0
+        for check in checks:
+            if check(self.db, userid, itemid):
+                return 1
         return 0
 
+    def clearCache(self):
+        ''' Forget the compiled permission lookup tables.
+
+            This is done automatically when Roles and Permissions are
+            added through this class's methods, and when a user's roles
+            change.
+        '''
+        self._tables = {}
+
+    def _lookup(self, permission, userid, classname, property):
+        ''' Find the Permissions of the user's Roles that match
+            "permission", "classname" and "property", disregarding any
+            check functions.
+
+            Returns a tuple of a list of the matched Permissions that
+            have no check function (if there are any the permission is
+            always granted) and the list of distinct check functions of
+            the others.
+
+            The result is remembered in a table per user, which is
+            compiled anew when the user's roles change (or when the
+            permissions list of one of the Roles is modified).
+        '''
+        roles = self.db.user.get(userid, 'roles')
+        entry = self._tables.get(userid)
+        if entry is not None and entry[0] == roles:
+            for role, perms, n in entry[1]:
+                if role.permissions is not perms or len(perms) != n:
+                    entry = None
+                    break
+        else:
+            entry = None
+        if entry is None:
+            l = []
+            if roles is not None:
+                for rolename in [x.lower().strip() for x in roles.split(',')]:
+                    if rolename and self.role.has_key(rolename):
+                        role = self.role[rolename]
+                        l.append((role, role.permissions,
+                            len(role.permissions)))
+            entry = self._tables[userid] = (roles, l, {})
+        table = entry[2]
+        key = (permission, classname, property)
+        if table.has_key(key):
+            return table[key]
+
+        unchecked = []
+        checks = []
+        # for each of the user's Roles, check the permissions
+        for role, perms, n in entry[1]:
+            for perm in perms:
+                # permission match?
+                if not perm.test(self.db, permission, classname,
+                        property, userid, None):
+                    continue
+                if perm.check is None:
+                    unchecked.append(perm)
+                elif perm.check not in checks:
+                    checks.append(perm.check)
+        table[key] = unchecked, checks
+        return unchecked, checks
+
+    def hasUncheckedPermission(self, permission, userid, classname,
+            property=None):
+        '''Determine whether the user has "permission" on *all* items
+           of the class, ie. whether one of the matching Permissions of
+           the user's Roles has no check function.
+
+           When this is true there's no need to call hasPermission()
+           for the individual items.
+        '''
+        unchecked, checks = self._lookup(permission, userid, classname,
+            property)
+        return unchecked and 1 or 0
+
+    def filterPermitted(self, permission, userid, classname, itemids,
+            property=None):
+        '''Return the list of those "itemids" of the class for which
+           the user has "permission", in their original order.
+
+           This gives the same result as calling hasPermission() for
+           each item, but the user's Roles are only looked at once, and
+           if any matching Permission has no check function all the
+           items are permitted without further ado. Otherwise only the
+           check functions of the matching Permissions are called for
+           each item.
+        '''
+        unchecked, checks = self._lookup(permission, userid, classname,
+            property)
+        if unchecked:
+            return list(itemids)
+        if not checks:
+            return []
+        l = []
+        for itemid in itemids:
+            for check in checks:
+                if check(self.db, userid, itemid):
+                    l.append(itemid)
+                    break
+        return l
+
     def addPermission(self, **propspec):
         ''' Create a new Permission with the properties defined in
             'propspec'. See the Permission class for the possible
@@ -196,6 +310,7 @@ class Security:
         '''
         role = Role(**propspec)
         self.role[role.name] = role
+        self.clearCache()
         return role
 
     def addPermissionToRole(self, rolename, permission, classname=None,
@@ -214,5 +329,6 @@ class Security:
                 properties, check)
         role = self.role[rolename.lower()]
         role.permissions.append(permission)
+        self.clearCache()
 
 # vim: set filetype=python sts=4 sw=4 et si :
@@ -58,6 +58,113 @@ class PrioList:
             self.sorted = True
         return iter(self.list)
 
+class LRUCache:
+    '''A dictionary-like cache holding at most "size" items.
+
+    When a new item is added to a full cache the least recently used
+    item is discarded. All operations are O(1): the items are kept in a
+    circular doubly-linked list (with a sentinel "root" link) in order
+    of use, and the dict maps each key to its link (a list of
+    [previous, next, key, value]).
+
+    >>> c = LRUCache(2)
+    >>> c['a'] = 1
+    >>> c['b'] = 2
+    >>> c['a']
+    1
+    >>> c['c'] = 3
+    >>> c.keys()
+    ['c', 'a']
+    >>> c.evictions
+    1
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.evictions = 0
+        self.clear()
+
+    def clear(self):
+        '''Remove all items (the evictions counter is left alone).
+        '''
+        self.data = {}
+        root = []
+        root[:] = [root, root, None, None]
+        self.root = root
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _push_front(self, link):
+        root = self.root
+        first = root[1]
+        link[0] = root
+        link[1] = first
+        first[0] = link
+        root[1] = link
+
+    def __len__(self):
+        return len(self.data)
+
+    def has_key(self, key):
+        return self.data.has_key(key)
+    __contains__ = has_key
+
+    def __getitem__(self, key):
+        link = self.data[key]
+        # push us to the front of the LRU
+        self._unlink(link)
+        self._push_front(link)
+        return link[3]
+
+    def get(self, key, default=None):
+        if not self.data.has_key(key):
+            return default
+        return self[key]
+
+    def __setitem__(self, key, value):
+        link = self.data.get(key)
+        if link is not None:
+            link[3] = value
+            self._unlink(link)
+            self._push_front(link)
+            return
+        link = [None, None, key, value]
+        self.data[key] = link
+        self._push_front(link)
+        if len(self.data) > self.size:
+            # discard the least recently used item
+            last = self.root[0]
+            self._unlink(last)
+            del self.data[last[2]]
+            self.evictions += 1
+
+    def __delitem__(self, key):
+        link = self.data.pop(key)
+        self._unlink(link)
+
+    def pop(self, key, default=None):
+        '''Remove the item "key" if present and return its value (or
+        "default" if it wasn't cached).
+        '''
+        link = self.data.pop(key, None)
+        if link is None:
+            return default
+        self._unlink(link)
+        return link[3]
+
+    def keys(self):
+        '''Return the keys, most recently used first.
+        '''
+        l = []
+        root = self.root
+        link = root[1]
+        while link is not root:
+            l.append(link[2])
+            link = link[1]
+        return l
+
 class Progress:
     '''Progress display for console applications.
 
@@ -1,8 +1,9 @@
-import sys, os, time
+import sys, os, time, marshal, base64
 
 from roundup.hyperdb import String, Password, Link, Multilink, Date, \
     Interval, DatabaseError, Boolean, Number
 from roundup import date, password
+from roundup.backends import get_backend, have_backend
 
 from db_test_base import config
 
@@ -22,11 +23,25 @@ def setupSchema(db, module):
     db.post_init()
     db.commit()
 
+    # a typical mix of permissions for regular users
+    sec = db.security
+    sec.addPermissionToRole('User', 'Web Access')
+    for cl in 'status', 'file', 'issue':
+        sec.addPermissionToRole('User', 'View', cl)
+        sec.addPermissionToRole('User', 'Edit', cl)
+        sec.addPermissionToRole('User', 'Create', cl)
+    def own_record(db, userid, itemid):
+        return userid == itemid
+    p = sec.addPermission(name='View', klass='user', check=own_record)
+    sec.addPermissionToRole('User', p)
+    p = sec.addPermission(name='Edit', klass='user', check=own_record,
+        properties=('username', 'password'))
+    sec.addPermissionToRole('User', p)
+
 def main(backendname, time=time.time, numissues=10):
-    try:
-        exec('from roundup.backends import %s as backend'%backendname)
-    except ImportError:
+    if not have_backend(backendname):
         return
+    backend = get_backend(backendname)
 
     times = []
 
@@ -36,7 +51,7 @@ def main(backendname, time=time.time, numissues=10):
         db = backend.Database(config, 'admin')
         setupSchema(db, backend)
         # create a whole bunch of stuff
-        db.user.create(**{'username': 'admin'})
+        db.user.create(**{'username': 'admin', 'roles': 'User'})
         db.status.create(name="unread")
         db.status.create(name="in-progress")
         db.status.create(name="testing")
@@ -106,6 +121,19 @@ def main(backendname, time=time.time, numissues=10):
             'title':'issue'}, ('+', 'activity'), ('+', 'status'))
     times.append(('filtml', time()))
 
+    # permission checks, as done when rendering an index page
+    db.clearCache()
+    check = db.security.hasPermission
+    users = db.user.list()
+    for i in range(10):
+        for j in db.issue.list():
+            check('View', '1', 'issue', itemid=j)
+            check('Edit', '1', 'issue', 'title', j)
+        for j in users:
+            check('View', '1', 'user', itemid=j)
+            check('Edit', '1', 'user', 'age', j)
+    times.append(('perms', time()))
+
     # results
     last = None
     for event, stamp in times:
@@ -117,10 +145,57 @@ def main(backendname, time=time.time, numissues=10):
     print ' %-6.2f'%(last-first)
     sys.stdout.flush()
 
+def journals(backendname, time=time.time, numissues=100, repeat=5):
+    """Compare the time taken to load the issue histories with the
+    journal params encoded by repr() (before version 7 of the RDBMS
+    databases) and by marshal. Uses the database set up by main().
+    """
+    if not have_backend(backendname):
+        return
+    backend = get_backend(backendname)
+    config.DATABASE = os.path.join('_benchmark', '%s-%s'%(backendname,
+        numissues))
+    if not os.path.exists(config.DATABASE):
+        main(backendname, numissues=numissues)
+    db = backend.Database(config, 'admin')
+    setupSchema(db, backend)
+    if not hasattr(db, 'journal_prefix'):
+        return
+
+    def load():
+        start = time()
+        for i in range(repeat):
+            db.clearCache()
+            for i in db.issue.list():
+                db.issue.history(i)
+        return time() - start
+
+    # go back to repr()
+    prefix = len(db.journal_prefix)
+    for cn in db.classes.keys():
+        cols = ['nodeid', 'date', 'tag', 'action', 'params']
+        db.sql('select %s from %s__journal'%(','.join(cols), cn))
+        rows = []
+        for row in db.sql_fetchall():
+            params = marshal.loads(base64.decodestring(row[4][prefix:]))
+            rows.append((row[0], row[1], row[2], row[3], repr(params)))
+        db.sql('delete from %s__journal'%cn)
+        db.sql_insert_rows('%s__journal'%cn, cols, rows)
+    db.commit()
+    before = load()
+
+    # and upgrade again
+    db.fix_version_6_tables()
+    db.commit()
+    after = load()
+    print '%7s: %-6d  repr %-6.2f  marshal %-6.2f'%(backendname, numissues,
+        before, after)
+    db.close()
+
 if __name__ == '__main__':
     #      0         1         2         3         4         5         6
     #      01234567890123456789012345678901234567890123456789012345678901234
-    print 'Test name       fetch  journl jprops lookup filter filtml TOTAL '
+    print 'Test name       fetch  journl jprops lookup filter filtml perms  TOTAL '
     for name in 'anydbm metakit sqlite'.split():
         main(name)
     for name in 'anydbm metakit sqlite'.split():
@@ -130,5 +205,8 @@ if __name__ == '__main__':
     # don't even bother benchmarking the dbm backends > 100!
     for name in 'metakit sqlite'.split():
         main(name, numissues=1000)
+    print 'History load   journal params encoding'
+    for name in 'postgresql mysql sqlite'.split():
+        journals(name)
 
 # vim: set et sts=4 sw=4 :
@@ -18,6 +18,7 @@
 # $Id: db_test_base.py,v 1.97 2008/03/07 01:11:55 richard Exp $
 
 import unittest, os, shutil, errno, imp, sys, time, pprint, sets, base64, os.path
+import StringIO, marshal
 
 from roundup.hyperdb import String, Password, Link, Multilink, Date, \
     Interval, DatabaseError, Boolean, Number, Node
@@ -562,6 +563,64 @@ class DBTest(MyTestCase):
         name2 = self.db.user.get('1', 'username')
         self.assertEqual(name1, name2)
 
+    def testChangeStamps(self):
+        stamp = self.db.getChangeStamp
+        issue, status, priority = stamp('issue'), stamp('status'), \
+            stamp('priority')
+        self.db.issue.create(title='spam', status='1')
+        self.failUnless(self.db.hasChanges())
+        self.db.rollback()
+        self.failIf(self.db.hasChanges())
+        self.db.commit()
+        self.assertEqual(stamp('issue'), issue)
+        # the stamps are renewed once the changes are committed
+        id = self.db.issue.create(title='spam', status='1')
+        self.assertEqual(stamp('issue'), issue)
+        self.db.commit()
+        self.failIf(self.db.hasChanges())
+        self.assertNotEqual(stamp('issue'), issue)
+        # (the status is linked to, which is journalled)
+        self.assertNotEqual(stamp('status'), status)
+        self.assertEqual(stamp('priority'), priority)
+        # for every process
+        issue = stamp('issue')
+        self.db.close()
+        self.db = self.module.Database(config, 'admin')
+        setupSchema(self.db, 0, self.module)
+        self.assertEqual(self.db.getChangeStamp('issue'), issue)
+        self.db.issue.retire(id)
+        self.db.commit()
+        self.assertNotEqual(self.db.getChangeStamp('issue'), issue)
+        # (of other users too)
+        mode = os.stat(os.path.join(config.DATABASE, 'changes',
+            'issue'))[os.path.stat.ST_MODE]
+        self.assertEqual(mode & 0777, 0666 & ~config.UMASK)
+
+    def testPrefetch(self):
+        ids = []
+        for nosy in ([], ['1'], ['2', '1']):
+            ids.append(self.db.issue.create(title='spam', status='2',
+                nosy=nosy, assignedto='2', foo=date.Interval('-1d')))
+        self.db.commit()
+        expected = {}
+        for id in ids:
+            expected[id] = self.db.issue.getnode(id).items()
+        self.db.clearCache()
+
+        nodes = self.db.getnodes('issue', ids + ['99'])
+        self.assertEqual(len(nodes), 3)
+        nosy = nodes[ids[2]]['nosy'][:]
+        nosy.sort()
+        self.assertEqual(nosy, ['1', '2'])
+
+        self.db.clearCache()
+        self.db.issue.prefetch(ids, ['nosy', 'status', 'title', 'id'])
+        for id in ids:
+            self.assertEqual(self.db.issue.getnode(id).items(),
+                expected[id])
+        self.assertEqual(self.db.status.get('2', 'name'), 'in-progress')
+        self.assertEqual(self.db.user.get('2', 'username'), 'fred')
+
     def testDestroyBlob(self):
         # destroy an uncommitted blob
         f1 = self.db.file.create(content='hello', type="text/plain")
@@ -805,6 +864,32 @@ class DBTest(MyTestCase):
         # see if the change was journalled
         self.assertNotEqual(jlen,  len(self.db.getjournal('issue', '1')))
 
+    def testIterJournals(self):
+        i1 = self.db.issue.create(title="spam")
+        i2 = self.db.issue.create(title="eggs")
+        i3 = self.db.issue.create(title="ham")
+        self.db.commit()
+        # wait a bit to keep proper order of journal entries
+        time.sleep(0.01)
+        since = date.Date()
+        time.sleep(0.01)
+        self.db.issue.set(i3, title="bacon")
+        self.db.issue.set(i1, title="beans")
+        self.db.commit()
+
+        def actions(entries):
+            return [(entry[0], entry[3]) for entry in entries]
+        journals = list(self.db.iterjournals('issue'))
+        self.assertEqual(actions(journals), [(i1, 'create'), (i1, 'set'),
+            (i2, 'create'), (i3, 'create'), (i3, 'set')])
+        self.assertEqual(journals[:2], self.db.getjournal('issue', i1))
+        self.assertEqual(journals[4][4], {'title': 'ham'})
+        self.assertEqual(actions(self.db.iterjournals('issue', [i3, '99',
+            i2, i3])), [(i2, 'create'), (i3, 'create'), (i3, 'set')])
+        self.assertEqual(actions(self.db.iterjournals('issue', since=since)),
+            [(i1, 'set'), (i3, 'set')])
+        self.assertEqual(list(self.db.iterjournals('issue', [])), [])
+
     def testJournalPreCommit(self):
         id = self.db.user.create(username="mary")
         self.assertEqual(len(self.db.getjournal('user', id)), 1)
@@ -943,6 +1028,30 @@ class DBTest(MyTestCase):
         self.assertEquals(self.db.indexer.search(['flebble'], self.db.issue),
             {'1': {}})
 
+    def testReindexJobs(self):
+        from roundup.admin import AdminTool
+        m1 = self.db.msg.create(content="one two")
+        m2 = self.db.msg.create(content="two three")
+        i1 = self.db.issue.create(title="flebble", messages=[m1])
+        i2 = self.db.issue.create(title="frooz", spam=[m2])
+        i3 = self.db.issue.create(title="flebble frooz")
+        self.db.commit()
+        tool = AdminTool()
+        tool.db = self.db
+        tool.reindex_interval = 2
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            tool.reindex_classes([self.db.issue, self.db.msg], jobs=2)
+        finally:
+            sys.stdout = stdout
+        self.failIf(os.path.exists(os.path.join(config.DATABASE,
+            'reindex-checkpoint')))
+        self.assertEquals(self.db.indexer.search(['flebble'], self.db.issue),
+            {i1: {}, i3: {}})
+        self.assertEquals(self.db.indexer.search(['two'], self.db.issue),
+            {i1: {'messages': [m1]}, i2: {'spam': [m2]}})
+
     def testIndexingOnImport(self):
         # import a message
         msgcontent = 'Glrk'
@@ -1180,6 +1289,37 @@ class DBTest(MyTestCase):
         ae(filt(None, {'nosy': ['1','2']}, ('+', 'status'),
             ('-', 'deadline')), ['4', '3'])
 
+    def testFilteringLimit(self):
+        ae, filt = self.filteringSetup()
+        ae(filt(None, {}, ('+','id'), (None,None), limit=2), ['1', '2'])
+        ae(filt(None, {}, ('+','id'), (None,None), limit=2, offset=3), ['4'])
+        ae(filt(None, {}, ('-','deadline'), (None,None), offset=1),
+            ['3', '1', '2'])
+        ae(filt(None, {'nosy': ['1','2']}, ('+', 'status'),
+            ('-', 'deadline'), limit=1, offset=1), ['3'])
+        # sorting by a Multilink can't be done by the database
+        ae(filt(None, {}, ('+','nosy'), (None,None), limit=2, offset=1),
+            ['2', '4'])
+
+    def testFilteringCount(self):
+        ae, filt = self.filteringSetup()
+        count = self.db.issue.filter_count
+        ae(count(None, {}), 4)
+        ae(count(None, {'status': '1'}), 2)
+        ae(count(None, {'nosy': ['1','2']}), 2)
+        ae(count(None, {'nosy': '-1'}), 2)
+        ae(count(None, {'assignedto.username': 'admin'}), 1)
+        ae(count({'1': 1, '3': 1}, {'title': 'issue'}), 2)
+        ae(count({}, {}), 0)
+        self.db.issue.retire('2')
+        ae(count(None, {'status': '1'}), 1)
+
+    def testFilteringSupportsLimit(self):
+        # only the rdbms backends count and slice in the database
+        from roundup.backends import rdbms_common
+        self.assertEqual(bool(self.db.issue.supports_limit),
+            isinstance(self.db.issue, rdbms_common.Class))
+
     def testFilteringMany(self):
         ae, filt = self.filteringSetup()
         ae(filt(None, {'nosy': '2', 'status': '1'}, ('+','id'), (None,None)),
@@ -1882,6 +2022,21 @@ class SchemaTest(MyTestCase):
         self.db.getjournal('a', aid)
         self.db.getjournal('b', bid)
 
+    def test_addpropAfterUse(self):
+        self.init_a()
+        aid = self.db.a.create(name='apple')
+        self.assertEqual(self.db.a.get(aid, 'name'), 'apple')
+        # the class' columns change once the items are in use
+        self.db.a.addprop(fooz=String(), bars=Multilink('a'))
+        self.db.post_init()
+        bid = self.db.a.create(name='bear', fooz='x', bars=[aid])
+        self.db.a.set(aid, fooz='y')
+        self.db.commit()
+        self.db.clearCache()
+        self.assertEqual(self.db.a.get(aid, 'fooz'), 'y')
+        self.assertEqual(self.db.a.get(bid, 'fooz'), 'x')
+        self.assertEqual(self.db.a.get(bid, 'bars'), [aid])
+
     def init_amod(self):
         self.db = self.module.Database(config, 'admin')
         a = self.module.Class(self.db, "a", name=String(), newstr=String(),
@@ -2044,6 +2199,150 @@ class RDBMSTest:
         self.assertEqual(self.db.sql_index_exists('_issue', '_issue_id_idx'), 1)
         self.assertEqual(self.db.sql_index_exists('_issue', '_issue_x_idx'), 0)
 
+class RDBMSIndexerTest:
+    ''' tests of the indexer_rdbms full-text index, mixed into the DBTest
+        of the RDBMS backends '''
+    def indexerSetup(self):
+        m1 = self.db.msg.create(content="please fix the bug, the bug is bad")
+        m2 = self.db.msg.create(content="bug fix")
+        m3 = self.db.msg.create(content="bug bug fix bug")
+        i1 = self.db.issue.create(title="fix it", messages=[m1, m2])
+        i2 = self.db.issue.create(title="another", messages=[m3])
+        self.db.commit()
+        return m1, m2, m3, i1, i2
+
+    def testIndexerRank(self):
+        m1, m2, m3, i1, i2 = self.indexerSetup()
+        rank = self.db.indexer.rank
+        self.assertEqual(rank(['bug']), [('msg', m3, 'content', 3),
+            ('msg', m1, 'content', 2), ('msg', m2, 'content', 1)])
+        self.assertEqual(rank(['bug', 'fix'], limit=2),
+            [('msg', m3, 'content', 4), ('msg', m1, 'content', 3)])
+        self.assertEqual(rank(['fix', 'another']), [])
+        self.assertEqual(rank(['fix', 'bad']), [('msg', m1, 'content', 2)])
+
+    def testIndexerPhrase(self):
+        m1, m2, m3, i1, i2 = self.indexerSetup()
+        phrase = self.db.indexer.find_phrase
+        ids = lambda l: [row[1] for row in l]
+        self.assertEqual(ids(phrase('fix the bug')), [m1])
+        l = ids(phrase('Bug fix'))
+        l.sort()
+        self.assertEqual(l, [m2, m3])
+        self.assertEqual(ids(phrase('fix bug')), [m3])
+        self.assertEqual(phrase('bad bug'), [])
+        self.assertEqual(phrase('the'), [])
+
+    def indexerWords(self, textid):
+        self.db.sql('select _word, _count, _positions from __words '
+            'where _textid=%s'%self.db.arg, (textid,))
+        l = [(str(row[0]), row[1], str(row[2]))
+            for row in self.db.cursor.fetchall()]
+        l.sort()
+        return l
+
+    def testIndexerChange(self):
+        i1 = self.db.issue.create(title="fix bug")
+        self.db.commit()
+        self.db.sql('select _textid from __textids where _class=%s '
+            'and _itemid=%s'%(self.db.arg, self.db.arg), ('issue', i1))
+        textid = self.db.cursor.fetchone()[0]
+        self.assertEqual(self.indexerWords(textid),
+            [('BUG', 1, '1'), ('FIX', 1, '0')])
+        self.db.issue.set(i1, title="fix the bug now, no bug")
+        self.db.commit()
+        self.assertEqual(self.indexerWords(textid),
+            [('BUG', 2, '2 5'), ('FIX', 1, '0'), ('NOW', 1, '3')])
+        self.assertEqual([tuple(row) for row in
+            self.db.indexer.find_phrase('fix the bug')],
+            [('issue', i1, 'title')])
+        self.db.issue.set(i1, title="now what")
+        self.db.commit()
+        self.assertEqual(self.indexerWords(textid),
+            [('NOW', 1, '0'), ('WHAT', 1, '1')])
+
+    def testIndexerBatch(self):
+        m1, m2, m3, i1, i2 = self.indexerSetup()
+        indexer = self.db.indexer
+        indexer.batch_size = 2
+        indexer.begin_batch()
+        indexer.add_text(('msg', m1, 'content'), 'bug')
+        indexer.add_text(('issue', i1, 'title'), 'bug bug')
+        # the batch is full and has been stored
+        self.assertEqual(indexer.rank(['bug'])[:2], [('msg', m3,
+            'content', 3), ('issue', i1, 'title', 2)])
+        indexer.add_text(('issue', i2, 'title'), 'another bug')
+        self.assertEqual(len(indexer.rank(['bug'])), 4)
+        indexer.save_index()
+        self.assertEqual(indexer.rank(['bug']), [('msg', m3, 'content', 3),
+            ('issue', i1, 'title', 2), ('issue', i2, 'title', 1),
+            ('msg', m1, 'content', 1), ('msg', m2, 'content', 1)])
+        self.assertEqual(indexer.batch, None)
+
+    def testIndexerUpgrade(self):
+        m1, m2, m3, i1, i2 = self.indexerSetup()
+        # go back to the version 5 full-text index
+        self.db.sql('DROP TABLE __words')
+        self.db.sql('CREATE TABLE __words (_word varchar(30), '
+            '_textid integer)')
+        self.db.database_schema['version'] = 5
+        self.db.post_init()
+        self.assertEqual(self.db.database_schema['version'],
+            self.db.current_db_version)
+        self.assertEqual(self.db.indexer.rank(['bug'])[0],
+            ('msg', m3, 'content', 3))
+        self.assertEqual(self.db.indexer.search(['bad'], self.db.issue),
+            {i1: {'messages': [m1]}})
+
+class RDBMSJournalTest:
+    ''' tests of the journal params encoding of the RDBMS backends,
+        mixed into their DBTest '''
+    def journalSetup(self):
+        i1 = self.db.issue.create(title="spam", status='1')
+        self.db.commit()
+        self.db.issue.set(i1, title="eggs", deadline=date.Date('2008-03-01'),
+            foo=date.Interval('-1d'), nosy=['1'])
+        self.db.commit()
+        return i1
+
+    def testJournalEncoding(self):
+        i1 = self.journalSetup()
+        self.db.sql('select params from issue__journal')
+        for row in self.db.cursor.fetchall():
+            self.assert_(row[0].startswith(self.db.journal_prefix))
+        action, params = self.db.getjournal('issue', i1)[1][3:]
+        self.assertEqual(action, 'set')
+        self.assertEqual(params['title'], 'spam')
+        self.assertEqual(params['deadline'], None)
+        self.assertEqual(params['nosy'], (('+', ['1']),))
+
+    def testJournalUpgrade(self):
+        i1 = self.journalSetup()
+        self.db.issue.set(i1, deadline=date.Date('2008-04-01'))
+        self.db.commit()
+        journal = self.db.getjournal('issue', i1)
+        # go back to the version 6 repr() encoding
+        cols = ['nodeid', 'date', 'tag', 'action', 'params']
+        self.db.sql('select %s from issue__journal'%','.join(cols))
+        rows = [[row[0], row[1], row[2], row[3], row[4]]
+            for row in self.db.cursor.fetchall()]
+        for row in rows:
+            prefix = len(self.db.journal_prefix)
+            row[4] = repr(marshal.loads(base64.decodestring(row[4][prefix:])))
+        self.db.sql('delete from issue__journal')
+        self.db.sql_insert_rows('issue__journal', cols, rows)
+        self.assertEqual(self.db.getjournal('issue', i1), journal)
+
+        self.db.database_schema['version'] = 6
+        self.db.post_init()
+        self.assertEqual(self.db.database_schema['version'],
+            self.db.current_db_version)
+        self.db.sql('select params from issue__journal')
+        for row in self.db.cursor.fetchall():
+            self.assert_(row[0].startswith(self.db.journal_prefix))
+        self.assertEqual(self.db.getjournal('issue', i1), journal)
+        self.assertEqual(journal[-1][4]['deadline'], date.Date('2008-03-01'))
+
 
 class ClassicInitTest(unittest.TestCase):
     count = 0
@@ -2084,6 +2383,42 @@ class ClassicInitTest(unittest.TestCase):
         l = db.issue.list()
         ae(l, [])
 
+    def testCachedSchema(self):
+        setupTracker(self.dirname, self.backend)
+        tracker = instance.open(self.dirname, optimize=1)
+        tracker.config.CACHE_SCHEMA = 1
+        db = self.db = tracker.open('admin')
+        classes, security = tracker.cached_schema
+        db.issue.disableJournalling()
+        db.close()
+
+        # the classes and security settings are shared with the first
+        # database, but bound to the new one; no Security is set up
+        # just to be replaced
+        import roundup.security
+        def no_security(db):
+            raise AssertionError, 'Security set up for a cached schema'
+        roundup.security.Security = no_security
+        try:
+            db = self.db = tracker.open('admin')
+        finally:
+            roundup.security.Security = security.__class__
+        self.failUnless(db.issue.db.classes is db.classes)
+        cached = dict([(cl.classname, cl) for cl in classes])
+        self.assertEqual(db.getclasses(), support.sorted(cached.keys()))
+        self.failIf(db.issue is cached['issue'])
+        self.failUnless(db.issue.properties is cached['issue'].properties)
+        self.failUnless(db.security.role is security.role)
+        self.assertEqual(db.issue.do_journal, 1)
+        self.failUnless(db.security.hasPermission('Edit', '1', 'issue'))
+        self.failIf(db.security.hasPermission('Edit', '2', 'issue'))
+
+        # the detectors apply too
+        id = db.issue.create(title='spam')
+        self.assertEqual(db.issue.get(id, 'status'),
+            db.status.lookup('unread'))
+        db.commit()
+
     def tearDown(self):
         if self.db is not None:
             self.db.close()
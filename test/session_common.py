@@ -1,4 +1,4 @@
-import os, shutil, unittest
+import os, shutil, time, unittest
 
 from db_test_base import config
 
@@ -32,9 +32,100 @@ class SessionTest(unittest.TestCase):
         self.sessions.set('random_key', text='nope')
         self.assertEqual(self.sessions.get('random_key', 'text'), 'nope')
 
+    def testDestroySession(self):
+        self.sessions.set('random_key', text='hello, world!')
+        self.sessions.set('other_key', text='hello')
+        self.sessions.destroy('random_key')
+        self.assert_(not self.sessions.exists('random_key'))
+        self.assert_(self.sessions.exists('other_key'))
+        self.assertEqual(self.sessions.get('random_key', 'text', None), None)
+
+    def testGetMany(self):
+        self.otks.set('one', uid='1')
+        self.otks.set('two', uid='2')
+        self.otks.set('three', uid='3')
+        self.otks.destroy('three')
+        self.assertEqual(self.otks.get_many(['one', 'two', 'three', 'four']),
+            {'one': {'uid': '1'}, 'two': {'uid': '2'}})
+        self.assertEqual(self.otks.get_many([]), {})
+
 class DBMTest(SessionTest):
     import roundup.backends.sessions_dbm as sessions_module
 
+    def testClean(self):
+        week = 60*60*24*7
+        self.sessions.set('old_key', text='old')
+        self.sessions.set('new_key', text='new')
+        self.sessions.set('old_key', __timestamp=time.time() - 2*week)
+        self.sessions.clean(time.time())
+        self.assertEqual(self.sessions.list(), ['new_key'])
+
+    def testCommit(self):
+        self.sessions.set('random_key', text='hello, world!')
+        other = self.sessions_module.Sessions(self.db)
+        self.assert_(not other.exists('random_key'))
+        other.rollback()
+        self.sessions.commit()
+        self.assertEqual(other.get('random_key', 'text'), 'hello, world!')
+        self.sessions.destroy('random_key')
+        self.sessions.rollback()
+        self.assertEqual(other.get('random_key', 'text'), 'hello, world!')
+        # a transaction sees the changes committed before it
+        other.set('random_key', text='nope')
+        other.commit()
+        self.assertEqual(self.sessions.get('random_key', 'text'), 'nope')
+
+    def testManager(self):
+        sessions = self.db.getSessionManager()
+        self.assert_(sessions is self.db.getSessionManager())
+        sessions.set('random_key', text='hello, world!')
+        self.db.commit()
+        self.assertEqual(self.sessions.get('random_key', 'text'),
+            'hello, world!')
+        sessions.set('random_key', text='nope')
+        self.db.rollback()
+        self.assertEqual(sessions.get('random_key', 'text'), 'hello, world!')
+
 class RDBMSTest(SessionTest):
     import roundup.backends.sessions_rdbms as sessions_module
 
+    def testValueEncoding(self):
+        self.sessions.set('random_key', text='hello, world!', last_use=1.5)
+        self.db.sql('select session_value from sessions')
+        value = self.db.cursor.fetchone()[0]
+        self.assert_(value.startswith(self.sessions_module.value_prefix))
+        other = self.sessions_module.Sessions(self.db)
+        self.assertEqual(other.getall('random_key'),
+            {'text': 'hello, world!', 'last_use': 1.5})
+
+    def testOldValue(self):
+        self.db.sql('insert into sessions (session_key, session_time, '
+            'session_value) values (%s, %s, %s)'%((self.db.arg,)*3),
+            ('random_key', time.time(), repr({'user': 'admin'})))
+        self.assertEqual(self.sessions.get('random_key', 'user'), 'admin')
+        self.sessions.set('random_key', last_use=1.5)
+        other = self.sessions_module.Sessions(self.db)
+        self.assertEqual(other.getall('random_key'),
+            {'user': 'admin', 'last_use': 1.5})
+        self.assertRaises(NameError, self.sessions_module.decode_value,
+            "__import__('os')")
+
+    def testClean(self):
+        week = 60*60*24*7
+        self.sessions.set('old_key', text='old')
+        self.sessions.set('new_key', text='new')
+        self.db.sql('update sessions set session_time=%s where '
+            'session_key=%s'%(self.db.arg, self.db.arg),
+            (time.time() - 2*week, 'old_key'))
+        self.sessions.clean(time.time())
+        self.assert_(not self.sessions.exists('old_key'))
+        self.assert_(self.sessions.exists('new_key'))
+        self.assert_(self.db.sql_index_exists('sessions',
+            'sessions_time_idx'))
+        self.assert_(self.db.sql_index_exists('otks', 'otks_time_idx'))
+
+    def testManager(self):
+        sessions = self.db.getSessionManager()
+        self.assert_(sessions is self.db.getSessionManager())
+        self.assert_(isinstance(sessions, self.db.session_class))
+
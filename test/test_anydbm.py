@@ -20,7 +20,9 @@
 import unittest, os, shutil, time
 from roundup.backends import get_backend
 
-from db_test_base import DBTest, ROTest, SchemaTest, ClassicInitTest, config
+from roundup import hyperdb
+from db_test_base import DBTest, ROTest, SchemaTest, ClassicInitTest, config, \
+    setupSchema
 
 class anydbmOpener:
     module = get_backend('anydbm')
@@ -29,7 +31,57 @@ class anydbmOpener:
         shutil.rmtree(config.DATABASE)
 
 class anydbmDBTest(anydbmOpener, DBTest):
-    pass
+    def indexed(self, idx, key):
+        ids = idx[key].split()
+        ids.sort()
+        return ids
+
+    def testFilterIndex(self):
+        ae, filt = self.filteringSetup()
+        ae(filt(None, {'status': '1'}, ('+','id'), (None,None)), ['2','3'])
+        # the index is built by the first filter and updated on commit
+        idx = self.db.getFilterIndex('issue')
+        try:
+            ae(self.indexed(idx, 'status:1'), ['2', '3'])
+            ae(self.indexed(idx, 'assignedto:'), ['3', '4'])
+            ae(self.indexed(idx, 'nosy:'), ['1', '2'])
+        finally:
+            idx.close()
+        self.db.issue.set('2', status='2', nosy=['3'])
+        self.db.issue.destroy('3')
+        self.db.commit()
+        idx = self.db.getFilterIndex('issue')
+        try:
+            self.failIf(idx.has_key('status:1'))
+            ae(self.indexed(idx, 'status:2'), ['1', '2'])
+            ae(self.indexed(idx, 'nosy:3'), ['2', '4'])
+            ae(self.indexed(idx, 'nosy:'), ['1'])
+        finally:
+            idx.close()
+        ae(filt(None, {'status': '2'}, ('+','id'), (None,None)), ['1','2'])
+        ae(filt(None, {'nosy': '-1'}, ('+','id'), (None,None)), ['1'])
+
+    def testFilterIndexUncommitted(self):
+        ae, filt = self.filteringSetup()
+        ae(filt(None, {'status': '1'}, ('+','id'), (None,None)), ['2','3'])
+        self.db.issue.set('1', status='1')
+        self.db.issue.set('2', status='3')
+        self.db.issue.create(title='five', status='1')
+        self.db.issue.destroy('3')
+        ae(filt(None, {'status': '1'}, ('+','id'), (None,None)), ['1','5'])
+        self.db.rollback()
+        ae(filt(None, {'status': '1'}, ('+','id'), (None,None)), ['2','3'])
+
+    def testFilterIndexSchemaChange(self):
+        ae, filt = self.filteringSetup()
+        ae(filt(None, {'status': '1'}, ('+','id'), (None,None)), ['2','3'])
+        self.db.close()
+        self.db = self.module.Database(config, 'admin')
+        setupSchema(self.db, 0, self.module)
+        self.db.issue.addprop(fixer=hyperdb.Link('user'))
+        # the index is rebuilt to include the new property
+        ae(self.db.issue.filter(None, {'fixer': '-1'}, ('+','id'),
+            (None,None)), ['1','2','3','4'])
 
 class anydbmROTest(anydbmOpener, ROTest):
     pass
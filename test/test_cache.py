@@ -0,0 +1,74 @@
+import unittest, os, shutil
+
+from roundup.cgi.cache import MemoryStore, DiskStore
+
+class StoreTest:
+    def testGetSet(self):
+        store = self.store
+        self.assertEqual(store.get(('a', 1)), None)
+        store.set(('a', 1), 'one')
+        store.set(('a', 2), ('text/html', u'two'))
+        self.assertEqual(store.get(('a', 1)), 'one')
+        self.assertEqual(store.get(('a', 2)), ('text/html', u'two'))
+        store.set(('a', 1), 'uno')
+        self.assertEqual(store.get(('a', 1)), 'uno')
+        self.assertEqual(store.stats['hits'], 3)
+        self.assertEqual(store.stats['misses'], 1)
+        self.assertEqual(store.stats['stores'], 3)
+        self.assertEqual(store.hit_ratio(), 0.75)
+        store.clear()
+        self.assertEqual(store.get(('a', 1)), None)
+
+class MemoryStoreTestCase(StoreTest, unittest.TestCase):
+    def setUp(self):
+        self.store = MemoryStore(3)
+
+    def testEviction(self):
+        for i in range(5):
+            self.store.set((i,), str(i))
+        self.assertEqual(self.store.get((0,)), None)
+        self.assertEqual(self.store.get((4,)), '4')
+        self.assertEqual(self.store.stats['evictions'], 2)
+
+class DiskStoreTestCase(StoreTest, unittest.TestCase):
+    def setUp(self):
+        self.dir = '_test_cache'
+        self.store = DiskStore(self.dir, 3)
+
+    def tearDown(self):
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+
+    def testShared(self):
+        self.store.set(('a',), 'one')
+        self.assertEqual(DiskStore(self.dir, 3).get(('a',)), 'one')
+        mode = os.stat(self.store.filename(('a',)))[os.path.stat.ST_MODE]
+        self.assertEqual(mode & 0777, 0644)
+
+    def testPrune(self):
+        for i in range(5):
+            self.store.set((i,), str(i))
+            # (the oldest are those stored first)
+            os.utime(self.store.filename((i,)), (i, i))
+        self.store.prune()
+        self.assertEqual(len(os.listdir(self.dir)), 3)
+        self.assertEqual(self.store.get((1,)), None)
+        self.assertEqual(self.store.get((2,)), '2')
+        self.assertEqual(self.store.stats['evictions'], 2)
+
+    def testCorrupt(self):
+        self.store.set(('a',), 'one')
+        open(self.store.filename(('a',)), 'wb').write('garbage')
+        self.assertEqual(self.store.get(('a',)), None)
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(MemoryStoreTestCase))
+    suite.addTest(unittest.makeSuite(DiskStoreTestCase))
+    return suite
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner()
+    unittest.main(testRunner=runner)
+
+# vim: set filetype=python sts=4 sw=4 et si :
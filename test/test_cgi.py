@@ -10,7 +10,7 @@
 #
 # $Id: test_cgi.py,v 1.34 2008/02/27 08:32:51 richard Exp $
 
-import unittest, os, shutil, errno, sys, difflib, cgi, re
+import unittest, os, shutil, errno, sys, difflib, cgi, re, StringIO
 
 from roundup.cgi import client, actions, exceptions
 from roundup.cgi.exceptions import FormError
@@ -635,6 +635,116 @@ class FormTestCase(unittest.TestCase):
         self.failUnlessRaises(exceptions.Unauthorised,
             actions.EditItemAction(cl).handle)
 
+    #
+    # OUTPUT
+    #
+    def testWriteHTMLContentLength(self):
+        class Request:
+            def __init__(self):
+                self.wfile = StringIO.StringIO()
+            def start_response(self, headers, response):
+                self.headers = dict(headers)
+        request = Request()
+        cl = client.Client(self.instance, request, {'PATH_INFO':'/',
+            'REQUEST_METHOD':'GET'}, makeForm({}))
+        # the length is that of the recoded page
+        cl.charset = 'iso-8859-1'
+        cl.write_html('caf\xc3\xa9')
+        self.assertEqual(request.wfile.getvalue(), 'caf\xe9')
+        self.assertEqual(request.headers['Content-Length'], '4')
+
+    def testServeFile(self):
+        class Request:
+            def __init__(self):
+                self.wfile = StringIO.StringIO()
+            def start_response(self, headers, response):
+                self.headers = dict(headers)
+                self.response = response
+        fileid = self.db.file.create(name='log', type='text/plain',
+            content='0123456789')
+        self.db.commit()
+        def serve(**env):
+            env['PATH_INFO'] = '/'
+            env['REQUEST_METHOD'] = 'GET'
+            request = Request()
+            cl = client.Client(self.instance, request, env, makeForm({}))
+            cl.db = self.db
+            cl.userid = '1'
+            cl.serve_file('file' + fileid)
+            return request
+        request = serve()
+        self.assertEqual(request.wfile.getvalue(), '0123456789')
+        self.assertEqual(request.headers['Content-Length'], '10')
+        self.assertEqual(request.headers['Accept-Ranges'], 'bytes')
+        etag = request.headers['ETag']
+
+        self.assertRaises(exceptions.NotModified, serve,
+            HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(serve(HTTP_IF_NONE_MATCH='"x"').response, 200)
+
+        request = serve(HTTP_RANGE='bytes=2-4')
+        self.assertEqual(request.response, 206)
+        self.assertEqual(request.wfile.getvalue(), '234')
+        self.assertEqual(request.headers['Content-Range'], 'bytes 2-4/10')
+        self.assertEqual(request.headers['Content-Length'], '3')
+        self.assertEqual(serve(HTTP_RANGE='bytes=7-').wfile.getvalue(),
+            '789')
+        self.assertEqual(serve(HTTP_RANGE='bytes=-2').wfile.getvalue(),
+            '89')
+        request = serve(HTTP_RANGE='bytes=10-')
+        self.assertEqual(request.response, 416)
+        self.assertEqual(request.headers['Content-Range'], 'bytes */10')
+        self.assertEqual(request.wfile.getvalue(), '')
+        # the whole file if the client's copy isn't current
+        request = serve(HTTP_RANGE='bytes=2-4', HTTP_IF_RANGE='"x"')
+        self.assertEqual(request.response, 200)
+        self.assertEqual(request.wfile.getvalue(), '0123456789')
+
+    def testPageCache(self):
+        self.instance.config.WEB_CACHE = 'memory'
+        self.db.commit()
+        def render(user='anonymous'):
+            env = {'PATH_INFO': 'keyword', 'REQUEST_METHOD': 'GET',
+                'QUERY_STRING': '', 'HTTP_HOST': 'localhost',
+                'TRACKER_NAME': 'test', 'SCRIPT_NAME': ''}
+            cl = client.Client(self.instance, None, env, makeForm({}))
+            cl.db = self.db
+            cl.user = user
+            cl.userid = self.db.user.lookup(user)
+            cl.ok_message = []
+            cl.error_message = []
+            cl.language = ''
+            cl.classname = 'keyword'
+            cl.template = 'index'
+            return cl.renderContext(), cl.output_cache.store
+        page, store = render()
+        store.clear()
+        stats = store.stats.copy()
+        self.assertEqual(render()[0], page)
+        self.assertEqual(render()[0], page)
+        self.assertEqual(store.stats['stores'], stats['stores'] + 1)
+        self.assertEqual(store.stats['hits'], stats['hits'] + 1)
+        # the page is rendered again once keywords change
+        self.db.keyword.create(name='new-keyword')
+        self.db.commit()
+        page = render()[0]
+        self.failUnless('new-keyword' in page)
+        self.assertEqual(store.stats['stores'], stats['stores'] + 2)
+        # and only cached for the anonymous user
+        render('admin')
+        self.assertEqual(store.stats['stores'], stats['stores'] + 2)
+        # or once the templates it's rendered with change, including
+        # those of the macros
+        self.assertEqual(render()[0], page)
+        self.assertEqual(store.stats['stores'], stats['stores'] + 2)
+        src = os.path.join(self.instance.templates.dir, 'page.html')
+        mtime = os.stat(src)[os.path.stat.ST_MTIME] + 10
+        os.utime(src, (mtime, mtime))
+        self.assertEqual(render()[0], page)
+        self.assertEqual(store.stats['stores'], stats['stores'] + 3)
+        self.assertEqual(render()[0], page)
+        self.assertEqual(store.stats['stores'], stats['stores'] + 3)
+
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(FormTestCase))
@@ -0,0 +1,141 @@
+import unittest, threading
+
+from roundup.backends.connpool import ConnectionPool
+
+class Connection:
+    def __init__(self, broken=0):
+        self.broken = broken
+        self.closed = 0
+        self.rollbacks = 0
+
+    def cursor(self):
+        if self.broken:
+            raise ValueError, 'connection lost'
+        return self
+
+    def execute(self, sql):
+        pass
+
+    def fetchall(self):
+        return [(1,)]
+
+    def rollback(self):
+        if self.broken:
+            raise ValueError, 'connection lost'
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = 1
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.opened = []
+        self.pool = ConnectionPool(self.connect, min_size=1, max_size=2)
+
+    def connect(self):
+        conn = Connection()
+        self.opened.append(conn)
+        return conn
+
+    def testReuse(self):
+        c1 = self.pool.get()
+        self.pool.put(c1)
+        self.assertEqual(c1.rollbacks, 1)
+        self.failUnless(self.pool.get() is c1)
+        c2 = self.pool.get()
+        self.failIf(c2 is c1)
+        self.assertEqual(self.pool.stats, {'connects': 2, 'reuses': 1,
+            'discards': 0})
+
+    def testMaxSize(self):
+        conns = [self.pool.get() for i in range(3)]
+        for conn in conns:
+            self.pool.put(conn)
+        self.assertEqual([conn.closed for conn in conns], [0, 0, 1])
+        self.assertEqual(len(self.pool.idle), 2)
+        # given back twice
+        self.pool.put(conns[0])
+        self.assertEqual(len(self.pool.idle), 2)
+
+    def testIdleTimeout(self):
+        self.pool.idle_timeout = -1
+        c1 = self.pool.get()
+        c2 = self.pool.get()
+        self.pool.put(c1)
+        self.pool.put(c2)
+        # the most recently used is kept
+        self.assertEqual((c1.closed, c2.closed), (1, 0))
+        self.assertEqual(self.pool.idle[0][1], c2)
+
+    def testBroken(self):
+        c1 = self.pool.get()
+        c1.broken = 1
+        self.pool.put(c1)
+        self.failUnless(c1.closed)
+        self.assertEqual(self.pool.idle, [])
+
+        # idle connections are checked after a while
+        c2 = self.pool.get()
+        self.pool.put(c2)
+        c2.broken = 1
+        self.pool.check_interval = -1
+        c3 = self.pool.get()
+        self.failIf(c3 is c2)
+        self.failUnless(c2.closed)
+        self.pool.put(c3)
+        self.failUnless(self.pool.get() is c3)
+        self.assertEqual(self.pool.stats['discards'], 2)
+
+    def testFork(self):
+        c1 = self.pool.get()
+        c2 = self.pool.get()
+        self.pool.put(c1)
+        # pretend we're a forked child: the parent's connections are
+        # left alone
+        self.pool.pid = -1
+        c3 = self.pool.get()
+        self.failIf(c3 is c1)
+        self.pool.put(c2)
+        self.assertEqual((c1.closed, c2.closed), (0, 0))
+        self.assertEqual((c1.rollbacks, c2.rollbacks), (1, 0))
+        self.assertEqual(len(self.pool.orphans), 2)
+        self.pool.put(c3)
+        self.failUnless(self.pool.get() is c3)
+
+    def testClear(self):
+        c1 = self.pool.get()
+        self.pool.put(c1)
+        self.pool.clear()
+        self.failUnless(c1.closed)
+        self.failIf(self.pool.get() is c1)
+
+    def testThreads(self):
+        self.pool.max_size = 3
+        errors = []
+        def run():
+            try:
+                for i in range(100):
+                    conn = self.pool.get()
+                    if conn.closed:
+                        errors.append(conn)
+                    self.pool.put(conn)
+            except:
+                errors.append('exception')
+        threads = [threading.Thread(target=run) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.failUnless(len(self.opened) <= 3)
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ConnectionPoolTestCase))
+    return suite
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner()
+    unittest.main(testRunner=runner)
+
+# vim: set et sts=4 sw=4 :
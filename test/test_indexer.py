@@ -65,6 +65,76 @@ class IndexerTest(unittest.TestCase):
     def tearDown(self):
         shutil.rmtree('test-index')
 
+class DbmIndexerTest(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists('test-index'):
+            shutil.rmtree('test-index')
+        os.mkdir('test-index')
+        from roundup.backends.indexer_dbm import Indexer
+        self.Indexer = Indexer
+        self.dex = Indexer(db)
+        self.dex.load_index()
+        self.dex.add_text(('test', '1', 'foo'), 'a the hello world')
+        self.dex.add_text(('test', '2', 'foo'), 'blah blah the world')
+        self.dex.save_index()
+
+    def reopen(self):
+        self.dex = self.Indexer(db)
+        self.dex.load_index()
+        return self.dex
+
+    def test_log(self):
+        segment = self.dex.indexdb + 'W'
+        mtime = int(os.stat(segment).st_mtime) - 10
+        os.utime(segment, (mtime, mtime))
+        self.dex.add_text(('test', '3', 'foo'), 'hello again')
+        self.dex.add_text(('test', '1', 'foo'), 'goodbye world')
+        self.dex.save_index()
+        # the changes went to the log, not the segments
+        self.assert_(os.path.exists(self.dex.indexlog))
+        self.assertEqual(os.stat(segment).st_mtime, mtime)
+        dex = self.reopen()
+        self.assertEqual(dex.find(['hello']), [('test', '3', 'foo')])
+        self.assertEqual(dex.find(['goodbye']), [('test', '1', 'foo')])
+        self.assertEqual(len(dex.find(['world'])), 2)
+        # new entries don't reuse the ids of the logged ones
+        dex.add_text(('test', '4', 'foo'), 'hello')
+        self.assertEqual(len(dex.find(['hello'])), 2)
+
+    def test_rollback(self):
+        self.dex.add_text(('test', '3', 'foo'), 'hello again')
+        self.dex.rollback()
+        self.dex.save_index()
+        self.failIf(os.path.exists(self.dex.indexlog))
+        self.failIf(self.reopen().find(['again']))
+
+    def test_merge(self):
+        self.dex.min_merge_size = 0
+        words = ['goodbye'] + ['word%d'%i for i in range(500)]
+        self.dex.add_text(('test', '1', 'foo'), ' '.join(words))
+        self.dex.save_index()
+        # the log outgrew the segments and was merged into them
+        self.failIf(os.path.exists(self.dex.indexlog))
+        dex = self.reopen()
+        self.assertEqual(dex.find(['world']), [('test', '2', 'foo')])
+        self.assertEqual(dex.find(['goodbye']), [('test', '1', 'foo')])
+        # the stale references were dropped
+        self.failIf(dex.words.has_key('HELLO'))
+        self.assertEqual(dex.words['WORLD'].keys(), [dex.files[('test',
+            '2', 'foo')][0]])
+
+    def test_truncated_log(self):
+        self.dex.add_text(('test', '3', 'foo'), 'hello again')
+        self.dex.save_index()
+        f = open(self.dex.indexlog, 'ab')
+        f.write('\x00\x01')
+        f.close()
+        self.assertEqual(self.reopen().find(['again']),
+            [('test', '3', 'foo')])
+
+    def tearDown(self):
+        shutil.rmtree('test-index')
+
 class XapianIndexerTest(IndexerTest):
     def setUp(self):
         if os.path.exists('test-index'):
@@ -78,6 +148,7 @@ class XapianIndexerTest(IndexerTest):
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(IndexerTest))
+    suite.addTest(unittest.makeSuite(DbmIndexerTest))
     try:
         import xapian
         suite.addTest(unittest.makeSuite(XapianIndexerTest))
@@ -23,6 +23,7 @@ from roundup.hyperdb import DatabaseError
 from roundup.backends import get_backend, have_backend
 
 from db_test_base import DBTest, ROTest, config, SchemaTest, ClassicInitTest
+from db_test_base import RDBMSIndexerTest, RDBMSJournalTest
 
 
 class mysqlOpener:
@@ -39,7 +40,8 @@ class mysqlOpener:
     def nuke_database(self):
         self.module.db_nuke(config)
 
-class mysqlDBTest(mysqlOpener, DBTest):
+class mysqlDBTest(mysqlOpener, DBTest, RDBMSIndexerTest,
+        RDBMSJournalTest):
     def setUp(self):
         mysqlOpener.setUp(self)
         DBTest.setUp(self)
@@ -22,6 +22,7 @@ import unittest
 from roundup.hyperdb import DatabaseError
 
 from db_test_base import DBTest, ROTest, config, SchemaTest, ClassicInitTest
+from db_test_base import RDBMSIndexerTest, RDBMSJournalTest
 
 from roundup.backends import get_backend, have_backend
 
@@ -39,7 +40,8 @@ class postgresqlOpener:
         # clear out the database - easiest way is to nuke and re-create it
         self.module.db_nuke(config)
 
-class postgresqlDBTest(postgresqlOpener, DBTest):
+class postgresqlDBTest(postgresqlOpener, DBTest, RDBMSIndexerTest,
+        RDBMSJournalTest):
     def setUp(self):
         postgresqlOpener.setUp(self)
         DBTest.setUp(self)
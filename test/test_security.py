@@ -106,6 +106,17 @@ class PermissionTest(MyTestCase):
         self.db.user.create(username="demo", roles='User')
         self.db.user.create(username="anonymous", roles='Anonymous')
 
+    def testBind(self):
+        security = self.db.security
+        security.hasPermission('Edit', '1', 'issue')
+        bound = security.bind(self.db)
+        # the Roles are shared, the lookup tables aren't
+        self.assert_(bound.role is security.role)
+        self.assertEqual(bound._tables, {})
+        self.assert_(bound.hasPermission('Edit', '1', 'issue'))
+        self.assertNotEqual(bound._tables, {})
+        self.assert_(bound._tables is not security._tables)
+
     def testAccessControls(self):
         add = self.db.security.addPermission
         has = self.db.security.hasPermission
@@ -178,6 +189,39 @@ class PermissionTest(MyTestCase):
         self.assertEquals(has('Test', none, 'test', itemid='1'), 0)
         self.assertEquals(has('Test', none, 'test', itemid='2'), 0)
 
+        # permission on all items
+        unchecked = self.db.security.hasUncheckedPermission
+        self.assertEquals(unchecked('Test', user1, 'test'), 1)
+        self.assertEquals(unchecked('Test', user2, 'test'), 1)
+        self.assertEquals(unchecked('Test', user2, 'test', 'c'), 0)
+        self.assertEquals(unchecked('Test', user3, 'test'), 0)
+        self.assertEquals(unchecked('Test', super, 'test'), 1)
+        self.assertEquals(unchecked('Test', none, 'test'), 0)
+
+        # bulk check
+        permitted = self.db.security.filterPermitted
+        ids = ['3', '1', '2']
+        self.assertEquals(permitted('Test', user1, 'test', ids), ids)
+        self.assertEquals(permitted('Test', user3, 'test', ids), ['1'])
+        self.assertEquals(permitted('Test', super, 'test', ids), ids)
+        self.assertEquals(permitted('Test', none, 'test', ids), [])
+        self.assertEquals(permitted('Test', user2, 'test', ids, 'a'), ids)
+        self.assertEquals(permitted('Test', user2, 'test', ids, 'c'), [])
+        for userid in (user1, user2, user3, super, none):
+            self.assertEquals(permitted('Test', userid, 'test', ids),
+                [id for id in ids if has('Test', userid, 'test', itemid=id)])
+
+        # changes to roles and permissions are picked up
+        self.assertEquals(has('Test', none, 'test'), 0)
+        self.db.user.set(none, roles='Role1')
+        self.assertEquals(has('Test', none, 'test'), 1)
+        self.assertEquals(has('Test', user3, 'test', itemid='2'), 0)
+        addToRole('Role3', add(name="Test", klass="test",
+            check=lambda db, userid, itemid: itemid == '2'))
+        self.assertEquals(has('Test', user3, 'test', itemid='2'), 1)
+        self.db.security.role['role3'].permissions = []
+        self.assertEquals(has('Test', user3, 'test', itemid='1'), 0)
+
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(PermissionTest))
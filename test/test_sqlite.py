@@ -21,6 +21,7 @@ import unittest, os, shutil, time
 from roundup.backends import get_backend, have_backend
 
 from db_test_base import DBTest, ROTest, SchemaTest, ClassicInitTest, config
+from db_test_base import RDBMSIndexerTest, RDBMSJournalTest
 
 class sqliteOpener:
     if have_backend('sqlite'):
@@ -29,7 +30,8 @@ class sqliteOpener:
     def nuke_database(self):
         shutil.rmtree(config.DATABASE)
 
-class sqliteDBTest(sqliteOpener, DBTest):
+class sqliteDBTest(sqliteOpener, DBTest, RDBMSIndexerTest,
+        RDBMSJournalTest):
     pass
 
 class sqliteROTest(sqliteOpener, ROTest):
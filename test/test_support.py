@@ -0,0 +1,55 @@
+import unittest
+
+from roundup.support import LRUCache
+
+class LRUCacheTestCase(unittest.TestCase):
+    def testEviction(self):
+        c = LRUCache(3)
+        for k in 'abcd':
+            c[k] = k.upper()
+        self.assertEquals(len(c), 3)
+        self.failIf(c.has_key('a'))
+        self.assertEquals(c.keys(), ['d', 'c', 'b'])
+        self.assertEquals(c.evictions, 1)
+
+    def testUsageOrder(self):
+        c = LRUCache(3)
+        for k in 'abc':
+            c[k] = k.upper()
+        # touching "a" makes "b" the least recently used
+        self.assertEquals(c['a'], 'A')
+        c['d'] = 'D'
+        self.failIf(c.has_key('b'))
+        self.assertEquals(c.keys(), ['d', 'a', 'c'])
+        # replacing a value also counts as a use
+        c['c'] = 'cc'
+        self.assertEquals(c.keys(), ['c', 'd', 'a'])
+        self.assertEquals(c.get('c'), 'cc')
+        self.assertEquals(c.evictions, 1)
+
+    def testRemoval(self):
+        c = LRUCache(3)
+        for k in 'abc':
+            c[k] = k.upper()
+        self.assertEquals(c.pop('b'), 'B')
+        self.assertEquals(c.pop('b'), None)
+        del c['a']
+        self.assertRaises(KeyError, c.__delitem__, 'a')
+        self.assertEquals(c.keys(), ['c'])
+        self.assertEquals(c.get('a', 'x'), 'x')
+        c.clear()
+        self.assertEquals(len(c), 0)
+        self.assertEquals(c.keys(), [])
+        c['e'] = 'E'
+        self.assertEquals(c.keys(), ['e'])
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(LRUCacheTestCase))
+    return suite
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner()
+    unittest.main(testRunner=runner)
+
+# vim: set et sts=4 sw=4 :
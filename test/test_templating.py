@@ -1,7 +1,9 @@
-import unittest
+import unittest, os, shutil
 from cgi import FieldStorage, MiniFieldStorage
 
 from roundup.cgi.templating import *
+from roundup.cgi.TAL import TALCompiler
+from roundup.cgi import cache
 from test_actions import MockNull, true
 
 class MockDatabase(MockNull):
@@ -88,6 +90,309 @@ class HTMLClassTestCase(TemplatingTestCase) :
         cls = HTMLClass(self.client, "issue")
         cls["nosy"]
 
+class TemplateLookupTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = '_test_templating'
+        os.mkdir(self.dir)
+        self.create('issue.item.html')
+        self.create('_generic.item.html')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def create(self, filename):
+        open(os.path.join(self.dir, filename), 'w').close()
+
+    def testLookups(self):
+        lookups = {}
+        self.assertEqual(find_template(self.dir, 'issue', 'item', lookups),
+            (os.path.join(self.dir, 'issue.item.html'), 'issue.item.html'))
+        self.assertRaises(NoTemplate, find_template, self.dir, 'user',
+            'index', lookups)
+        # later lookups don't look at the files again
+        os.remove(os.path.join(self.dir, 'issue.item.html'))
+        self.create('user.index.html')
+        self.assertEqual(find_template(self.dir, 'issue', 'item',
+            lookups)[1], 'issue.item.html')
+        self.assertRaises(NoTemplate, find_template, self.dir, 'user',
+            'index', lookups)
+        # but new ones do
+        self.assertEqual(find_template(self.dir, 'issue', 'item')[1],
+            '_generic.item.html')
+        self.assertEqual(find_template(self.dir, 'user', 'index', {})[1],
+            'user.index.html')
+
+    def testHasItemTemplate(self):
+        client = MockNull(template_lookups={})
+        client.db.config.TEMPLATES = self.dir
+        self.assert_(has_item_template(client, 'issue'))
+        self.failIf(has_item_template(client, 'user'))
+        self.assertEqual(len(client.template_lookups), 2)
+
+class FilterResultTestCase(TemplatingTestCase):
+    def setUp(self):
+        TemplatingTestCase.setUp(self)
+        self.ids = [str(i) for i in range(1, 201)]
+        self.calls = []
+        def filter(matches, filterspec, sort, group, limit=None, offset=0):
+            self.calls.append((limit, offset))
+            return self.ids[offset:offset+limit]
+        self.klass = MockNull(filter=filter,
+            filter_count=lambda matches, filterspec: len(self.ids))
+
+    def testLazyFetch(self):
+        l = FilterResult(self.klass, None, {}, [], [], 10)
+        self.assertEqual(len(l), 200)
+        self.assertEqual(self.calls, [])
+        self.assertEqual(l[50], '51')
+        self.assertEqual(l[60], '61')
+        self.assertEqual(l[-1], '200')
+        self.assertEqual(self.calls, [(11, 50), (11, 199)])
+        self.assertRaises(IndexError, l.__getitem__, 200)
+
+    def testBatch(self):
+        l = FilterResult(self.klass, None, {}, [], [], 20)
+        b = Batch(self.client, l, 20, 40)
+        self.assertEqual(b.sequence_length, 200)
+        self.assertEqual(b.length, 20)
+        self.assertEqual([b[i] for i in range(b.length)],
+            [str(i) for i in range(41, 61)])
+        self.failIf(b.next() is None)
+        # only the displayed batch (and the start of the next) is fetched
+        self.assertEqual(self.calls[0], (21, 40))
+
+compiler_template = """<html><body tal:define="items options/names;
+                                           title string:T &amp; x">
+<h1 tal:content="title">x</h1>
+<ul><li tal:repeat="i items" tal:attributes="title i;
+    class python:repeat['i'].odd() and 'odd' or 'even'"
+  ><span tal:replace="i">x</span>
+  <b tal:condition="repeat/i/end">last</b></li></ul>
+<p tal:replace="structure string:&lt;em&gt;s&lt;/em&gt;">x</p>
+<div tal:omit-tag="" tal:content="default">kept</div>
+<div tal:omit-tag="python:1">omitted</div>
+<div tal:omit-tag="python:0">not omitted</div>
+<input type="checkbox" checked tal:attributes="checked python:0" />
+<input type="text" tal:attributes="value title; name string:a-long-name;
+    id string:a-long-id; title string:a long title" />
+<p tal:on-error="string:failed" tal:content="options/missing">x</p>
+<p i18n:translate="">Hello <span i18n:name="who" tal:replace="title"/></p>
+<div metal:define-macro="m">before <span metal:define-slot="s">default</span>
+ after</div>
+<div metal:use-macro="template/macros/m"
+  ><b metal:fill-slot="s">filled <i tal:content="title" /></b></div>
+<div metal:use-macro="template/macros/m">unfilled</div>
+</body></html>
+"""
+
+class TALCompilerTestCase(unittest.TestCase):
+    def render(self, compile):
+        pt = PageTemplate.PageTemplate()
+        pt.write(compiler_template)
+        interpreter = TALInterpreter.TALInterpreter
+        if compile:
+            pt._v_program, pt._v_macros = TALCompiler.compile_template(
+                pt._v_program, pt._v_macros)
+            interpreter = TALCompiler.CompiledTALInterpreter
+        c = pt.pt_getContext()
+        c['options'] = {'names': ['a', 'b', 'c']}
+        output = StringIO.StringIO()
+        interpreter(pt._v_program, pt._v_macros, getEngine().getContext(c),
+            output, tal=1, strictinsert=0)()
+        return output.getvalue()
+
+    def testSameOutput(self):
+        expected = self.render(0)
+        for text in ('T &amp; x', 'class="odd"', '<em>s</em>', 'kept',
+                'omitted', '<div>not omitted</div>', 'failed',
+                'Hello T & x', 'filled <i>T &amp; x</i>', 'default'):
+            self.failUnless(text in expected, text)
+        self.assertEqual(self.render(1), expected)
+
+    def testCompiledMacros(self):
+        pt = PageTemplate.PageTemplate()
+        pt.write(compiler_template)
+        program, macros = TALCompiler.compile_template(pt._v_program,
+            pt._v_macros)
+        # a compiled program is still a program that may be interpreted
+        self.assertEqual(list(macros['m']), list(pt._v_macros['m']))
+        self.failUnless(macros['m'].render)
+
+cache_template = """<ul tal:cache="options/key"><li tal:repeat="i options/names"
+  tal:content="i" /></ul>"""
+
+class FragmentCacheTestCase(unittest.TestCase):
+    def render(self, compile, cache, key, names):
+        pt = PageTemplate.PageTemplate()
+        pt.write(cache_template)
+        interpreter = TALInterpreter.TALInterpreter
+        if compile:
+            pt._v_program, pt._v_macros = TALCompiler.compile_template(
+                pt._v_program, pt._v_macros)
+            interpreter = TALCompiler.CompiledTALInterpreter
+        c = pt.pt_getContext()
+        c['options'] = {'key': key, 'names': names}
+        output = StringIO.StringIO()
+        interpreter(pt._v_program, pt._v_macros, getEngine().getContext(c),
+            output, tal=1, strictinsert=0, cache=cache)()
+        return output.getvalue()
+
+    def testCache(self):
+        for compile in 0, 1:
+            store = cache.MemoryStore(10)
+            fragments = cache.FragmentCache(store, ())
+            self.assertEqual(self.render(compile, fragments, 'k', ['a']),
+                '<ul><li>a</li></ul>\n')
+            # rendered once for each key
+            self.assertEqual(self.render(compile, fragments, 'k', ['b']),
+                '<ul><li>a</li></ul>\n')
+            self.assertEqual(self.render(compile, fragments, 'l', ['b']),
+                '<ul><li>b</li></ul>\n')
+            self.assertEqual(store.stats['hits'], 1)
+            # but not cached without a key or a cache
+            self.assertEqual(self.render(compile, fragments, None, ['c']),
+                '<ul><li>c</li></ul>\n')
+            self.assertEqual(self.render(compile, None, 'k', ['c']),
+                '<ul><li>c</li></ul>\n')
+            self.assertEqual(store.stats['stores'], 2)
+
+    def testUncachedValues(self):
+        class Value:
+            pass
+        for compile in 0, 1:
+            store = cache.MemoryStore(10)
+            fragments = cache.FragmentCache(store, ())
+            # only strings and numbers are cached: lists aren't hashable,
+            # and objects would be compared by identity
+            for key in ['1', '2'], Value(), 1.5:
+                self.assertEqual(self.render(compile, fragments, key, ['a']),
+                    '<ul><li>a</li></ul>\n')
+                self.assertEqual(self.render(compile, fragments, key, ['b']),
+                    '<ul><li>b</li></ul>\n')
+            self.assertEqual(store.stats['stores'], 0)
+            self.assertEqual(self.render(compile, fragments, 1, ['a']),
+                '<ul><li>a</li></ul>\n')
+            self.assertEqual(self.render(compile, fragments, 1, ['b']),
+                '<ul><li>a</li></ul>\n')
+
+    def testTemplateChanged(self):
+        dir = '_test_templating'
+        os.mkdir(dir)
+        try:
+            templates = Templates(dir)
+            src = os.path.join(dir, 'page.html')
+            for compile in 0, 1:
+                Templates.templates.clear()
+                templates.compile = compile
+                store = cache.MemoryStore(10)
+                fragments = cache.FragmentCache(store, (), templates)
+                for text, mtime in ('ul', 1000), ('ol', 2000):
+                    # (the elements are at the same position)
+                    f = open(src, 'w')
+                    f.write(cache_template.replace('ul', text))
+                    f.close()
+                    os.utime(src, (mtime, mtime))
+                    pt = templates.get('page', None)
+                    for names in ['a'], ['b']:
+                        interpreter = TALInterpreter.TALInterpreter
+                        if compile:
+                            interpreter = TALCompiler.CompiledTALInterpreter
+                        c = pt.pt_getContext()
+                        c['options'] = {'key': 'k', 'names': names}
+                        output = StringIO.StringIO()
+                        interpreter(pt._v_program, pt._v_macros,
+                            getEngine().getContext(c), output, tal=1,
+                            strictinsert=0, cache=fragments)()
+                        self.assertEqual(output.getvalue(),
+                            '<%s><li>a</li></%s>\n'%(text, text))
+                self.assertEqual(store.stats['stores'], 2)
+        finally:
+            Templates.templates.clear()
+            shutil.rmtree(dir)
+
+class TemplateCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = '_test_templating'
+        os.mkdir(self.dir)
+        self.cache = os.path.join(self.dir, 'cache')
+        f = open(os.path.join(self.dir, 'page.html'), 'w')
+        f.write(compiler_template)
+        f.close()
+        Templates.templates.clear()
+
+    def tearDown(self):
+        Templates.templates.clear()
+        shutil.rmtree(self.dir)
+
+    def render(self, pt):
+        interpreter = TALInterpreter.TALInterpreter
+        if pt._v_compiled:
+            interpreter = TALCompiler.CompiledTALInterpreter
+        c = pt.pt_getContext()
+        c['options'] = {'names': ['a', 'b', 'c']}
+        output = StringIO.StringIO()
+        interpreter(pt._v_program, pt._v_macros, getEngine().getContext(c),
+            output, tal=1, strictinsert=0)()
+        return output.getvalue()
+
+    def get(self, compile):
+        Templates.templates.clear()
+        return Templates(self.dir, compile, self.cache).get('page', None)
+
+    def testCache(self):
+        src = os.path.join(self.dir, 'page.html')
+        for compile in 0, 1:
+            expected = self.render(self.get(compile))
+            # the template is cached once cooked, for the processes
+            # starting later to load it
+            pt = RoundupPageTemplate()
+            pt.compile = compile
+            pt.id = 'page.html'
+            self.failUnless(TemplateCache(self.cache).load(pt, src))
+            self.assertEqual(pt._v_compiled, compile)
+            self.assertEqual(self.render(pt), expected)
+        self.assertEqual(len(os.listdir(self.cache)), 2)
+        # readable by the processes of other users (mkstemp() makes the
+        # files private)
+        for name in os.listdir(self.cache):
+            mode = os.stat(os.path.join(self.cache, name))[os.path.stat.ST_MODE]
+            self.assertEqual(mode & 0777, 0644)
+
+    def testUntrusted(self):
+        src = os.path.join(self.dir, 'page.html')
+        self.get(0)
+        pt = RoundupPageTemplate()
+        pt.compile = 0
+        pt.id = 'page.html'
+        cache = TemplateCache(self.cache)
+        self.failUnless(cache.load(pt, src))
+        # files anybody could have written (or replaced) aren't loaded
+        os.chmod(self.cache, 0777)
+        self.failIf(cache.load(pt, src))
+        os.chmod(self.cache, 0755)
+        filename = cache.filename(src, 0)
+        os.chmod(filename, 0666)
+        self.failIf(cache.load(pt, src))
+        os.chmod(filename, 0644)
+        self.failUnless(cache.load(pt, src))
+        # nor are the files of other users
+        if hasattr(os, 'geteuid') and os.geteuid() == 0:
+            os.chown(filename, 65534, -1)
+            self.failIf(cache.load(pt, src))
+
+    def testStale(self):
+        self.get(0)
+        # a changed template isn't loaded from the cache
+        f = open(os.path.join(self.dir, 'page.html'), 'w')
+        f.write('<p tal:content="string:changed">x</p>')
+        f.close()
+        os.utime(os.path.join(self.dir, 'page.html'), (0, 0))
+        self.assertEqual(self.render(self.get(0)), '<p>changed</p>\n')
+        # nor is one the cache can't be read
+        for name in os.listdir(self.cache):
+            open(os.path.join(self.cache, name), 'w').write('garbage')
+        self.assertEqual(self.render(self.get(0)), '<p>changed</p>\n')
+
 '''
 class HTMLPermissions:
     def is_edit_ok(self):
@@ -263,6 +568,11 @@ def test_suite():
     suite.addTest(unittest.makeSuite(HTMLDatabaseTestCase))
     suite.addTest(unittest.makeSuite(FunctionsTestCase))
     suite.addTest(unittest.makeSuite(HTMLClassTestCase))
+    suite.addTest(unittest.makeSuite(FilterResultTestCase))
+    suite.addTest(unittest.makeSuite(TemplateLookupTestCase))
+    suite.addTest(unittest.makeSuite(TALCompilerTestCase))
+    suite.addTest(unittest.makeSuite(FragmentCacheTestCase))
+    suite.addTest(unittest.makeSuite(TemplateCacheTestCase))
     return suite
 
 if __name__ == '__main__':